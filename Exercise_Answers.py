@@ -10,6 +10,7 @@ import glob, os, datetime, tempfile, gc, logging, time
 import rioxarray  # Required for GeoTIFF conversion
 import eccodes  # Ensures compatibility with GRIB2 files
 import colorama
+from grib_index_cache import GribIndexCache  # Persistent cfgrib index files, outside ./Data
 
 # former color setup that I use to highlight "prints", but we need to refactor that for "logging".
 class style():
@@ -102,11 +103,12 @@ for init_dt, step_dict in sorted(init_dict.items()):
 
 datasets = []
 temp_files = []
+index_cache = GribIndexCache()
 
 for file_path in file_list:
     try:
         # Load main dataset
-        ds_main = xr.open_dataset(file_path, engine='cfgrib', backend_kwargs={"indexpath": None})
+        ds_main = xr.open_dataset(file_path, engine='cfgrib', backend_kwargs=index_cache.backend_kwargs(file_path))
         datasets.append(ds_main)
 
         # Load soil variables separately (avoid conflicts with depthBelowLandLayer)
@@ -114,7 +116,7 @@ for file_path in file_list:
             try:
                 ds_soil = xr.open_dataset(
                     file_path, engine='cfgrib',
-                    backend_kwargs={"indexpath": None},
+                    backend_kwargs=index_cache.backend_kwargs(file_path),
                     filter_by_keys={"depthBelowLandLayer": depth}
                 )
                 datasets.append(ds_soil)
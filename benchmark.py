@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from logging_config import logging, pool_initializer  # Import custom logging setup
+from profiling import process_peak_rss_mb
+from data_extraction import SHORT_NAMES
+import encoding_profiles
+
+project_dir = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARK_DIR = os.path.join(project_dir, "benchmarks")
+HISTORY_PATH = os.path.join(BENCHMARK_DIR, "history.jsonl")
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+# Allowed slowdown (or memory growth) against the baseline before a stage is flagged
+DEFAULT_TOLERANCE = 0.25
+
+RESOLUTIONS = {1.0: "1p00", 0.5: "0p50", 0.25: "0p25"}
+
+# shortName: (typeOfLevel, level or (top, bottom) soil layer in cm, accumulated)
+VARIABLES = {
+    "t2m": ("heightAboveGround", 2, False),
+    "tp": ("surface", 0, True),
+    "smlt": ("surface", 0, True),
+    "stl1": ("depthBelowLandLayer", (0, 7), False),
+    "swvl1": ("depthBelowLandLayer", (0, 7), False),
+    "swvl2": ("depthBelowLandLayer", (7, 28), False),
+    "swvl3": ("depthBelowLandLayer", (28, 100), False),
+}
+
+DEFAULT_STAGES = ["extract", "clean", "gif", "3d_map", "kml", "geotiff", "cog", "csv", "zarr", "parquet", "rollups"]
+
+def synthetic_field(name, latitudes, longitudes, step, rng):
+    """Plausible values for a variable on the grid, so packing and colour scales behave like real data."""
+    lat, lon = np.meshgrid(np.radians(latitudes), np.radians(longitudes), indexing="ij")
+    noise = rng.standard_normal(lat.shape)
+
+    if name in ("t2m", "stl1"):
+        diurnal = 5 * np.sin(lon + 2 * np.pi * step / 24)
+        return 300 - 45 * np.sin(lat) ** 2 + diurnal + noise
+    if name in ("tp", "smlt"):
+        # Accumulated since initialisation, so it grows with the step
+        return np.clip(step * 2e-4 * (1 + noise), 0, None)
+    return np.clip(0.3 + 0.05 * noise, 0, 0.5)  # Volumetric soil water
+
+def write_synthetic_grib(file_path, init_datetime, step, resolution=0.25, variables=tuple(VARIABLES), seed=0):
+    """Write one forecast step of synthetic GRIB2 messages with eccodes."""
+    import eccodes  # Only needed to generate benchmark data
+
+    n_lat, n_lon = int(round(180 / resolution)) + 1, int(round(360 / resolution))
+    latitudes = np.linspace(90, -90, n_lat)
+    longitudes = np.arange(n_lon) * resolution
+    rng = np.random.default_rng([seed, step])
+
+    with open(file_path, "wb") as f:
+        for name in variables:
+            type_of_level, level, accumulated = VARIABLES[name]
+            handle = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+            try:
+                eccodes.codes_set_key_vals(handle, {
+                    "Ni": n_lon, "Nj": n_lat,
+                    "latitudeOfFirstGridPointInDegrees": 90.0,
+                    "latitudeOfLastGridPointInDegrees": -90.0,
+                    "longitudeOfFirstGridPointInDegrees": 0.0,
+                    "longitudeOfLastGridPointInDegrees": float(longitudes[-1]),
+                    "iDirectionIncrementInDegrees": resolution,
+                    "jDirectionIncrementInDegrees": resolution,
+                    "dataDate": int(init_datetime.strftime("%Y%m%d")),
+                    "dataTime": init_datetime.hour * 100,
+                })
+                if accumulated:
+                    eccodes.codes_set(handle, "productDefinitionTemplateNumber", 8)
+                eccodes.codes_set(handle, "shortName", SHORT_NAMES.get(name, name))
+                eccodes.codes_set(handle, "typeOfLevel", type_of_level)
+
+                if isinstance(level, tuple):
+                    eccodes.codes_set(handle, "topLevel", level[0])
+                    eccodes.codes_set(handle, "bottomLevel", level[1])
+                else:
+                    eccodes.codes_set(handle, "level", level)
+
+                if accumulated:
+                    eccodes.codes_set_key_vals(handle, {"startStep": 0, "endStep": step})
+                else:
+                    eccodes.codes_set(handle, "step", step)
+
+                values = synthetic_field(name, latitudes, longitudes, step, rng)
+                eccodes.codes_set_values(handle, values.ravel())
+                eccodes.codes_write(handle, f)
+            finally:
+                eccodes.codes_release(handle)
+
+def generate_dataset(data_dir, resolution=0.25, steps=24, variables=tuple(VARIABLES), step_hours=1, seed=0):
+    """Write ``steps`` synthetic forecast files named like the real GFS inputs, returning their paths."""
+    os.makedirs(data_dir, exist_ok=True)
+    init_datetime = datetime.datetime(2025, 2, 11, 0)
+
+    file_paths = []
+    for index in range(steps):
+        step = index * step_hours
+        file_name = f"gfs.{RESOLUTIONS[resolution]}.{init_datetime:%Y%m%d}.{init_datetime:%H}z.{step:03d}h.grib2"
+        file_path = os.path.join(data_dir, file_name)
+        write_synthetic_grib(file_path, init_datetime, step, resolution, variables, seed)
+        file_paths.append(file_path)
+
+    return file_paths
+
+def path_size(path):
+    """Size of a file, or of every file below a directory, in bytes (0 if missing)."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def _run_isolated(context, func, *args):
+    """``func(*args)`` in a fresh spawned process. A run that raises or crashes its process is returned as failed."""
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context, **pool_initializer()) as executor:
+            return executor.submit(func, *args).result()
+    except Exception as e:
+        logging.error(f"{func.__name__}{args[1:]} failed: {e}")
+        return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+def _summarize_runs(runs):
+    """Failure entry of a stage or profile none of whose runs finished, None if one did."""
+    if any("error" not in run for run in runs):
+        return None
+    return {"ok": False, "error": runs[0]["error"]}
+
+def _run_stage(work_dir, stage_name, workers):
+    """Run one main.py stage in a fresh process and return its timings."""
+    import main  # Changes into the project directory on import
+
+    os.chdir(work_dir)
+    args = argparse.Namespace(workers=workers, sink_workers=1, index_cache=os.path.join(work_dir, "index_cache"),
+                              incremental=False, force=True, show=False, variables=None, bbox=None, regions=None,
+                              archive=False, archive_days=10, parquet_drop_fill=False,
+                              zones=None, zones_id_field=None, regrid=None, regrid_method="bilinear",
+                              encoding_profile=encoding_profiles.DEFAULT_PROFILE)
+    stage = main.build_pipeline(args).stages[stage_name]
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    result = stage.func(**stage.params)
+
+    return {
+        "ok": result is not None,
+        "wall_s": time.perf_counter() - wall_start,
+        "cpu_s": time.process_time() - cpu_start,
+        # Peak of the whole (fresh) run process, extraction workers are reaped by then so their peak counts too
+        "process_peak_rss_mb": max(process_peak_rss_mb(), process_peak_rss_mb(resource.RUSAGE_CHILDREN)),
+    }
+
+def _stage_input(work_dir, stage_name):
+    """What a stage reads, for the MB/s figure."""
+    if stage_name == "extract":
+        return os.path.join(work_dir, "Data")
+    if stage_name == "clean":
+        return os.path.join(work_dir, "Outputs", "final_dataset.zarr")
+    return os.path.join(work_dir, "Outputs", "final_cleaned_dataset.nc")
+
+def run_benchmark(work_dir, steps, stages=DEFAULT_STAGES, workers=1, repeat=1):
+    """Time every stage in order, each run in a fresh spawned process (best wall time of ``repeat`` runs)."""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+
+    for stage_name in stages:
+        input_bytes = path_size(_stage_input(work_dir, stage_name))
+        runs = []
+
+        for _ in range(repeat):
+            # Cold cfgrib indexes, otherwise only the first extraction run pays for indexing
+            shutil.rmtree(os.path.join(work_dir, "index_cache"), ignore_errors=True)
+            # Full rollups every run, not an up-to-date check
+            shutil.rmtree(os.path.join(work_dir, "Outputs", "rollups"), ignore_errors=True)
+
+            runs.append(_run_isolated(context, _run_stage, work_dir, stage_name, workers))
+
+        results[stage_name] = _summarize_runs(runs)
+        if results[stage_name] is not None:
+            continue
+
+        best = min((run for run in runs if "error" not in run), key=lambda run: run["wall_s"])
+        results[stage_name] = {
+            "ok": all(run["ok"] for run in runs),
+            **({"error": run["error"] for run in runs if "error" in run}),
+            "wall_s": round(best["wall_s"], 4),
+            "cpu_s": round(best["cpu_s"], 4),
+            "process_peak_rss_mb": max(run["process_peak_rss_mb"] for run in runs if "error" not in run),
+            "steps_per_s": round(steps / best["wall_s"], 3),
+            "mb_per_s": round(input_bytes / (1024 * 1024) / best["wall_s"], 3),
+        }
+        logging.info(f"{stage_name}: {results[stage_name]}")
+
+    return results
+
+def _run_encoding(work_dir, profile, engine):
+    """Write the cleaned dataset with one encoding profile and read it back, in a fresh process."""
+    import xarray as xr
+
+    os.chdir(work_dir)
+    source = xr.open_dataset(os.path.join("Outputs", "final_cleaned_dataset.nc"), chunks={})
+    output_path = os.path.join("Outputs", f"encoding_{profile}.{'zarr' if engine == 'zarr' else 'nc'}")
+    shutil.rmtree(output_path, ignore_errors=True)
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if engine == "zarr":
+        encoding_profiles.to_zarr(source, output_path, profile, mode="w")
+    else:
+        encoding_profiles.to_netcdf(source, output_path, profile)
+    write_s, cpu_s = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    read_start = time.perf_counter()
+    written = (xr.open_zarr(output_path) if engine == "zarr" else xr.open_dataset(output_path, chunks={})).load()
+    read_s = time.perf_counter() - read_start
+
+    raw_mb = sum(var.nbytes for var in source.data_vars.values()) / (1024 * 1024)
+    size_mb = path_size(output_path) / (1024 * 1024)
+    max_error = {name: float(np.nanmax(np.abs(written[name].values - source[name].values)))
+                 for name in source.data_vars if source[name].ndim}
+    if engine == "zarr":
+        shutil.rmtree(output_path)
+    else:
+        os.remove(output_path)
+
+    return {
+        "ok": True,
+        "wall_s": round(write_s, 4),
+        "cpu_s": round(cpu_s, 4),
+        "read_s": round(read_s, 4),
+        "process_peak_rss_mb": process_peak_rss_mb(),
+        "size_mb": round(size_mb, 3),
+        "size_ratio": round(size_mb / raw_mb, 4),
+        "write_mb_per_s": round(raw_mb / write_s, 3),
+        "read_mb_per_s": round(raw_mb / read_s, 3),
+        "max_error": max_error,
+    }
+
+def run_encoding_benchmark(work_dir, profiles=tuple(encoding_profiles.PROFILES), engines=("netcdf", "zarr"), repeat=1):
+    """Size ratio (against the uncompressed arrays) and write/read speed of every encoding profile."""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+
+    for profile in profiles:
+        for engine in engines:
+            runs = [_run_isolated(context, _run_encoding, work_dir, profile, engine) for _ in range(repeat)]
+
+            name = f"encoding_{profile}_{engine}"
+            results[name] = _summarize_runs(runs)
+            if results[name] is not None:
+                continue
+
+            runs = [run for run in runs if "error" not in run]
+            results[name] = {**min(runs, key=lambda run: run["wall_s"]), "read_s": min(run["read_s"] for run in runs)}
+            logging.info(f"{name}: {results[name]}")
+
+    return results
+
+def config_key(config):
+    """Identify a benchmark configuration, results are only compared within the same one."""
+    return f"res{config['resolution']}-steps{config['steps']}-{'+'.join(config['variables'])}-workers{config['workers']}"
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Stages slower, or using more memory, than the baseline by more than ``tolerance``."""
+    regressions = []
+    for stage_name, result in results.items():
+        base = baseline.get(stage_name)
+        if base is None or not (result["ok"] and base["ok"]):
+            continue
+
+        for metric in ("wall_s", "read_s", "size_mb", "process_peak_rss_mb"):
+            if metric not in result or metric not in base:
+                continue
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{stage_name} {metric}: {base[metric]} -> {result[metric]} "
+                                   f"({result[metric] / base[metric] - 1:+.0%})")
+    return regressions
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_dir,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _load_baselines():
+    try:
+        with open(BASELINE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GRIB2 pipeline stages on synthetic data.")
+    parser.add_argument("--resolution", type=float, default=0.25, choices=sorted(RESOLUTIONS),
+                        help="Grid spacing in degrees.")
+    parser.add_argument("--steps", type=int, default=24, help="Number of forecast steps (files).")
+    parser.add_argument("--variables", default=",".join(VARIABLES),
+                        help=f"Comma-separated variables to encode (from {', '.join(VARIABLES)}).")
+    parser.add_argument("--stages", default=",".join(DEFAULT_STAGES), help="Comma-separated main.py stages to time.")
+    parser.add_argument("--profiles", default=",".join(encoding_profiles.PROFILES),
+                        help="Comma-separated encoding profiles to time on the cleaned dataset (empty to skip).")
+    parser.add_argument("--workers", type=int, default=1, help="GRIB2 extraction workers (0 = one per CPU).")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per stage, the fastest one is kept.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic fields.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative slowdown or memory growth flagged as a regression.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store these results as the baseline of this configuration.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directory.")
+    args = parser.parse_args()
+
+    variables = [name.strip() for name in args.variables.split(",")]
+    unknown_variables = set(variables) - set(VARIABLES)
+    if unknown_variables:
+        parser.error(f"Unknown variables {sorted(unknown_variables)}, choose from {list(VARIABLES)}")
+    stages = [name.strip() for name in args.stages.split(",")]
+    profiles = [name.strip() for name in args.profiles.split(",") if name.strip()]
+    config = {"resolution": args.resolution, "steps": args.steps, "variables": variables, "workers": args.workers}
+
+    work_dir = tempfile.mkdtemp(prefix="grib2_benchmark_")
+    try:
+        logging.info(f"Generating {args.steps} synthetic GRIB2 steps at {args.resolution} degrees in {work_dir}...")
+        generate_dataset(os.path.join(work_dir, "Data"), args.resolution, args.steps, variables, seed=args.seed)
+        os.makedirs(os.path.join(work_dir, "Outputs"), exist_ok=True)
+
+        results = run_benchmark(work_dir, args.steps, stages, args.workers or None, args.repeat)
+        if profiles:
+            if os.path.exists(os.path.join(work_dir, "Outputs", "final_cleaned_dataset.nc")):
+                results.update(run_encoding_benchmark(work_dir, profiles, repeat=args.repeat))
+            else:
+                logging.warning("The encoding profiles are timed on the cleaned dataset, include the clean stage.")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    key = config_key(config)
+    entry = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "config": config,
+        "results": results,
+    }
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    with open(HISTORY_PATH, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    logging.info(f"Benchmark results appended to {HISTORY_PATH}")
+
+    # Failed stages and profiles are recorded in the history, and still fail the run
+    failed = [name for name, result in results.items() if not result["ok"]]
+    if failed:
+        logging.error(f"Failed: {', '.join(failed)}")
+
+    baselines = _load_baselines()
+    if args.save_baseline:
+        baselines[key] = entry
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        logging.info(f"Saved as the baseline for {key}")
+        return
+
+    if key not in baselines:
+        logging.warning(f"No baseline for {key}, run with --save-baseline to store one.")
+        sys.exit(1 if failed else 0)
+
+    regressions = find_regressions(results, baselines[key]["results"], args.tolerance)
+    for regression in regressions:
+        logging.error(f"Regression against baseline {baselines[key]['commit']}: {regression}")
+
+    if regressions or failed:
+        sys.exit(1)
+    logging.info(f"No regressions against baseline {baselines[key]['commit']} for {key}.")
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,82 @@ import numpy as np
 import logging
 
 from logging_config import logging  # Import custom logging setup
+from profiling import profile_stage
+import encoding_profiles
 
-def clean_and_transform(ds):
-    """Apply data cleaning and transformation steps."""
+MISSING_SENTINEL = -9999
+FILL_VALUE = 0.0
+
+def _replace_missing_block(values, sentinel, fill_value):
+    """Replace sentinel and NaN values of one chunk in a single pass."""
+    return np.where((values == sentinel) | np.isnan(values), fill_value, values).astype(values.dtype, copy=False)
+
+def replace_missing(ds, sentinel=MISSING_SENTINEL, fill_value=FILL_VALUE):
+    """Lazily replace sentinel/NaN values of every floating point variable, chunk by chunk."""
+    def replace(da):
+        if not np.issubdtype(da.dtype, np.floating):
+            return da
+        return xr.apply_ufunc(
+            _replace_missing_block, da,
+            kwargs={"sentinel": sentinel, "fill_value": fill_value},
+            dask="parallelized", output_dtypes=[da.dtype], keep_attrs=True
+        )
+
+    return ds.map(replace, keep_attrs=True)
+
+def wrap_longitude(ds):
+    """Convert longitude from [0, 360] to [-180, 180] by rolling a fixed index instead of sorting."""
+    lon_chunks = ds.chunks.get("longitude")
+    wrapped = ((ds.longitude.values + 180) % 360) - 180
+
+    # On a regular grid the wrapped longitudes are already sorted once rotated
+    # to start at the most western one, so a roll replaces sortby's gather
+    shift = int(np.argmin(wrapped))
+    rolled = np.roll(wrapped, -shift)
+
+    if np.all(np.diff(rolled) > 0):
+        ds = ds.roll(longitude=-shift, roll_coords=True)
+        ds = ds.assign_coords(longitude=("longitude", rolled, ds.longitude.attrs))
+    else:
+        logging.warning("Longitudes are not a regular grid, falling back to sortby.")
+        ds = ds.assign_coords(longitude=wrapped).sortby("longitude")
+
+    # A shift that isn't a multiple of the chunk size splits the boundary chunk,
+    # merge the pieces back into the original layout
+    if lon_chunks and ds.chunks.get("longitude") != lon_chunks:
+        ds = ds.chunk({"longitude": lon_chunks[0]})
+
+    return ds
+
+def regular_step(coords, name="coordinate"):
+    """Spacing of an evenly spaced axis, ValueError when it has gaps (e.g. a crop to several regions)."""
+    coords = np.asarray(coords, dtype=np.float64)
+    if len(coords) < 2:
+        raise ValueError(f"The {name} axis needs at least two points to have a spacing")
+
+    step = (coords[-1] - coords[0]) / (len(coords) - 1)
+    if not np.allclose(np.diff(coords), step):
+        raise ValueError(f"The {name} axis is not evenly spaced, export each region separately")
+    return step
+
+@profile_stage("clean")
+def clean_and_transform(ds, output_path="Outputs/final_cleaned_dataset.nc", profile=encoding_profiles.DEFAULT_PROFILE):
+    """Apply data cleaning and transformation steps.
+
+    Every step stays lazy and chunk-aligned on a dask-backed dataset, and the
+    output is written chunk by chunk, so peak memory is bounded by the chunk
+    size rather than the dataset size. The NetCDF is packed, chunked and
+    compressed with the named encoding ``profile`` (see encoding_profiles).
+    """
     if ds is None:
         logging.error("Received empty dataset for cleaning. Exiting...")
         return None
 
     # Replace missing values
-    ds_cleaned = ds.where(ds != -9999, np.nan).fillna(0.0)
+    ds_cleaned = replace_missing(ds)
 
     # Convert longitude to [-180, 180] range
-    ds_cleaned = ds_cleaned.assign_coords(longitude=((ds_cleaned.longitude + 180) % 360) - 180)
-    ds_cleaned = ds_cleaned.sortby(ds_cleaned.longitude)
+    ds_cleaned = wrap_longitude(ds_cleaned)
 
     # Rename specific variables
     rename_dict = {
@@ -28,8 +91,11 @@ def clean_and_transform(ds):
 
     # Save processed dataset
     ds_cleaned.attrs["crs"] = "EPSG:4326"
-    ds_cleaned.to_netcdf("Outputs/final_cleaned_dataset.nc")
+    with profile_stage("netcdf_write", level=logging.DEBUG, file=output_path):
+        encoding_profiles.to_netcdf(ds_cleaned, output_path, profile)
 
-    logging.info("Final cleaned dataset saved as Outputs/final_cleaned_dataset.nc")
+    logging.info(f"Final cleaned dataset saved as {output_path}")
 
-    return ds_cleaned
+    # Hand back the written file lazily instead of the graph, so later stages
+    # don't recompute the cleaning
+    return xr.open_dataset(output_path, chunks={})
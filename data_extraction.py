@@ -4,71 +4,667 @@ import glob
 import datetime
 import logging
 import os
-import tempfile
-import gc
+import shutil
+import json
+import math
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from logging_config import logging  # Import custom logging setup
+from logging_config import logging, pool_initializer  # Import custom logging setup
+from grib_index_cache import shared_cache
+from profiling import profile_stage
+import forecast_archive
 
-def process_grib_files():
-    """Process GRIB2 files and extract data."""
-    logging.info("Starting GRIB2 file processing...")
+# Soil layers come out of cfgrib as one hypercube per depth
+SOIL_LEVEL = "depthBelowLandLayer"
 
-    # List all GRIB2 files
-    file_list = sorted(glob.glob("./Data/*.grib2"))
+# Zarr store every GRIB2 step is streamed into
+DEFAULT_STORE = "Outputs/final_dataset.zarr"
 
-    if not file_list:
-        logging.error("No GRIB2 files found in ./Data/. Exiting...")
+# One step per chunk and 360x360 spatial tiles (a 0.25 degree grid splits into
+# 2x4 tiles, and the longitude roll in data_cleaning stays chunk-aligned)
+DEFAULT_CHUNKS = {"step": 1, "latitude": 360, "longitude": 360}
+
+# GRIB shortName of variables cfgrib renames, the others are named after their shortName
+SHORT_NAMES = {"t2m": "2t", "d2m": "2d", "u10": "10u", "v10": "10v", "si10": "10si"}
+
+# cfgrib names of the variables that can be selected for extraction (the
+# names before data_cleaning renames the soil layers, e.g. swvl1 not sw-5)
+VARIABLES = [*SHORT_NAMES, "tp", "smlt", "stl1", "swvl1", "swvl2", "swvl3"]
+
+# Named regions of interest as (lat_min, lat_max, lon_min, lon_max), longitudes in [-180, 180]
+REGIONS = {
+    "south_america": (-56.0, 13.0, -82.0, -34.0),
+    "us_corn_belt": (36.0, 49.0, -104.0, -80.0),
+}
+
+def parse_grib_filename(file_path):
+    """Return (init datetime, forecast step hours) parsed from a GRIB2 filename, or None."""
+    # Same naming scheme as Exercise_Answers.py PART 1: <model>.<res>.<YYYYMMDD>.<HHz>.<FFFh>.grib2,
+    # ensemble members add their name before the step: <model>.<res>.<YYYYMMDD>.<HHz>.<member>.<FFFh>.grib2
+    parts = os.path.basename(file_path).split(".")
+
+    if len(parts) < 5:
+        return None
+
+    date_str, hour_str, step_str = parts[2], parts[3], parts[5] if len(parts) > 6 else parts[4]
+    try:
+        init_datetime = datetime.datetime.strptime(date_str + hour_str.replace("z", ""), "%Y%m%d%H")
+        forecast_step_hours = int(step_str.replace("h", ""))
+    except ValueError:
+        return None
+
+    return init_datetime, forecast_step_hours
+
+def parse_member(file_path):
+    """Ensemble member of a GRIB2 filename (e.g. c00 or p01), DETERMINISTIC_MEMBER for single runs."""
+    parts = os.path.basename(file_path).split(".")
+    return parts[4] if len(parts) > 6 else forecast_archive.DETERMINISTIC_MEMBER
+
+def decoded_cycle_step(file_path, index_cache_dir=None):
+    """Return (init datetime, forecast step hours) from the decoded ``time`` and ``step`` of a GRIB2 file, or None."""
+    try:
+        ds = decode_grib_file(file_path, shared_cache(index_cache_dir))  # Lazy, only the coordinates are read
+        init_datetime = ds["time"].values.astype("datetime64[s]").item()
+        forecast_step_hours = int(ds["step"].values // np.timedelta64(1, "h"))
+    except Exception as e:
+        logging.error(f"Error reading the forecast time of {file_path}: {e}")
         return None
+    return init_datetime, forecast_step_hours
 
-    temp_files = []
+def plan_cycles(file_list, index_cache_dir=None):
+    """Group GRIB2 files into {init datetime: {member: [(step hours, path), ...]}}, sorted by step.
 
+    Files whose name can't be parsed are placed from their decoded ``time``
+    and ``step`` coordinates instead (as single runs), and skipped when
+    those can't be read either.
+    """
+    cycles = {}
     for file_path in file_list:
-        try:
-            # Open dataset with all available variables (without filtering)
-            ds_main = xr.open_dataset(file_path, engine='cfgrib', backend_kwargs={"indexpath": None})
-            datasets = [ds_main]  # Store all processed datasets
-
-            # Extract specific variables (Fixing depthBelowLandLayer issue)
-            for depth in [0, 7, 28]:  
-                try:
-                    ds_soil = xr.open_dataset(
-                        file_path, engine='cfgrib',
-                        backend_kwargs={"indexpath": None},
-                        filter_by_keys={"depthBelowLandLayer": depth}
-                    )
-                    datasets.append(ds_soil)
-                except Exception as e:
-                    logging.warning(f"Skipping depth {depth} for {file_path}: {e}")
-
-            # Merge all datasets per file
-            ds_merged = xr.merge(datasets, combine_attrs="override")
-
-            # Save to temporary NetCDF
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".nc") as tmp:
-                temp_path = tmp.name
-                ds_merged.to_netcdf(temp_path)
-                temp_files.append(temp_path)
-
-            del ds_main, ds_merged, datasets  # Free memory
-            gc.collect()
-
-        except Exception as e:
-            logging.error(f"Error processing {file_path}: {e}")
-
-    if not temp_files:
-        logging.error("No NetCDF files were created. Exiting...")
+        parsed = parse_grib_filename(file_path)
+        member = parse_member(file_path)
+        if parsed is None:
+            parsed = decoded_cycle_step(file_path, index_cache_dir)
+            member = forecast_archive.DETERMINISTIC_MEMBER
+        if parsed is None:
+            logging.warning(f"Skipping file due to unexpected format: {file_path}")
+            continue
+
+        init_datetime, step = parsed
+        cycles.setdefault(init_datetime, {}).setdefault(member, []).append((step, file_path))
+
+    for members in cycles.values():
+        for files in members.values():
+            files.sort()
+    return cycles
+
+def _latest_cycle(cycles):
+    """(init datetime, member) of the newest cycle's primary member, warning about what is left out."""
+    latest = max(cycles)
+    member = forecast_archive.primary_member(cycles[latest])
+
+    older = [init_datetime for init_datetime in sorted(cycles) if init_datetime != latest]
+    if older:
+        logging.warning(f"Only the newest cycle {latest:%Y-%m-%d %Hz} is extracted, {len(older)} older cycles in "
+                        f"./Data ({', '.join(f'{init:%Y-%m-%d %Hz}' for init in older)}) need --archive.")
+    if len(cycles[latest]) > 1:
+        logging.warning(f"Only ensemble member {member} of {len(cycles[latest])} is extracted, the others need --archive.")
+
+    return latest, member
+
+def _normalize_box(box):
+    """(lat_min, lat_max, lon_min, lon_max) with lon_min in [-180, 180), whichever longitude convention it came in."""
+    lat_min, lat_max, lon_min, lon_max = (float(value) for value in box)
+    width = min(lon_max - lon_min, 360.0)
+    lon_min = (lon_min + 180.0) % 360.0 - 180.0
+    return lat_min, lat_max, lon_min, lon_min + width
+
+def resolve_bbox(bbox=None, regions=None):
+    """Boxes of ``bbox`` and every named region, with normalized longitudes (None means the whole globe)."""
+    boxes = ([bbox] if bbox else []) + [REGIONS[name] for name in regions or []]
+    if not boxes:
+        return None
+    return list(dict.fromkeys(_normalize_box(box) for box in boxes))
+
+def _boxes(bbox):
+    """A single (lat_min, lat_max, lon_min, lon_max) box or a list of them, as a list."""
+    return [bbox] if np.isscalar(bbox[0]) else bbox
+
+def _box_masks(latitudes, longitudes, box):
+    """Latitude and longitude masks of the grid points inside one box (longitudes in [0, 360))."""
+    lat_min, lat_max, lon_min, lon_max = box
+    lat_mask = (latitudes >= lat_min) & (latitudes <= lat_max)
+    if lon_max - lon_min >= 360:
+        lon_mask = np.ones(len(longitudes), dtype=bool)
+    elif lon_min % 360 <= lon_max % 360:
+        lon_mask = (longitudes >= lon_min % 360) & (longitudes <= lon_max % 360)
+    else:
+        lon_mask = (longitudes >= lon_min % 360) | (longitudes <= lon_max % 360)
+    return lat_mask, lon_mask
+
+def crop_to_bbox(ds, bbox):
+    """Select the grid points inside (lat_min, lat_max, lon_min, lon_max), or inside any of a list of such boxes.
+
+    Several boxes keep the union of their latitude and longitude indices,
+    so the rows and columns between two regions are not read. Works on
+    either latitude order and on [0, 360] or [-180, 180] longitudes, a box
+    crossing the grid's longitude seam keeps both sides
+    (data_cleaning.wrap_longitude puts them back in order).
+    """
+    latitudes = ds["latitude"].values
+    longitudes = ds["longitude"].values % 360
+
+    lat_mask = np.zeros(len(latitudes), dtype=bool)
+    lon_mask = np.zeros(len(longitudes), dtype=bool)
+    for box in _boxes(bbox):
+        box_lat_mask, box_lon_mask = _box_masks(latitudes, longitudes, box)
+        lat_mask |= box_lat_mask
+        lon_mask |= box_lon_mask
+
+    lat_index, lon_index = np.flatnonzero(lat_mask), np.flatnonzero(lon_mask)
+    if not len(lat_index) or not len(lon_index):
+        raise ValueError(f"Bounding box {bbox} contains no grid points")
+
+    return ds.isel(latitude=lat_index, longitude=lon_index)
+
+def decode_grib_file(file_path, index_cache=None, variables=None, bbox=None):
+    """Decode every hypercube of a GRIB2 file in a single scan and merge them.
+
+    ``variables`` (cfgrib names, e.g. t2m or swvl1) limits which messages
+    are decoded at all, ``bbox`` (lat_min, lat_max, lon_min, lon_max, or a
+    list of such boxes) crops every hypercube before the merge.
+    """
+    index_cache = index_cache or shared_cache()
+
+    # Unselected variables are filtered out of the index, so their messages are never decoded
+    backend_kwargs = {}
+    if variables:
+        backend_kwargs["filter_by_keys"] = {"shortName": [SHORT_NAMES.get(name, name) for name in variables]}
+
+    # cfgrib scans the messages once to write the index, then builds every
+    # hypercube (surface fields, each soil layer) from that same index instead
+    # of rescanning the whole file per filter_by_keys. The index is kept in the
+    # cache, so files already seen in earlier runs are not scanned again.
+    hypercubes = cfgrib.open_datasets(file_path, backend_kwargs=index_cache.backend_kwargs(file_path, **backend_kwargs))
+
+    surface, soil = [], []
+    for ds in hypercubes:
+        if bbox is not None:
+            ds = crop_to_bbox(ds, bbox)  # Still lazy, only the region is kept once loaded
+
+        if SOIL_LEVEL not in ds.coords:
+            surface.append(ds)
+        elif ds[SOIL_LEVEL].ndim == 0:
+            # Keep the depth as an attribute so the layers don't conflict on merge
+            depth = float(ds[SOIL_LEVEL].values)
+            for name in ds.data_vars:
+                ds[name].attrs[SOIL_LEVEL] = depth
+            soil.append((depth, ds.reset_coords(SOIL_LEVEL, drop=True)))
+        else:
+            soil.append((float(ds[SOIL_LEVEL].min()), ds))
+
+    if not surface and not soil:
+        raise ValueError(f"No GRIB2 messages could be decoded from {file_path}")
+
+    datasets = surface + [ds for _, ds in sorted(soil, key=lambda item: item[0])]
+
+    # Merge all datasets per file
+    return xr.merge(datasets, combine_attrs="override")
+
+def count_messages(ds):
+    """Number of GRIB2 messages (2D fields) held by a decoded dataset."""
+    return sum(math.prod(var.shape[:-2]) for var in ds.data_vars.values() if var.ndim >= 2)
+
+def load_grib_file(file_path, index_cache_dir=None, variables=None, bbox=None):
+    """Decode one GRIB2 file fully into memory (None on failure)."""
+    try:
+        with profile_stage("decode", level=logging.DEBUG, file=os.path.basename(file_path)) as stats:
+            ds = decode_grib_file(file_path, shared_cache(index_cache_dir), variables, bbox).load()
+            stats["messages"] = count_messages(ds)
+        return ds
+    except Exception as e:
+        logging.error(f"Error processing {file_path}: {e}")
         return None
 
-    # Merge all NetCDFs together
+def _map_files(func, file_list, max_workers, *args):
+    """Yield (file_path, func(file_path, *args)) in file order, in a process pool when max_workers != 1.
+
+    A worker that dies (e.g. killed for memory) breaks the whole pool and
+    every file in flight with it. The pool is then replaced and those files
+    are retried one at a time, so only the file that crashed its worker is
+    reported as failed and the extraction goes on.
+    """
+    if max_workers == 1:
+        for file_path in file_list:
+            yield file_path, func(file_path, *args)
+        return
+
+    logging.info(f"Extracting {len(file_list)} files with {max_workers or os.cpu_count()} workers...")
+    # Only keep a couple of files per worker in flight so results never pile up
+    window = 2 * (max_workers or os.cpu_count())
+    queue, pending = deque(file_list), deque()
+    executor = _new_pool(max_workers)
+
+    try:
+        while queue or pending:
+            try:
+                while queue and len(pending) < window:
+                    pending.append((queue[0], executor.submit(func, queue[0], *args)))
+                    queue.popleft()
+                file_path, future = pending[0]
+                result = _result(file_path, future)
+            except BrokenProcessPool:
+                suspects = [file_path for file_path, _ in pending]
+                pending.clear()
+                logging.warning(f"A worker died, retrying {len(suspects)} files one at a time in a new pool.")
+                executor = _restart_pool(executor, max_workers)
+
+                for file_path in suspects:
+                    try:
+                        result = _result(file_path, executor.submit(func, file_path, *args))
+                    except BrokenProcessPool:
+                        logging.error(f"Worker died while processing {file_path}, skipping it.")
+                        executor = _restart_pool(executor, max_workers)
+                        result = None
+                    yield file_path, result
+                continue
+
+            pending.popleft()
+            yield file_path, result
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def _new_pool(max_workers):
+    return ProcessPoolExecutor(max_workers=max_workers, **pool_initializer())
+
+def _restart_pool(broken, max_workers):
+    """A fresh pool replacing one whose worker died."""
+    broken.shutdown(wait=False, cancel_futures=True)
+    return _new_pool(max_workers)
+
+def _result(file_path, future):
+    """Result of a worker future, None (logged) if the file failed. A dead worker raises BrokenProcessPool."""
     try:
-        ds_combined = xr.open_mfdataset(temp_files, combine="nested", concat_dim="step")
+        return future.result()
+    except BrokenProcessPool:
+        raise
     except Exception as e:
-        logging.error(f"Failed to merge datasets: {e}")
+        logging.error(f"Worker failed while processing {file_path}: {e}")
+        return None
+
+def _as_step_slab(ds):
+    """Give a single-file dataset a length-1 ``step`` dimension so it can be appended."""
+    ds = ds.expand_dims("step")
+    if "valid_time" in ds.coords and ds["valid_time"].ndim == 0:
+        ds = ds.assign_coords(valid_time=ds["valid_time"].expand_dims("step"))
+    return ds
+
+# Fixed time units, otherwise xarray picks them from the first slab (e.g. "days"
+# for step 0) and every later append is stored in the wrong units
+TIME_ENCODING = {
+    "step": {"units": "minutes", "dtype": "int64"},
+    "valid_time": {"units": "minutes since 1970-01-01", "dtype": "int64"},
+    "time": {"units": "minutes since 1970-01-01", "dtype": "int64"},
+}
+
+def _zarr_encoding(ds, chunks):
+    """Zarr chunk and time encoding for every variable along its own dimensions."""
+    encoding = {name: dict(TIME_ENCODING[name]) for name in TIME_ENCODING if name in ds.variables}
+    for name, var in ds.variables.items():
+        if var.ndim > 0:
+            var_chunks = tuple(min(chunks.get(dim, size), size) for dim, size in zip(var.dims, var.shape))
+            encoding.setdefault(name, {})["chunks"] = var_chunks
+    return encoding
+
+def load_ingest_manifest(store_path=DEFAULT_STORE):
+    """Return the (init datetime, step hours) pairs already written to a store.
+
+    The manifest of a forecast archive holds (init datetime, step hours,
+    member) triples instead.
+    """
+    if not os.path.exists(store_path):
+        return set()  # Store was removed, everything has to be ingested again
+
+    try:
+        with open(f"{store_path}.manifest.json") as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return set()
+
+    return {(datetime.datetime.fromisoformat(init), *rest) for init, *rest in entries}
+
+def open_store(store_path=DEFAULT_STORE):
+    """Lazily open an extracted store with its steps in order (the ingest daemon appends them as they arrive)."""
+    ds = xr.open_zarr(store_path)
+    if "step" in ds.dims and not ds.indexes["step"].is_monotonic_increasing:
+        ds = ds.sortby("step")
+    return ds
+
+def save_ingest_manifest(store_path, ingested):
+    """Atomically write the ingested manifest entries next to the store."""
+    manifest_path = f"{store_path}.manifest.json"
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(sorted((init.isoformat(), *rest) for init, *rest in ingested), f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+def reset_store(store_path):
+    """Remove a Zarr store (or forecast archive) and its ingest manifest."""
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    if os.path.exists(f"{store_path}.manifest.json"):
+        os.remove(f"{store_path}.manifest.json")
+
+def _selection_attrs(variables, bbox):
+    """Store attributes recording which variables and region were extracted."""
+    return {
+        "extracted_variables": ",".join(variables) if variables else "all",
+        "extracted_bbox": ";".join(",".join(str(value) for value in box) for box in _boxes(bbox)) if bbox else "global",
+    }
+
+def _stored_selection(store_path):
+    """Selection attributes recorded in an extracted store."""
+    return {name: xr.open_zarr(store_path).attrs.get(name) for name in _selection_attrs(None, None)}
+
+def _selection_matches(store_path, variables, bbox):
+    """Whether a store was extracted with the same variables and region, warning if not."""
+    stored_selection = _stored_selection(store_path)
+    if stored_selection != _selection_attrs(variables, bbox):
+        logging.warning(f"{store_path} was extracted with {stored_selection}, rebuilding it for the new selection.")
+        return False
+    return True
+
+def resume_ingest(store_path, variables=None, bbox=None):
+    """Manifest entries already written to the single-run store.
+
+    When the store was extracted with other ``variables`` or ``bbox``, or
+    its contents are unknown, it is removed (it only ever holds what is in
+    ./Data) and an empty set is returned.
+    """
+    ingested = load_ingest_manifest(store_path)
+
+    if ingested and not _selection_matches(store_path, variables, bbox):
+        ingested = set()
+
+    if not ingested:
+        reset_store(store_path)  # No manifest, so the contents of the store are unknown
+    return ingested
+
+def _archived_entries(archive):
+    """Manifest entries of every step held by the stores of a forecast archive."""
+    entries = set()
+    for init_datetime, members in forecast_archive.list_cycles(archive).items():
+        for member, path in members.items():
+            try:
+                steps = np.atleast_1d(xr.open_zarr(path)["step"].values)
+            except Exception as e:
+                logging.warning(f"Could not read the steps of {path}, leaving it out of the manifest: {e}")
+                continue
+            entries.update((init_datetime, int(step // np.timedelta64(1, "h")), member) for step in steps)
+    return entries
+
+def resume_archive(archive, variables=None, bbox=None):
+    """Manifest entries already written to a forecast archive, None when it holds another selection.
+
+    Archived cycles may no longer be in ./Data, so nothing is ever deleted
+    here: an archive extracted with other ``variables`` or ``bbox`` is
+    refused, and a lost manifest is rebuilt from the steps in its stores.
+    """
+    stored = [path for members in forecast_archive.list_cycles(archive).values() for path in members.values()]
+    if not stored:
+        return set()
+
+    stored_selection = _stored_selection(stored[0])
+    if stored_selection != _selection_attrs(variables, bbox):
+        logging.error(f"{archive} holds cycles extracted with {stored_selection}, not {_selection_attrs(variables, bbox)}. "
+                      f"Extract with the same selection, or move {archive} away to start a new archive.")
+        return None
+
+    ingested = load_ingest_manifest(archive)
+    if not ingested:
+        logging.warning(f"No ingest manifest found for {archive}, rebuilding it from the archived stores.")
+        ingested = _archived_entries(archive)
+        save_ingest_manifest(archive, ingested)
+    return ingested
+
+def write_step(ds, store_path, chunks=None, variables=None, bbox=None):
+    """Append one decoded file to a Zarr store as a ``step`` slab, creating the store if needed."""
+    ds_step = _as_step_slab(ds)
+    ds_step.attrs.update(_selection_attrs(variables, bbox))
+
+    if os.path.exists(store_path):
+        ds_step.to_zarr(store_path, append_dim="step")
+    else:
+        # The first slab fixes the chunk layout, later appends fill whole step chunks
+        ds_step.to_zarr(store_path, mode="w", encoding=_zarr_encoding(ds_step, {**DEFAULT_CHUNKS, **(chunks or {})}))
+
+def _stream_to_zarr(targets, manifest_path, ingested, max_workers, index_cache_dir, chunks, variables=None, bbox=None):
+    """Decode files and write each one as its own step slab of its Zarr store.
+
+    ``targets`` lists (file path, store path, manifest entry) in write
+    order. Every entry is added to ``ingested`` and saved to the manifest of
+    ``manifest_path`` right after its write. Returns the number of steps
+    written.
+    """
+    destinations = {file_path: (store_path, entry) for file_path, store_path, entry in targets}
+    written = 0
+
+    file_list = [file_path for file_path, _, _ in targets]
+    for file_path, ds in _map_files(load_grib_file, file_list, max_workers, index_cache_dir, variables, bbox):
+        if ds is None:
+            continue
+
+        store_path, entry = destinations[file_path]
+        with profile_stage("zarr_write", level=logging.DEBUG, file=os.path.basename(file_path)):
+            write_step(ds, store_path, chunks, variables, bbox)
+        written += 1
+
+        # Recorded after every write, so an interrupted run resumes where it stopped
+        ingested.add(entry)
+        save_ingest_manifest(manifest_path, ingested)
+
+        del ds  # Only about one step per worker is ever held in memory
+        logging.info(f"Wrote {file_path} to {store_path}")
+
+    shared_cache(index_cache_dir).evict()
+    return written
+
+def _latest_cycle_targets(cycles, store_path, ingested):
+    """Write targets of the newest cycle's steps missing from the single-run store."""
+    latest, member = _latest_cycle(cycles)
+    return [(file_path, store_path, (latest, step))
+            for step, file_path in cycles[latest][member] if (latest, step) not in ingested]
+
+def _extract_to_archive(cycles, archive, ingested, keep_days, *stream_args):
+    """Write every cycle and member not yet archived, then prune cycles older than ``keep_days``.
+
+    Returns the number of steps written.
+    """
+    newest = max([*cycles, *(entry[0] for entry in ingested)])
+    cutoff = newest - datetime.timedelta(days=keep_days)
+
+    targets = [
+        (file_path, forecast_archive.cycle_store(archive, init_datetime, member), (init_datetime, step, member))
+        for init_datetime, members in sorted(cycles.items()) if init_datetime >= cutoff
+        for member, files in sorted(members.items())
+        for step, file_path in files if (init_datetime, step, member) not in ingested
+    ]
+    if targets:
+        logging.info(f"Archiving {len(targets)} new steps of {len({target[1] for target in targets})} cycle members.")
+    written = _stream_to_zarr(targets, archive, ingested, *stream_args) if targets else 0
+
+    removed = set(forecast_archive.prune_archive(archive, keep_days))
+    if removed:
+        ingested -= {entry for entry in ingested if entry[0] in removed}
+        save_ingest_manifest(archive, ingested)
+
+    return written
+
+def _publish_latest_cycle(archive, ingested, store_path, variables=None, bbox=None):
+    """Bring the single-run store used by the exports up to the newest archived cycle's primary member.
+
+    Only the steps archived since the last publish are appended to it, the
+    whole member is copied when a newer cycle (or another selection)
+    replaces what the store holds.
+    """
+    cycles = forecast_archive.list_cycles(archive)
+    if not cycles:
+        return False
+
+    latest = max(cycles)
+    member = forecast_archive.primary_member(cycles[latest])
+    archived = {(init, step) for init, step, m in ingested if init == latest and m == member}
+    published = load_ingest_manifest(store_path) if os.path.exists(store_path) else set()
+
+    if published and {init for init, _ in published} == {latest} and published <= archived \
+            and _selection_matches(store_path, variables, bbox):
+        source = xr.open_zarr(cycles[latest][member])
+        for init, step in sorted(archived - published):
+            write_step(source.sel(step=np.timedelta64(step, "h")), store_path, variables=variables, bbox=bbox)
+            published.add((init, step))
+            save_ingest_manifest(store_path, published)
+    else:
+        reset_store(store_path)
+        shutil.copytree(cycles[latest][member], store_path)
+        save_ingest_manifest(store_path, archived)
+
+    logging.info(f"Cycle {latest:%Y-%m-%d %Hz} ({member}) is the current forecast in {store_path}")
+    return True
+
+@profile_stage("extract_incremental")
+def append_new_grib_files(store_path=DEFAULT_STORE, max_workers=1, index_cache_dir=None, chunks=None,
+                          variables=None, bbox=None, regions=None, archive=None,
+                          keep_days=forecast_archive.ARCHIVE_DAYS):
+    """Decode only GRIB2 files not yet in the store and append them along ``step``.
+
+    Which (init time, step) pairs are already stored is tracked in a manifest
+    next to the Zarr store, so each run costs O(new files). A store extracted
+    with other ``variables`` or region is rebuilt from scratch, and so is
+    one holding an older cycle than the newest one in ./Data.
+
+    With an ``archive`` (see forecast_archive) every new cycle and member is
+    appended to its own archive store instead, and the newest cycle's new
+    steps are then appended to ``store_path``. An archive extracted with another selection
+    is left alone and None is returned.
+    """
+    logging.info("Starting incremental GRIB2 ingest...")
+
+    bbox = resolve_bbox(bbox, regions)
+    cycles = plan_cycles(sorted(glob.glob("./Data/*.grib2")), index_cache_dir)
+    stream_args = (max_workers, index_cache_dir, chunks, variables, bbox)
+
+    if archive:
+        ingested = resume_archive(archive, variables, bbox)
+        if ingested is None:
+            return None
+
+        if not cycles:
+            logging.info("No GRIB2 files found in ./Data/.")
+        elif _extract_to_archive(cycles, archive, ingested, keep_days, *stream_args) or not os.path.exists(store_path):
+            _publish_latest_cycle(archive, ingested, store_path, variables, bbox)
+
+        return xr.open_zarr(store_path) if os.path.exists(store_path) else None
+
+    ingested = resume_ingest(store_path, variables, bbox)
+
+    if ingested and cycles and {entry[0] for entry in ingested} != {max(cycles)}:
+        logging.info(f"New cycle {max(cycles):%Y-%m-%d %Hz} found, replacing the previous one in {store_path}.")
+        ingested = set()
+        reset_store(store_path)
+
+    targets = _latest_cycle_targets(cycles, store_path, ingested) if cycles else []
+
+    if not targets:
+        logging.info(f"No new forecast steps found, {store_path} is up to date.")
+        return xr.open_zarr(store_path) if ingested else None
+
+    logging.info(f"Found {len(targets)} new forecast steps to ingest.")
+    _stream_to_zarr(targets, store_path, ingested, *stream_args)
+
+    if not os.path.exists(store_path):
+        logging.error("No forecast steps could be ingested. Exiting...")
+        return None
+
+    return xr.open_zarr(store_path)
+
+@profile_stage("extract")
+def process_grib_files(max_workers=1, index_cache_dir=None, store_path=DEFAULT_STORE, chunks=None,
+                       variables=None, bbox=None, regions=None, archive=None,
+                       keep_days=forecast_archive.ARCHIVE_DAYS):
+    """Process GRIB2 files and extract data.
+
+    Every file is decoded and streamed straight into the chunked Zarr store
+    at ``store_path`` as one ``step`` slab (chunk sizes from ``chunks``,
+    default DEFAULT_CHUNKS), so no temporary NetCDF files are written and
+    peak memory stays around one step per worker.
+
+    Files are grouped by cycle (init time) and ensemble member from their
+    names, ``store_path`` only receives the newest cycle (its control member
+    for ensembles) so cycles never get interleaved along ``step``. With an
+    ``archive`` directory every cycle and member of the last ``keep_days``
+    days is written to its own store there (see forecast_archive.open_cycles
+    for the (member, init_time, step) hypercube) and the newest cycle is
+    copied into ``store_path``. Only the archived cycle members found in
+    ./Data are rebuilt, the others are kept.
+
+    With ``max_workers`` > 1 (or None for one worker per CPU) the files are
+    decoded in a process pool. Results are always written in sorted step
+    order, so the ``step`` order does not depend on which worker finishes
+    first. cfgrib indexes are kept in ``index_cache_dir`` (see
+    grib_index_cache) so reruns skip indexing files they have already seen.
+
+    ``variables`` is an allow-list of cfgrib variable names, other messages
+    are never decoded. ``bbox`` (lat_min, lat_max, lon_min, lon_max) and the
+    named ``regions`` (see REGIONS) crop every file to the grid rows and
+    columns inside any of them before anything is merged or written.
+    """
+    logging.info("Starting GRIB2 file processing...")
+
+    bbox = resolve_bbox(bbox, regions)
+    if variables or bbox:
+        logging.info(f"Extracting variables {variables or 'all'} within {bbox or 'the whole globe'}")
+
+    # List all GRIB2 files
+    file_list = sorted(glob.glob("./Data/*.grib2"))
+
+    if not file_list:
+        logging.error("No GRIB2 files found in ./Data/. Exiting...")
+        return None
+
+    cycles = plan_cycles(file_list, index_cache_dir)
+    if not cycles:
+        logging.error("No GRIB2 files could be placed into cycles and steps. Exiting...")
         return None
 
-    output_path = "Outputs/final_dataset.nc"
-    ds_combined.to_netcdf(output_path)
+    stream_args = (max_workers, index_cache_dir, chunks, variables, bbox)
+
+    if archive:
+        ingested = resume_archive(archive, variables, bbox)
+        if ingested is None:
+            return None
+
+        # Full rebuild of the cycle members in ./Data, older archived cycles are kept
+        for init_datetime, members in cycles.items():
+            for member in members:
+                reset_store(forecast_archive.cycle_store(archive, init_datetime, member))
+        ingested -= {entry for entry in ingested if entry[2] in cycles.get(entry[0], {})}
+        save_ingest_manifest(archive, ingested)
+
+        reset_store(store_path)
+        written = _extract_to_archive(cycles, archive, ingested, keep_days, *stream_args)
+        if written:
+            _publish_latest_cycle(archive, ingested, store_path, variables, bbox)
+    else:
+        # Full rebuild, start from an empty store
+        reset_store(store_path)
+        ingested = set()
+        written = _stream_to_zarr(_latest_cycle_targets(cycles, store_path, ingested), store_path, ingested, *stream_args)
+
+    if not written:
+        logging.error("No GRIB2 files could be decoded. Exiting...")
+        return None
 
-    logging.info(f"Final dataset saved as {output_path}")
+    logging.info(f"Final dataset saved as {store_path}")
 
-    return ds_combined
+    return xr.open_zarr(store_path)
@@ -0,0 +1,149 @@
+import os
+import logging
+import functools
+from collections import OrderedDict
+
+import xarray as xr
+
+from logging_config import logging  # Import custom logging setup
+import data_cleaning
+
+# Memory budget for derived arrays held by each process
+DEFAULT_MAX_BYTES = int(os.environ.get("GRIB2_DATASET_CACHE_MB", "1024")) * 1024 * 1024
+
+def _open(path):
+    """Open the cleaned NetCDF or a Zarr store lazily."""
+    if os.path.isdir(path) or path.endswith(".zarr"):
+        return xr.open_zarr(path)
+    return xr.open_dataset(path, chunks={})
+
+# Metadata files of a Zarr store (v2 and v3) and of each of its arrays
+ZARR_METADATA = (".zmetadata", ".zattrs", ".zarray", "zarr.json")
+
+def _source_key(path):
+    """(absolute path, mtime) of a file or Zarr store, a rewritten source gets a new key."""
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        # A Zarr store's directory mtime doesn't change when chunks are rewritten or appended,
+        # the metadata of the root and of every resized array (and the ingest manifest) does
+        folders = [path] + [entry.path for entry in os.scandir(path) if entry.is_dir()]
+        metadata = [os.path.join(folder, name) for folder in folders for name in ZARR_METADATA]
+        metadata.append(f"{path}.manifest.json")
+        return path, max([os.stat(path).st_mtime_ns] + [os.stat(name).st_mtime_ns for name in metadata if os.path.exists(name)])
+    return path, os.stat(path).st_mtime_ns
+
+class DatasetCache:
+    """Per-process memo of opened datasets and the arrays derived from them.
+
+    Datasets are opened lazily once per (path, mtime). Derived arrays (e.g.
+    Celsius t2m on wrapped longitudes) are computed once per source and
+    derivation and kept in least-recently-used order until they exceed
+    ``max_bytes``. Datasets not opened through the cache are never memoized,
+    their derivations are simply computed.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._datasets = {}  # absolute path -> (source key, dataset)
+        self._sources = {}  # id(dataset) -> source key, for datasets handed out by open()
+        self._derived = OrderedDict()  # (source key, name) -> (value, nbytes)
+        self._bytes = 0
+
+    def open(self, path):
+        """Lazily opened dataset at ``path``, reopened if the file changed since."""
+        key = _source_key(path)
+        cached = self._datasets.get(key[0])
+        if cached and cached[0] == key:
+            return cached[1]
+
+        if cached:
+            self.invalidate(key[0])
+
+        ds = _open(path)
+        self._datasets[key[0]] = (key, ds)
+        self._sources[id(ds)] = key
+        logging.info(f"Opened {path} through the dataset cache")
+        return ds
+
+    def invalidate(self, path):
+        """Drop a source and everything derived from it."""
+        key, ds = self._datasets.pop(os.path.abspath(path), (None, None))
+        if ds is None:
+            return
+
+        self._sources.pop(id(ds), None)
+        for derived_key in [derived_key for derived_key in self._derived if derived_key[0] == key]:
+            self._bytes -= self._derived.pop(derived_key)[1]
+        ds.close()
+
+    def cached(self, ds, name):
+        """The memoized ``name`` derived from ``ds``, None if it isn't cached."""
+        entry = self._derived.get((self._sources.get(id(ds)), name))
+        if entry is None:
+            return None
+        self._derived.move_to_end((self._sources[id(ds)], name))
+        return entry[0]
+
+    def derive(self, ds, name, func):
+        """``func(ds)``, memoized per source and ``name`` when ``ds`` came from open()."""
+        source = self._sources.get(id(ds))
+        if source is None:
+            return func(ds)
+
+        key = (source, name)
+        if key in self._derived:
+            self._derived.move_to_end(key)
+            return self._derived[key][0]
+
+        value = func(ds)
+        nbytes = value.nbytes if hasattr(value, "nbytes") else 0
+        if nbytes > self.max_bytes:
+            logging.warning(f"'{name}' needs {nbytes / 2**20:.0f} MB, more than the dataset cache budget, not caching it")
+            return value
+
+        self._derived[key] = (value, nbytes)
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            (_, evicted_name), (_, evicted_bytes) = self._derived.popitem(last=False)
+            self._bytes -= evicted_bytes
+            logging.info(f"Evicted '{evicted_name}' from the dataset cache")
+
+        return value
+
+    def clear(self):
+        for path in list(self._datasets):
+            self.invalidate(path)
+
+# Shared by every stage running in this process
+cache = DatasetCache()
+
+def open_dataset(path):
+    """Open ``path`` (NetCDF or Zarr) through the process-wide cache."""
+    return cache.open(path)
+
+def _wrapped(ds):
+    return data_cleaning.wrap_longitude(ds)
+
+def _t2m_celsius(ds, step=None):
+    t2m = wrapped(ds)["t2m"]
+    if step is not None:
+        t2m = t2m.isel(step=step)
+    return (t2m.transpose(..., "latitude", "longitude") - 273.15).load()
+
+def wrapped(ds):
+    """The dataset on [-180, 180] longitudes, still lazy."""
+    return cache.derive(ds, "wrapped", _wrapped)
+
+def t2m_celsius(ds, step=None):
+    """2m temperature in °C on [-180, 180] longitudes, loaded into memory.
+
+    Every step by default, only the step at index ``step`` otherwise (sliced
+    from the every-step array when that one is cached already).
+    """
+    if step is None or "step" not in ds["t2m"].dims:
+        return cache.derive(ds, "t2m_celsius", _t2m_celsius)
+
+    every_step = cache.cached(ds, "t2m_celsius")
+    if every_step is not None:
+        return every_step.isel(step=step)
+    return cache.derive(ds, f"t2m_celsius[step={step}]", functools.partial(_t2m_celsius, step=step))
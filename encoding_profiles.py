@@ -0,0 +1,136 @@
+import os
+import logging
+
+import numpy as np
+import xarray as xr
+
+from logging_config import logging  # Import custom logging setup
+
+# int16 packing of temperatures in K: stored = round((value - add_offset) / scale_factor).
+# Values are kept to +/-0.005 K between -54.5 K and 600.8 K (0 K, the cleaning fill value, included)
+TEMPERATURE_PACKING = {"dtype": "int16", "scale_factor": np.float32(0.01), "add_offset": np.float32(273.15),
+                       "_FillValue": np.int16(-32768)}
+
+# Soil moisture (m3/m3) keeps 8 of the 23 float32 mantissa bits, a relative error of at most 2^-9
+# (0.001 m3/m3 at 0.5), and the zeroed bits compress away
+SOIL_MOISTURE_KEEPBITS = 8
+
+# Raw and cleaned (see data_cleaning) names of the soil moisture layers
+SOIL_MOISTURE = ("swvl1", "swvl2", "swvl3", "sw-5", "sw-15", "sw-50")
+
+# Encoding profiles by name:
+#   packing   variable -> xarray packing encoding (lossy, within the precision documented above)
+#   keepbits  variable -> float32 mantissa bits kept by bit-rounding (lossy)
+#   chunks    dimension -> chunk size on disk (-1 = the whole dimension)
+#   netcdf    compression of NetCDF files, zlib so they open without HDF5 filter plugins
+#   zarr      Blosc compressor (cname, clevel) of Zarr stores, always with byte shuffle
+PROFILES = {
+    # Smallest files, for long-term storage and copies to blob storage
+    "archive": {
+        "packing": {"t2m": TEMPERATURE_PACKING, "stl1": TEMPERATURE_PACKING},
+        "keepbits": {name: SOIL_MOISTURE_KEEPBITS for name in SOIL_MOISTURE},
+        "chunks": {"step": 24, "latitude": 180, "longitude": 360},
+        "netcdf": {"zlib": True, "complevel": 6, "shuffle": True},
+        "zarr": ("zstd", 7),
+    },
+    # One whole field per chunk and light compression, for readers that load one step at a time
+    "fast-read": {
+        "chunks": {"step": 1, "latitude": -1, "longitude": -1},
+        "netcdf": {"zlib": True, "complevel": 1, "shuffle": True},
+        "zarr": ("lz4", 1),
+    },
+    # Bit-for-bit values, tiled like the extraction store
+    "lossless": {
+        "chunks": {"step": 1, "latitude": 360, "longitude": 360},
+        "netcdf": {"zlib": True, "complevel": 4, "shuffle": True},
+        "zarr": ("zstd", 3),
+    },
+}
+
+DEFAULT_PROFILE = os.environ.get("GRIB2_ENCODING_PROFILE", "lossless")
+
+def get_profile(name):
+    """Settings of a named profile, None (xarray's defaults) for no profile."""
+    if name is None:
+        return None
+    if name not in PROFILES:
+        raise ValueError(f"Unknown encoding profile '{name}', choose from {list(PROFILES)}")
+    return PROFILES[name]
+
+def bitround(values, keepbits):
+    """Round float32 values to ``keepbits`` mantissa bits (to nearest, ties to even), zeroing the others."""
+    values = np.asarray(values, dtype=np.float32)
+    drop = 23 - keepbits
+    if drop <= 0:
+        return values
+
+    bits = values.view(np.uint32)
+    half = np.uint32((1 << (drop - 1)) - 1)
+    rounded = (bits + half + ((bits >> np.uint32(drop)) & np.uint32(1))) & ~np.uint32((1 << drop) - 1)
+    # NaN and infinities are left alone, their mantissa bits carry no value
+    return np.where(np.isfinite(values), rounded.view(np.float32), values)
+
+def prepare(ds, profile):
+    """Lazily apply a profile's bit-rounding, chunk by chunk."""
+    settings = get_profile(profile)
+    if not settings:
+        return ds
+
+    rounded = {}
+    for name, keepbits in settings.get("keepbits", {}).items():
+        if name in ds.data_vars and np.issubdtype(ds[name].dtype, np.floating):
+            rounded[name] = xr.apply_ufunc(bitround, ds[name], kwargs={"keepbits": keepbits},
+                                           dask="parallelized", output_dtypes=[np.float32])
+            rounded[name].attrs = {**ds[name].attrs, "bitround_keepbits": keepbits}
+    return ds.assign(rounded)
+
+def _chunk_shape(var, chunks):
+    return tuple(size if chunks.get(dim, -1) == -1 else min(chunks[dim], size) for dim, size in zip(var.dims, var.shape))
+
+def _zarr_compressor(cname, clevel):
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        return {"compressors": (BloscCodec(cname=cname, clevel=clevel, shuffle="shuffle"),)}
+
+    from numcodecs import Blosc
+    return {"compressor": Blosc(cname=cname, clevel=clevel, shuffle=Blosc.SHUFFLE)}
+
+def encoding(ds, profile, engine="netcdf"):
+    """Per-variable ``encoding`` for ``to_netcdf`` (engine "netcdf") or ``to_zarr`` (engine "zarr")."""
+    settings = get_profile(profile)
+    if not settings:
+        return {}
+
+    result = {}
+    for name, var in ds.variables.items():
+        # Non-index coordinates along step (valid_time) are chunked like the data,
+        # otherwise opening with chunks={} gives inconsistent chunks along step
+        if var.ndim == 0 or name in ds.dims:
+            continue
+        var_encoding = dict(settings.get("packing", {}).get(name, {})) if name in ds.data_vars else {}
+        if engine == "zarr":
+            var_encoding["chunks"] = _chunk_shape(var, settings["chunks"])
+            var_encoding.update(_zarr_compressor(*settings["zarr"]))
+        else:
+            var_encoding["chunksizes"] = _chunk_shape(var, settings["chunks"])
+            var_encoding.update(settings["netcdf"])
+        result[name] = var_encoding
+    return result
+
+def to_netcdf(ds, output_path, profile=DEFAULT_PROFILE):
+    """Write a dataset as NetCDF with an encoding profile."""
+    prepare(ds, profile).to_netcdf(output_path, encoding=encoding(ds, profile))
+    if profile:
+        logging.debug(f"{output_path} written with the '{profile}' encoding profile")
+
+def to_zarr(ds, output_path, profile=DEFAULT_PROFILE, **kwargs):
+    """Write a dataset as a Zarr store with an encoding profile, rechunked to the profile's chunks."""
+    settings = get_profile(profile)
+    if settings:
+        # Every dask chunk must cover whole Zarr chunks
+        ds = ds.chunk({dim: settings["chunks"].get(dim, -1) for dim in ds.dims})
+    prepare(ds, profile).to_zarr(output_path, encoding=encoding(ds, profile, engine="zarr"), **kwargs)
+    if profile:
+        logging.debug(f"{output_path} written with the '{profile}' encoding profile")
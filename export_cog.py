@@ -0,0 +1,137 @@
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from logging_config import logging, pool_initializer  # Import custom logging setup
+from profiling import profile_stage
+import dataset_cache
+import data_cleaning
+
+DEFAULT_OUTPUT_DIR = "Outputs/cog"
+
+# Internal tile size, also the number of rows read from the dataset per window
+BLOCK_SIZE = 512
+
+COMPRESSION = os.environ.get("COG_COMPRESSION", "ZSTD")
+OVERVIEW_RESAMPLING = "AVERAGE"
+
+# Variable attributes kept as band tags (the GRIB_* ones describe the unwrapped source grid)
+BAND_TAGS = ("long_name", "standard_name", "units")
+
+# Filled by _init_worker in every pool process (and once in-process without a pool)
+_source = {}
+
+def _init_worker(ds_or_path):
+    ds = dataset_cache.open_dataset(ds_or_path) if isinstance(ds_or_path, str) else ds_or_path
+    _source["ds"] = dataset_cache.wrapped(ds)
+
+def grid_transform(latitudes, longitudes):
+    """Affine transform of a regular north-up grid from its cell-centre coordinates (ValueError on gapped axes)."""
+    lon_step = data_cleaning.regular_step(longitudes, "longitude")
+    lat_step = abs(data_cleaning.regular_step(latitudes, "latitude"))
+    return from_origin(longitudes[0] - lon_step / 2, latitudes.max() + lat_step / 2, lon_step, lat_step)
+
+def write_cog(da, output_path, compression=COMPRESSION, num_threads="ALL_CPUS"):
+    """Stream a (latitude, longitude) field into a Cloud-optimized GeoTIFF.
+
+    The field is read ``BLOCK_SIZE`` rows at a time into a tiled scratch
+    GeoTIFF, which GDAL's COG driver then copies with compression and
+    averaged overviews (compressing tiles on ``num_threads`` threads), so
+    only one row of tiles is ever held in memory.
+    """
+    da = da.transpose("latitude", "longitude")
+    if da["latitude"].values[0] < da["latitude"].values[-1]:
+        da = da.isel(latitude=slice(None, None, -1))  # North-up rows
+
+    height, width = da.shape
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": 1, "dtype": "float32",
+        "crs": "EPSG:4326", "transform": grid_transform(da["latitude"].values, da["longitude"].values),
+        "nodata": np.nan, "tiled": True, "blockxsize": BLOCK_SIZE, "blockysize": BLOCK_SIZE,
+    }
+
+    scratch_path = f"{output_path}.tmp.tif"
+    try:
+        with rasterio.open(scratch_path, "w", **profile) as dst:
+            for row in range(0, height, BLOCK_SIZE):
+                block = np.asarray(da.isel(latitude=slice(row, row + BLOCK_SIZE)).values, dtype=np.float32)
+                dst.write(block, 1, window=Window(0, row, width, block.shape[0]))
+
+            dst.update_tags(1, **{key: str(da.attrs[key]) for key in BAND_TAGS if key in da.attrs})
+            if "valid_time" in da.coords:
+                dst.update_tags(valid_time=str(da["valid_time"].values))
+
+        rasterio.shutil.copy(
+            scratch_path, output_path, driver="COG", compress=compression, predictor="YES",
+            blocksize=BLOCK_SIZE, overview_resampling=OVERVIEW_RESAMPLING, bigtiff="IF_SAFER", num_threads=num_threads,
+        )
+    finally:
+        if os.path.exists(scratch_path):
+            os.remove(scratch_path)
+
+    return output_path
+
+def _write_task(task):
+    """Write one (variable, step) raster from the worker's dataset."""
+    variable, step_index, output_path, compression, num_threads = task
+    da = _source["ds"][variable]
+    if step_index is not None:
+        da = da.isel(step=step_index)
+    return write_cog(da, output_path, compression, num_threads)
+
+def _output_path(output_dir, variable, step_hours):
+    """``<output_dir>/<variable>/<variable>_<FFF>h.tif``, the step named like the GRIB2 inputs."""
+    name = variable if step_hours is None else f"{variable}_{step_hours:03d}h"
+    return os.path.join(output_dir, variable, f"{name}.tif")
+
+@profile_stage("cog")
+def export_cog(ds, output_dir=DEFAULT_OUTPUT_DIR, variables=None, compression=COMPRESSION, max_workers=None):
+    """Write every variable and step as a tiled, compressed COG with overviews.
+
+    Longitudes are wrapped to [-180, 180] first (through dataset_cache). Rasters
+    are written in parallel by ``max_workers`` processes (None = one per
+    CPU) when ``ds`` was opened from a file, which every worker reopens
+    lazily. Returns the written paths, or None on failure.
+    """
+    variables = variables or [name for name, var in ds.data_vars.items() if {"latitude", "longitude"} <= set(var.dims)]
+
+    tasks = []
+    for variable in variables:
+        os.makedirs(os.path.join(output_dir, variable), exist_ok=True)
+        if "step" in ds[variable].dims:
+            for step_index, step in enumerate(ds["step"].values):
+                step_hours = int(step / np.timedelta64(1, "h"))
+                tasks.append((variable, step_index, _output_path(output_dir, variable, step_hours), compression))
+        else:
+            tasks.append((variable, None, _output_path(output_dir, variable, None), compression))
+
+    source_path = ds.encoding.get("source")
+    in_process = max_workers == 1 or source_path is None or len(tasks) == 1
+
+    # Rasters in parallel in a pool, otherwise GDAL compresses each raster's tiles in parallel
+    num_threads = "ALL_CPUS" if in_process else 1
+    tasks = [task + (num_threads,) for task in tasks]
+
+    try:
+        if in_process:
+            _init_worker(ds)
+            output_paths = list(map(_write_task, tasks))
+        else:
+            # Spawned, each worker opens the file itself instead of inheriting its handles
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                     **pool_initializer(_init_worker, (source_path,))) as executor:
+                output_paths = list(executor.map(_write_task, tasks))
+    except Exception as e:
+        logging.error(f"Error saving COGs: {e}")
+        return None
+
+    logging.info(f"{len(output_paths)} Cloud-optimized GeoTIFFs saved in {output_dir}")
+    return output_paths
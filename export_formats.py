@@ -0,0 +1,46 @@
+import rioxarray  # Required for GeoTIFF conversion
+import logging
+
+from logging_config import logging  # Import custom logging setup
+from profiling import profile_stage
+import encoding_profiles
+import data_cleaning
+
+@profile_stage("geotiff")
+def export_geotiff(ds, output_path="Outputs/temperature_2m.tif"):
+    """Write 2m temperature as a GeoTIFF (returns the path, None on failure)."""
+    try:
+        # rioxarray georeferences from the first cells' spacing, wrong across a gap
+        data_cleaning.regular_step(ds["latitude"].values, "latitude")
+        data_cleaning.regular_step(ds["longitude"].values, "longitude")
+        ds["t2m"].rio.write_crs("EPSG:4326").rio.to_raster(output_path)
+    except Exception as e:
+        logging.error(f"Error saving GeoTIFF: {e}")
+        return None
+
+    logging.info(f"GeoTIFF file saved as {output_path}")
+    return output_path
+
+@profile_stage("csv")
+def export_csv(ds, output_path="Outputs/final_dataset.csv"):
+    """Write the dataset as one CSV row per grid point and step (returns the path, None on failure)."""
+    try:
+        ds.to_dataframe().to_csv(output_path)
+    except Exception as e:
+        logging.error(f"Error saving CSV: {e}")
+        return None
+
+    logging.info(f"CSV file saved as {output_path}")
+    return output_path
+
+@profile_stage("zarr")
+def export_zarr(ds, output_path="Outputs/final_cleaned_dataset.zarr", profile=encoding_profiles.DEFAULT_PROFILE):
+    """Write the dataset as a consolidated Zarr store with an encoding profile (returns the path, None on failure)."""
+    try:
+        encoding_profiles.to_zarr(ds, output_path, profile, mode="w", consolidated=True)
+    except Exception as e:
+        logging.error(f"Error saving Zarr: {e}")
+        return None
+
+    logging.info(f"Zarr file saved as {output_path}")
+    return output_path
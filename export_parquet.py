@@ -0,0 +1,115 @@
+import os
+import shutil
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from logging_config import logging  # Import custom logging setup
+from profiling import profile_stage
+import data_cleaning
+
+DEFAULT_OUTPUT_DIR = "Outputs/final_dataset.parquet"
+
+# Rows per record batch (and Parquet row group), bounds memory independently of the grid size
+BATCH_ROWS = 512 * 1024
+
+# Coordinates repeat across every row group, so they are dictionary encoded
+DICTIONARY_COLUMNS = ["latitude", "longitude", "init_time", "valid_time"]
+
+def _init_time(step_ds):
+    """Initialisation time of one step (the ``time`` coordinate, or valid time minus step)."""
+    if "time" in step_ds.coords:
+        return pd.Timestamp(step_ds["time"].values)
+    return pd.Timestamp(step_ds["valid_time"].values - step_ds["step"].values)
+
+def _partition_dir(output_dir, init_time, step_hours):
+    """Hive-style partition folder, readable as columns by DuckDB, Polars and pyarrow."""
+    return os.path.join(output_dir, f"init_date={init_time:%Y-%m-%d}", f"step={step_hours}")
+
+def _iter_batches(step_ds, variables, drop_fill, fill_value):
+    """Yield Arrow record batches of one step, reading ``BATCH_ROWS`` rows of the grid at a time."""
+    latitudes = step_ds["latitude"].values
+    longitudes = step_ds["longitude"].values
+    n_lon = len(longitudes)
+    lat_block = max(1, BATCH_ROWS // n_lon)
+
+    init_time = np.datetime64(_init_time(step_ds), "ns")
+    valid_time = np.datetime64(pd.Timestamp(step_ds["valid_time"].values), "ns")
+
+    for start in range(0, len(latitudes), lat_block):
+        block = step_ds[variables].isel(latitude=slice(start, start + lat_block)).transpose("latitude", "longitude")
+        block = block.compute()
+        n_rows = block.sizes["latitude"] * n_lon
+
+        columns = {
+            "latitude": np.repeat(latitudes[start:start + lat_block], n_lon),
+            "longitude": np.tile(longitudes, block.sizes["latitude"]),
+        }
+        for name in variables:
+            columns[name] = block[name].values.astype(np.float32, copy=False).ravel()
+
+        if drop_fill:
+            # Rows where every variable is missing or the cleaning fill value carry no data
+            values = np.stack([columns[name] for name in variables])
+            keep = ~np.all(np.isnan(values) | (values == fill_value), axis=0)
+            columns = {name: column[keep] for name, column in columns.items()}
+            n_rows = int(keep.sum())
+            if not n_rows:
+                continue
+
+        columns["init_time"] = np.full(n_rows, init_time)
+        columns["valid_time"] = np.full(n_rows, valid_time)
+        yield pa.RecordBatch.from_pydict(columns)
+
+@profile_stage("parquet")
+def export_parquet(ds, output_dir=DEFAULT_OUTPUT_DIR, variables=None, drop_fill=False,
+                   fill_value=data_cleaning.FILL_VALUE, compression="zstd"):
+    """Stream the dataset into Parquet files partitioned by init date and step.
+
+    Every step is converted ``BATCH_ROWS`` grid points at a time into Arrow
+    record batches and appended to ``<output_dir>/init_date=YYYY-MM-DD/
+    step=H/<HH>z.parquet``, so memory stays constant whatever the grid size.
+    Coordinates are dictionary encoded and everything is ``compression``
+    compressed. With ``drop_fill`` rows where every variable is NaN or
+    ``fill_value`` are left out. Returns the output directory, or None on
+    failure.
+    """
+    variables = variables or [name for name, var in ds.data_vars.items() if {"latitude", "longitude"} <= set(var.dims)]
+
+    try:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+
+        if "step" not in ds.dims:
+            ds = ds.expand_dims("step")
+
+        rows = 0
+        for index in range(ds.sizes["step"]):
+            step_ds = ds.isel(step=index)
+            init_time = _init_time(step_ds)
+            step_hours = int(step_ds["step"].values / np.timedelta64(1, "h"))
+
+            partition = _partition_dir(output_dir, init_time, step_hours)
+            os.makedirs(partition, exist_ok=True)
+            file_path = os.path.join(partition, f"{init_time:%H}z.parquet")
+
+            writer = None
+            try:
+                for batch in _iter_batches(step_ds, variables, drop_fill, fill_value):
+                    if writer is None:
+                        writer = pq.ParquetWriter(file_path, batch.schema, compression=compression,
+                                                  use_dictionary=DICTIONARY_COLUMNS)
+                    writer.write_batch(batch, row_group_size=BATCH_ROWS)
+                    rows += batch.num_rows
+            finally:
+                if writer is not None:
+                    writer.close()
+    except Exception as e:
+        logging.error(f"Error saving Parquet: {e}")
+        return None
+
+    logging.info(f"Parquet dataset saved in {output_dir} ({rows} rows, {ds.sizes['step']} steps)")
+    return output_dir
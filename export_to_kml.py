@@ -1,54 +1,129 @@
-import xarray as xr
 import numpy as np
 import os
 import logging
 
 from logging_config import logging  # Import logging setup
-
-logging.info("Exporting temperature data to Google Earth KML format...")
-
-# Load dataset
-ds = xr.open_dataset("./Outputs/final_dataset.nc")
-
-t2m_celsius = ds["t2m"].isel(step=0) - 273.15
-ds = ds.assign_coords(longitude=((ds.longitude + 180) % 360) - 180)
-
-# Define KML file path
-output_folder = "./Outputs/"
-os.makedirs(output_folder, exist_ok=True)
-kml_filename = os.path.join(output_folder, "temperature_data.kml")
+import data_cleaning
+import kml_tiles
+import dataset_cache
+from profiling import profile_stage
 
 color_palette = ["#0000FF", "#00FFFF", "#00FF00", "#FFFF00", "#FF7F00", "#FF0000"]
 temp_min, temp_max = -30, 50
 
+# Export every n-th latitude/longitude (1 = full resolution)
+STRIDE = int(os.environ.get("KML_STRIDE", "5"))
+
 def get_color(temp):
     norm_temp = np.clip((temp - temp_min) / (temp_max - temp_min), 0, 1)
     index = int(norm_temp * (len(color_palette) - 1))
     return color_palette[index]
 
-# Create KML structure
-kml_header = """<?xml version="1.0" encoding="UTF-8"?>
+def get_color_indices(temps):
+    """Vectorized get_color: the palette index of every temperature in one array operation."""
+    norm_temps = np.clip((temps - temp_min) / (temp_max - temp_min), 0, 1)
+    return (norm_temps * (len(color_palette) - 1)).astype(np.int8)
+
+def kml_color(hex_color):
+    """Convert #RRGGBB to KML's opaque aabbggrr."""
+    return f"ff{hex_color[5:7]}{hex_color[3:5]}{hex_color[1:3]}".lower()
+
+def iter_kml(latitudes, longitudes, temps):
+    """Yield the KML document piece by piece, one Placemark per grid point."""
+    yield """<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
 <Document>
 """
+    # One shared style per palette colour instead of a Style block per Placemark
+    for index, color in enumerate(color_palette):
+        yield f"""<Style id="t{index}"><IconStyle><color>{kml_color(color)}</color><scale>0.6</scale>
+  <Icon><href>http://maps.google.com/mapfiles/kml/shapes/shaded_dot.png</href></Icon></IconStyle></Style>
+"""
+
+    lon_grid, lat_grid = np.meshgrid(longitudes, latitudes)
+    valid = np.isfinite(temps)
+    lats, lons, temps = lat_grid[valid], lon_grid[valid], temps[valid]
+    color_indices = get_color_indices(temps)
 
-kml_body = ""
-for lat in ds.latitude.values[::5]:  
-    for lon in ds.longitude.values[::5]:
-        temp_value = t2m_celsius.sel(latitude=lat, longitude=lon, method="nearest").values
-        color = get_color(temp_value)
-        kml_body += f"""
-<Placemark>
-  <name>{temp_value:.1f}°C</name>
-  <Point><coordinates>{lon},{lat},0</coordinates></Point>
-</Placemark>
+    for lat, lon, temp, index in zip(lats.tolist(), lons.tolist(), temps.tolist(), color_indices.tolist()):
+        yield f"""<Placemark><name>{temp:.1f}°C</name><styleUrl>#t{index}</styleUrl><Point><coordinates>{lon:.4f},{lat:.4f},0</coordinates></Point></Placemark>
 """
 
-kml_footer = """</Document></kml>"""
+    yield """</Document></kml>"""
+
+def write_kml(t2m_celsius, kml_filename, stride=STRIDE):
+    """Slice the grid once with NumPy strides and stream the Placemarks to a KML file."""
+    t2m_sliced = t2m_celsius.isel(latitude=slice(None, None, stride), longitude=slice(None, None, stride))
+    t2m_sliced = t2m_sliced.transpose("latitude", "longitude")
+
+    latitudes = t2m_sliced.latitude.values
+    longitudes = ((t2m_sliced.longitude.values + 180) % 360) - 180
+    temps = np.asarray(t2m_sliced.values, dtype=np.float32)
+
+    with open(kml_filename, "w", encoding="utf-8", buffering=1 << 20) as file:
+        file.writelines(iter_kml(latitudes, longitudes, temps))
+
+    return temps.size
+
+def write_kmz(t2m_celsius, kmz_filename, max_workers=None):
+    """Write the full-resolution field as a tiled, level-of-detail KMZ pyramid."""
+    t2m_wrapped = data_cleaning.wrap_longitude(t2m_celsius.to_dataset(name="t2m"))["t2m"]
+    t2m_wrapped = t2m_wrapped.transpose("latitude", "longitude")
+
+    # Translucent cells so the basemap stays visible under the tiles
+    colors = ["99" + kml_color(color)[2:] for color in color_palette]
+
+    return kml_tiles.write_kmz_pyramid(
+        t2m_wrapped.values, t2m_wrapped.latitude.values, t2m_wrapped.longitude.values,
+        kmz_filename, colors, temp_min, temp_max, max_workers=max_workers
+    )
+
+@profile_stage("kml")
+def export_kml(ds=None, output_folder="./Outputs/", stride=STRIDE, tiled=True, max_workers=None):
+    """Export the first step's 2m temperature as a flat KML and a tiled KMZ pyramid.
+
+    ``ds`` can be an in-memory or lazily opened dataset, by default the
+    extracted Zarr store is opened. Returns the written file paths, or None
+    on failure.
+    """
+    logging.info("Exporting temperature data to Google Earth KML format...")
+
+    if ds is None:
+        # Load dataset
+        try:
+            ds = dataset_cache.open_dataset("./Outputs/final_dataset.zarr")
+        except Exception as e:
+            logging.error(f"Error loading dataset: {e}")
+            return None
+
+    if "t2m" not in ds:
+        logging.error("The dataset does not contain the variable 't2m'. Cannot export KML.")
+        return None
+
+    t2m_celsius = dataset_cache.t2m_celsius(ds, step=0)
+
+    # Define KML file path
+    os.makedirs(output_folder, exist_ok=True)
+    kml_filename = os.path.join(output_folder, "temperature_data.kml")
+
+    # Save the KML file
+    with profile_stage("kml_write", level=logging.DEBUG, file=kml_filename) as stats:
+        stats["points"] = points = write_kml(t2m_celsius, kml_filename, stride)
+    logging.info(f"KML file saved at {kml_filename} ({points} points, stride {stride})")
+    output_paths = [kml_filename]
+
+    # Tiled pyramid, Google Earth only loads the tiles in view
+    if tiled:
+        kmz_filename = os.path.join(output_folder, "temperature_tiles.kmz")
+        try:
+            with profile_stage("kmz_write", level=logging.DEBUG, file=kmz_filename):
+                write_kmz(t2m_celsius, kmz_filename, max_workers)
+        except ValueError as e:
+            logging.error(f"Error saving KMZ: {e}")
+            return None
+        output_paths.append(kmz_filename)
 
-# Save the KML file
-with open(kml_filename, "w") as file:
-    file.write(kml_header + kml_body + kml_footer)
+    return output_paths
 
-logging.info(f"KML file saved at {kml_filename}")
-print(f"KML file saved: {kml_filename}")
+if __name__ == "__main__":
+    export_kml()
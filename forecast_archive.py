@@ -0,0 +1,170 @@
+import os
+import glob
+import shutil
+import datetime
+import argparse
+import logging
+
+import numpy as np
+import xarray as xr
+
+from logging_config import logging  # Import custom logging setup
+
+# One Zarr store per cycle and member: <archive>/<YYYYMMDDHH>/<member>.zarr
+DEFAULT_ARCHIVE = "Outputs/forecast_archive"
+CYCLE_FORMAT = "%Y%m%d%H"
+
+# Rolling window of cycles kept, counted back from the newest archived cycle
+ARCHIVE_DAYS = 10
+
+# Member name of single (non-ensemble) runs
+DETERMINISTIC_MEMBER = "det"
+
+def cycle_store(archive, init_datetime, member=DETERMINISTIC_MEMBER):
+    """Path of the Zarr store holding one member of one cycle."""
+    return os.path.join(archive, init_datetime.strftime(CYCLE_FORMAT), f"{member}.zarr")
+
+def list_cycles(archive=DEFAULT_ARCHIVE):
+    """Return {init datetime: {member: store path}} of every archived cycle, oldest first."""
+    cycles = {}
+    for path in glob.glob(os.path.join(archive, "*", "*.zarr")):
+        try:
+            init_datetime = datetime.datetime.strptime(os.path.basename(os.path.dirname(path)), CYCLE_FORMAT)
+        except ValueError:
+            continue
+        cycles.setdefault(init_datetime, {})[os.path.basename(path)[:-len(".zarr")]] = path
+
+    return {init_datetime: dict(sorted(members.items())) for init_datetime, members in sorted(cycles.items())}
+
+def primary_member(members):
+    """Member fed to the single-run exports: the deterministic run, else the control (e.g. c00), else the first."""
+    if DETERMINISTIC_MEMBER in members:
+        return DETERMINISTIC_MEMBER
+    controls = sorted(member for member in members if member.startswith("c"))
+    return controls[0] if controls else sorted(members)[0]
+
+def _open_member(path, member, ensemble):
+    """Lazily open one cycle store, with a ``member`` dimension for ensembles."""
+    ds = xr.open_zarr(path).drop_vars("time", errors="ignore")  # The init time becomes the init_time dimension
+    if "step" in ds.dims and not ds.indexes["step"].is_monotonic_increasing:
+        ds = ds.sortby("step")  # Steps appended out of order by incremental runs
+
+    if "number" in ds.dims:
+        return ds.rename(number="member")  # Every member came in the same file
+    ds = ds.drop_vars("number", errors="ignore")
+    return ds.expand_dims(member=[member]) if ensemble else ds
+
+def open_cycles(archive=DEFAULT_ARCHIVE, init_times=None, members=None):
+    """Open archived cycles as one lazy (init_time, step) hypercube.
+
+    Ensembles get a leading ``member`` dimension: (member, init_time, step,
+    ...). Only metadata is read, every cycle stays its own chunk along
+    ``init_time`` and is loaded when its values are used. ``init_times`` and
+    ``members`` narrow down which stores are opened. Cycles with different
+    steps are aligned on the union of their steps (NaN where missing), and
+    ``valid_time`` becomes an (init_time, step) coordinate. Returns None when
+    nothing matches.
+    """
+    cycles = list_cycles(archive)
+    if init_times is not None:
+        wanted = {np.datetime64(value, "ns") for value in init_times}
+        cycles = {init: stores for init, stores in cycles.items() if np.datetime64(init, "ns") in wanted}
+    if members is not None:
+        cycles = {init: {m: path for m, path in stores.items() if m in members} for init, stores in cycles.items()}
+        cycles = {init: stores for init, stores in cycles.items() if stores}
+
+    if not cycles:
+        logging.error(f"No archived cycles found in {archive}")
+        return None
+
+    ensemble = any(member != DETERMINISTIC_MEMBER for stores in cycles.values() for member in stores)
+
+    datasets = []
+    for init_datetime, stores in cycles.items():
+        parts = [_open_member(path, member, ensemble) for member, path in stores.items()]
+        ds = xr.concat(parts, dim="member", join="outer", coords="minimal", compat="override") if ensemble else parts[0]
+        ds = ds.expand_dims(init_time=[np.datetime64(init_datetime, "ns")])
+        datasets.append(ds.assign_coords(valid_time=ds["valid_time"].expand_dims(init_time=ds["init_time"])))
+
+    # Variables or coordinates missing from a cycle are filled with NaN
+    hypercube = xr.concat(datasets, dim="init_time", join="outer", coords="minimal", compat="override")
+    if ensemble:
+        hypercube = hypercube.transpose("member", "init_time", ...)
+
+    logging.info(f"Opened {len(cycles)} cycles from {archive}: {dict(hypercube.sizes)}")
+    return hypercube
+
+def run_to_run_delta(ds, variables=None, init_time=None, previous_init_time=None):
+    """Change between two cycles' forecasts of the same valid times.
+
+    Defaults to the newest cycle of the ``open_cycles`` hypercube minus the
+    one before it. The previous cycle's step ``s + (init_time -
+    previous_init_time)`` is compared with the newer cycle's step ``s``, so
+    the result is indexed by the newer cycle's steps and only covers valid
+    times both cycles forecast. Stays lazy, only the two cycles are read.
+    """
+    init_times = ds["init_time"].values
+    if len(init_times) < 2 and previous_init_time is None:
+        raise ValueError("A run-to-run delta needs at least two cycles")
+
+    current = ds.sel(init_time=np.datetime64(init_time, "ns") if init_time is not None else init_times[-1])
+    previous = ds.sel(init_time=np.datetime64(previous_init_time, "ns") if previous_init_time is not None else init_times[-2])
+    variables = variables or [name for name in ds.data_vars if "step" in ds[name].dims]
+
+    # Shift the previous cycle onto the newer cycle's lead times
+    offset = current["init_time"].values - previous["init_time"].values
+    previous = previous.assign_coords(step=previous["step"].values - offset)
+
+    delta = current[variables].drop_vars("init_time") - previous[variables].drop_vars("init_time")
+    delta = delta.assign_coords(valid_time=current["valid_time"].sel(step=delta["step"]).drop_vars("init_time"))
+    delta.attrs.update({
+        "init_time": str(current["init_time"].values),
+        "previous_init_time": str(previous["init_time"].values),
+    })
+    return delta
+
+def prune_archive(archive=DEFAULT_ARCHIVE, keep_days=ARCHIVE_DAYS):
+    """Remove cycles more than ``keep_days`` older than the newest archived one.
+
+    The window is counted from the newest cycle rather than the clock, so
+    replaying old data keeps its most recent cycles. Returns the removed
+    init datetimes.
+    """
+    cycles = list_cycles(archive)
+    if not cycles:
+        return []
+
+    cutoff = max(cycles) - datetime.timedelta(days=keep_days)
+    removed = [init_datetime for init_datetime in cycles if init_datetime < cutoff]
+    for init_datetime in removed:
+        shutil.rmtree(os.path.join(archive, init_datetime.strftime(CYCLE_FORMAT)))
+
+    if removed:
+        logging.info(f"Pruned {len(removed)} cycles older than {cutoff:%Y-%m-%d %Hz} from {archive}")
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(description="Run-to-run change between the two newest archived cycles.")
+    parser.add_argument("--archive", default=DEFAULT_ARCHIVE, help="Forecast archive written by main.py --archive.")
+    parser.add_argument("--variables", type=lambda value: value.split(","), default=None,
+                        help="Comma-separated variables to compare (default: all).")
+    parser.add_argument("--members", type=lambda value: value.split(","), default=None,
+                        help="Comma-separated ensemble members to compare (default: all).")
+    parser.add_argument("--output", default="Outputs/run_to_run_delta.nc", help="NetCDF output file.")
+    args = parser.parse_args()
+
+    ds = open_cycles(args.archive, members=args.members)
+    if ds is None:
+        return
+
+    try:
+        delta = run_to_run_delta(ds, args.variables)
+        delta.to_netcdf(args.output)
+    except Exception as e:
+        logging.error(f"Error computing the run-to-run delta: {e}")
+        return
+
+    logging.info(f"Run-to-run delta {delta.attrs['init_time']} - {delta.attrs['previous_init_time']} saved as {args.output}")
+
+if __name__ == "__main__":
+    main()
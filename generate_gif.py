@@ -1,70 +1,229 @@
+import os
 import numpy as np
-import xarray as xr
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
 
-from logging_config import logging  # Import custom logging setup
+from logging_config import logging, pool_initializer  # Import custom logging setup
+import dataset_cache
+from profiling import profile_stage
+
+# Extra formats written next to the GIF, e.g. ANIMATION_FORMATS=gif,apng,mp4
+OUTPUT_FORMATS = os.environ.get("ANIMATION_FORMATS", "gif").split(",")
+EXTENSIONS = {"gif": ".gif", "apng": ".png", "mp4": ".mp4"}
+FRAME_WORKERS = int(os.environ.get("ANIMATION_WORKERS", "1"))
+FRAME_INTERVAL_MS = 500
+
+# Filled by _init_frame_worker in every pool process (and once in-process without a pool)
+_basemap = {}
+
+def render_basemap(latitudes, longitudes, vmin, vmax, cmap, figsize=(12, 6), dpi=100):
+    """Rasterise the static figure once.
+
+    Returns the background (land and colorbar), a transparent overlay with
+    coastlines and borders, and for every pixel of the map axes the grid row
+    and column it shows.
+    """
+    fig, ax = plt.subplots(figsize=figsize, dpi=dpi, subplot_kw={"projection": ccrs.PlateCarree()})
+    lon_step, lat_step = abs(longitudes[1] - longitudes[0]), abs(latitudes[1] - latitudes[0])
+    extent = [max(longitudes.min() - lon_step / 2, -180), min(longitudes.max() + lon_step / 2, 180),
+              max(latitudes.min() - lat_step / 2, -90), min(latitudes.max() + lat_step / 2, 90)]
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    land = ax.add_feature(cfeature.LAND, facecolor="lightgray")
+
+    # Add colorbar
+    mappable = plt.cm.ScalarMappable(norm=plt.Normalize(vmin, vmax), cmap=cmap)
+    cbar = plt.colorbar(mappable, ax=ax, orientation="horizontal", pad=0.05)
+    cbar.set_label("2m Temperature (°C)", fontsize=12)
+
+    fig.canvas.draw()
+    background = np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+    # Second pass with only the line work, on a transparent canvas
+    land.remove()
+    cbar.ax.set_visible(False)
+    fig.patch.set_alpha(0)
+    ax.patch.set_alpha(0)
+    ax.spines["geo"].set_visible(False)
+    ax.add_feature(cfeature.COASTLINE, linewidth=0.5)
+    ax.add_feature(cfeature.BORDERS, linestyle=":")
+    fig.canvas.draw()
+    overlay = np.asarray(fig.canvas.buffer_rgba()).copy()
+
+    # Axes box in array coordinates (matplotlib's origin is bottom-left)
+    x0, y0, x1, y1 = np.round(ax.get_window_extent().extents).astype(int)
+    height = background.shape[0]
+    box = (height - y1, height - y0, x0, x1)
+    plt.close(fig)
+
+    # Nearest grid cell of every pixel centre inside the axes box
+    pixel_lons = extent[0] + (np.arange(x1 - x0) + 0.5) / (x1 - x0) * (extent[1] - extent[0])
+    pixel_lats = extent[3] - (np.arange(y1 - y0) + 0.5) / (y1 - y0) * (extent[3] - extent[2])
+    col_index = np.abs(pixel_lons[:, None] - longitudes[None, :]).argmin(axis=1)
+    row_index = np.abs(pixel_lats[:, None] - latitudes[None, :]).argmin(axis=1)
+
+    return background, overlay, box, row_index, col_index
+
+def _init_frame_worker(background, overlay, box, row_index, col_index, lut, palette):
+    _basemap.update(
+        background=background, overlay=overlay, box=box,
+        row_index=row_index, col_index=col_index, lut=lut, palette=palette,
+    )
+
+def _compose_frame(color_indices, title, mode):
+    """Composite one step's LUT indices onto the cached basemap and encode it as a PIL image."""
+    top, bottom, left, right = _basemap["box"]
+    frame = _basemap["background"].copy()
+
+    # Index 255 marks missing values, the land background shows through there
+    pixels = color_indices[np.ix_(_basemap["row_index"], _basemap["col_index"])]
+    frame_box = frame[top:bottom, left:right]
+    np.copyto(frame_box, _basemap["lut"][pixels], where=(pixels != 255)[..., None])
+
+    # Line work on top, alpha-blended
+    overlay = _basemap["overlay"]
+    alpha = overlay[..., 3:4].astype(np.float32) / 255
+    frame = (frame * (1 - alpha) + overlay[..., :3] * alpha).astype(np.uint8)
+
+    image = Image.fromarray(frame)
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.load_default(size=14)
+    except TypeError:
+        font = ImageFont.load_default()
+    draw.text(((left + right) // 2, top - 8), title, fill="black", font=font, anchor="md")
+
+    if mode == "P":
+        # Shared palette for every frame, no per-frame quantisation flicker
+        return image.quantize(palette=_basemap["palette"], dither=Image.Dither.NONE)
+    return image
+
+def _compose_task(args):
+    return _compose_frame(*args)
+
+def color_lut(cmap):
+    """256-colour RGB lookup table of a colormap, index 255 is reserved for missing values."""
+    return (cmap(np.linspace(0, 1, 255))[:, :3] * 255).astype(np.uint8)
+
+def to_color_indices(temperature, vmin, vmax):
+    """Map every step to LUT indices in one vectorized operation (255 = missing)."""
+    scaled = (temperature - vmin) / (vmax - vmin) * 254
+    indices = np.clip(np.nan_to_num(scaled, nan=0.0), 0, 254).astype(np.uint8)
+    indices[~np.isfinite(temperature)] = 255
+    return indices
+
+def frame_basemap(temperature, latitudes, longitudes, cmap=None):
+    """Basemap, colour LUT and palette shared by every frame, and by every output format, of an animation."""
+    cmap = cmap or plt.get_cmap("coolwarm")
+    vmin, vmax = float(np.nanmin(temperature)), float(np.nanmax(temperature))
+
+    background, overlay, box, row_index, col_index = render_basemap(latitudes, longitudes, vmin, vmax, cmap)
+    lut = color_lut(cmap)
+
+    # One palette for the whole animation: the colormap plus the basemap colours
+    palette_source = np.concatenate([lut[None], background[::8, ::8].reshape(1, -1, 3)], axis=1)
+    palette = Image.fromarray(palette_source).quantize(colors=256, dither=Image.Dither.NONE)
+
+    return background, overlay, box, row_index, col_index, lut, palette
+
+def render_frames(temperature, latitudes, longitudes, titles, mode="P", cmap=None, max_workers=FRAME_WORKERS,
+                  basemap=None):
+    """Yield one PIL image per step from a preloaded (step, latitude, longitude) array.
+
+    ``basemap`` (from frame_basemap) is drawn here when not given.
+    """
+    initargs = basemap or frame_basemap(temperature, latitudes, longitudes, cmap)
+    indices = to_color_indices(temperature, float(np.nanmin(temperature)), float(np.nanmax(temperature)))
+    tasks = ((indices[step], titles[step], mode) for step in range(len(indices)))
+
+    if max_workers == 1:
+        _init_frame_worker(*initargs)
+        yield from map(_compose_task, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, **pool_initializer(_init_frame_worker, initargs)) as executor:
+            yield from executor.map(_compose_task, tasks)
+
+def save_animation(frames, output_path, interval_ms=FRAME_INTERVAL_MS):
+    """Encode frames as GIF, APNG (.png/.apng) or MP4, picked from the file extension."""
+    extension = os.path.splitext(output_path)[1].lower()
+
+    if extension == ".mp4":
+        import imageio.v2 as imageio  # Optional, only needed for MP4 (with imageio-ffmpeg)
+
+        with imageio.get_writer(output_path, fps=1000 / interval_ms, macro_block_size=16) as writer:
+            for frame in frames:
+                writer.append_data(np.asarray(frame.convert("RGB")))
+        return
+
+    frames = iter(frames)
+    first = next(frames)
+    if extension == ".gif":
+        first.save(output_path, format="GIF", save_all=True, append_images=frames, duration=interval_ms, loop=0)
+    else:
+        # Pillow's APNG writer reads append_images twice, an iterator would be used up by the first pass
+        first.save(output_path, format="PNG", save_all=True, append_images=list(frames), duration=interval_ms, loop=0)
+
+@profile_stage("gif")
+def create_temperature_gif(ds=None, output_stem="Outputs/temperature_forecast", formats=OUTPUT_FORMATS,
+                           max_workers=FRAME_WORKERS):
+    """Animate 2m temperature over every forecast step.
+
+    ``ds`` can be an in-memory or lazily opened dataset, by default the
+    extracted Zarr store is opened. Returns the written file paths, or None
+    if the dataset can't be animated.
+    """
+    if ds is None:
+        # Load dataset with error handling
+        try:
+            ds = dataset_cache.open_dataset("Outputs/final_dataset.zarr")
+            logging.info("Successfully loaded Outputs/final_dataset.zarr")
+        except Exception as e:
+            logging.error(f"Error loading dataset: {e}")
+            return None
 
-# Load dataset with error handling
-try:
-    ds = xr.open_dataset("Outputs/final_dataset.nc")
-    logging.info("Successfully loaded Outputs/final_dataset.nc")
     logging.info(f"Available variables: {list(ds.data_vars.keys())}")
-except Exception as e:
-    logging.error(f"Error loading dataset: {e}")
-    exit()
-
-# Ensure 't2m' exists in dataset
-if "t2m" not in ds:
-    raise KeyError("The dataset does not contain the variable 't2m'. Check your NetCDF file.")
-
-# Ensure forecast steps exist
-if "step" not in ds.coords:
-    raise KeyError("The dataset does not contain the 'step' coordinate. Cannot animate time steps.")
-
-# Extract key information
-temperature = ds["t2m"] - 273.15  # Convert to Celsius
-steps = ds["step"].values  # Forecast steps
-valid_times = ds["valid_time"].values  # Time at each step
-
-logging.info(f"Forecast Steps: {steps}")
-logging.info(f"Valid Times: {valid_times}")
-
-# Create figure with Cartopy projection
-fig, ax = plt.subplots(figsize=(12, 6), subplot_kw={"projection": ccrs.PlateCarree()})
-ax.add_feature(cfeature.COASTLINE, linewidth=0.5)
-ax.add_feature(cfeature.BORDERS, linestyle=":")
-ax.add_feature(cfeature.LAND, facecolor="lightgray")
-
-# Define color map
-cmap = plt.get_cmap("coolwarm")
-t2m_min, t2m_max = temperature.min().values, temperature.max().values
-
-# Initialize first frame
-im = ax.pcolormesh(
-    ds.longitude, ds.latitude, temperature.isel(step=0),
-    cmap=cmap, vmin=t2m_min, vmax=t2m_max, transform=ccrs.PlateCarree()
-)
-
-# Add colorbar
-cbar = plt.colorbar(im, ax=ax, orientation="horizontal", pad=0.05)
-cbar.set_label("2m Temperature (°C)", fontsize=12)
-
-# Define animation update function
-def update(frame):
-    im.set_array(temperature.isel(step=frame).values.ravel())  # Update data
-    ax.set_title(f"2m Temperature Forecast for {valid_times[frame]}", fontsize=14)
-    return im,
-
-# Create animation
-ani = animation.FuncAnimation(fig, update, frames=len(steps), interval=500, blit=False)
-
-# Save animation as GIF
-gif_filename = "Outputs/temperature_forecast.gif"
-ani.save(gif_filename, dpi=100, writer="pillow")
-
-logging.info(f"GIF saved as '{gif_filename}'")
-plt.show()
+
+    # Ensure 't2m' exists in dataset
+    if "t2m" not in ds:
+        logging.error("The dataset does not contain the variable 't2m'. Cannot create the GIF.")
+        return None
+
+    # Ensure forecast steps exist
+    if "step" not in ds.dims:
+        logging.error("The dataset does not contain the 'step' dimension. Cannot animate time steps.")
+        return None
+
+    # Extract key information, every step in Celsius is read into memory once per process
+    t2m_celsius = dataset_cache.t2m_celsius(ds).transpose("step", "latitude", "longitude")
+    temperature = t2m_celsius.values
+    latitudes, longitudes = t2m_celsius["latitude"].values, t2m_celsius["longitude"].values
+    steps = ds["step"].values  # Forecast steps
+    valid_times = ds["valid_time"].values  # Time at each step
+
+    logging.info(f"Forecast Steps: {steps}")
+    logging.info(f"Valid Times: {valid_times}")
+
+    titles = [f"2m Temperature Forecast for {valid_time}" for valid_time in valid_times]
+
+    # The cartopy basemap is drawn once for every output format
+    basemap = frame_basemap(temperature, latitudes, longitudes)
+
+    output_paths = []
+    for output_format in formats:
+        extension = EXTENSIONS[output_format.strip().lower()]
+        output_path = f"{output_stem}{extension}"
+        mode = "P" if extension == ".gif" else "RGB"
+
+        frames = render_frames(temperature, latitudes, longitudes, titles, mode=mode, max_workers=max_workers,
+                               basemap=basemap)
+        save_animation(frames, output_path)
+        logging.info(f"Animation saved as '{output_path}'")
+        output_paths.append(output_path)
+
+    return output_paths
+
+if __name__ == "__main__":
+    create_temperature_gif()
@@ -0,0 +1,100 @@
+import glob
+import hashlib
+import json
+import os
+import logging
+
+from logging_config import logging  # Import custom logging setup
+
+# Kept outside ./Data so downloads and cfgrib index files never mix
+DEFAULT_CACHE_DIR = os.environ.get(
+    "GRIB2_INDEX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "grib2_index")
+)
+DEFAULT_MAX_BYTES = int(os.environ.get("GRIB2_INDEX_CACHE_MB", "512")) * 1024 * 1024
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+class GribIndexCache:
+    """Directory of cfgrib index files keyed by path, size, mtime and content hash.
+
+    An entry's mtime doubles as its last-used time, so eviction drops the
+    least recently used indexes until the directory fits in ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = os.path.abspath(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        self._hashes = {}  # (path, size, mtime) -> content hash, so a file is hashed once per process
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def file_key(self, file_path):
+        """Return the (path, size, mtime, content hash) key of a GRIB2 file."""
+        stat = os.stat(file_path)
+        stat_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+        if stat_key not in self._hashes:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                    digest.update(block)
+            self._hashes[stat_key] = digest.hexdigest()
+
+        return stat_key + (self._hashes[stat_key],)
+
+    def indexpath(self, file_path):
+        """Return the cached index path template for a GRIB2 file, marking its indexes as recently used.
+
+        cfgrib fills ``{short_hash}`` with a hash of the index keys, so a
+        ``filter_by_keys`` on extra keys gets its own index instead of
+        discarding the unfiltered one.
+        """
+        entry = hashlib.blake2b(json.dumps(self.file_key(file_path)).encode(), digest_size=16).hexdigest()
+
+        for index_path in glob.glob(os.path.join(self.cache_dir, f"{entry}.*.idx")):
+            try:
+                os.utime(index_path)
+            except OSError:
+                pass  # Evicted by another process in the meantime, cfgrib will rebuild it
+
+        return os.path.join(self.cache_dir, f"{entry}.{{short_hash}}.idx")
+
+    def backend_kwargs(self, file_path, **kwargs):
+        """cfgrib backend_kwargs that read and write the index through the cache."""
+        return {"indexpath": self.indexpath(file_path), **kwargs}
+
+    def evict(self):
+        """Delete least recently used index files until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".idx"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        if removed:
+            logging.info(f"Evicted {removed} GRIB index files from {self.cache_dir}")
+
+# One cache per directory and process, so its hash memo outlives a single file
+_shared = {}
+
+def shared_cache(cache_dir=None):
+    """Return this process's GribIndexCache for ``cache_dir``, created on first use."""
+    cache_dir = os.path.abspath(cache_dir or DEFAULT_CACHE_DIR)
+    if cache_dir not in _shared:
+        _shared[cache_dir] = GribIndexCache(cache_dir)
+    return _shared[cache_dir]
@@ -0,0 +1,311 @@
+import os
+import sys
+import glob
+import time
+import signal
+import asyncio
+import argparse
+import datetime
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from logging_config import logging, pool_initializer  # Import custom logging setup
+from profiling import profile_stage
+from grib_index_cache import shared_cache
+import data_extraction
+import forecast_archive
+
+POLL_INTERVAL = float(os.environ.get("GRIB2_POLL_INTERVAL", "1.0"))
+
+# Completed files waiting for a decode worker, the watcher stops scanning while it is full
+QUEUE_SIZE = 16
+
+# Tries of a file whose decode worker died, each in a fresh pool, before it is skipped until it changes
+DECODE_ATTEMPTS = 2
+
+# Every GRIB2 message ends with this marker, a file still being written usually doesn't
+END_MARKER = b"7777"
+
+def is_complete(file_path):
+    """Whether a GRIB2 file ends with the end marker of a whole message."""
+    try:
+        with open(file_path, "rb") as f:
+            f.seek(-len(END_MARKER), os.SEEK_END)
+            return f.read() == END_MARKER
+    except OSError:
+        return False
+
+class IngestDaemon:
+    """Long-running ingest of GRIB2 files as they land in a folder.
+
+    A polling watcher queues a file once its size and mtime are unchanged
+    between two polls and it ends with a complete GRIB2 message. Decode
+    tasks hand the queued files to a process pool, and a single writer
+    appends every decoded step to the Zarr store (and, with ``archive``, to
+    its cycle's archive store) and records it in the manifest as soon as it
+    is written. Both queues are bounded, so a slow writer throttles decoding
+    and a backlog throttles the watcher. Files of an older cycle than the
+    one in the single-run store are only archived, a newer cycle replaces it.
+    """
+
+    def __init__(self, data_dir="./Data", store_path=data_extraction.DEFAULT_STORE, archive=None,
+                 keep_days=forecast_archive.ARCHIVE_DAYS, max_workers=None, queue_size=QUEUE_SIZE,
+                 poll_interval=POLL_INTERVAL, index_cache_dir=None, chunks=None, variables=None, bbox=None):
+        self.data_dir = data_dir
+        self.store_path = store_path
+        self.archive = archive
+        self.keep_days = keep_days
+        self.max_workers = max_workers or os.cpu_count()
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.index_cache_dir = index_cache_dir
+        self.chunks = chunks
+        self.variables = variables
+        self.bbox = bbox
+
+        self.archived = set()
+        if archive:
+            self.archived = data_extraction.resume_archive(archive, variables, bbox)
+            if self.archived is None:
+                raise ValueError(f"{archive} was extracted with another selection")
+        self.ingested = data_extraction.resume_ingest(store_path, variables, bbox)
+
+        self.stopping = asyncio.Event()
+        self._executor = None  # Decode pool, replaced when a worker dies
+        self._sizes = {}  # file path -> (size, mtime) at the last poll
+        self._handled = {}  # file path -> (size, mtime) of the version queued, written or skipped
+        self._arrived = {}  # file path -> when it was first seen, for the arrival-to-published latency
+
+    def _current_cycle(self):
+        return max((entry[0] for entry in self.ingested), default=None)
+
+    def _pending_entries(self, file_path):
+        """Manifest entries a file still has to be written to, as (store path, manifest, entry)."""
+        parsed = data_extraction.parse_grib_filename(file_path)
+        if parsed is None:
+            return []
+
+        init_datetime, step = parsed
+        member = data_extraction.parse_member(file_path)
+        pending = []
+
+        if self.archive and (init_datetime, step, member) not in self.archived:
+            newest = max([init_datetime, *(entry[0] for entry in self.archived)])
+            if init_datetime >= newest - datetime.timedelta(days=self.keep_days):
+                store = forecast_archive.cycle_store(self.archive, init_datetime, member)
+                pending.append((store, self.archive, (init_datetime, step, member)))
+
+        # The single-run store only follows the deterministic or control run of the newest cycle
+        primary = member == forecast_archive.DETERMINISTIC_MEMBER or member.startswith("c")
+        current = self._current_cycle()
+        if primary and (current is None or init_datetime >= current) and (init_datetime, step) not in self.ingested:
+            pending.append((self.store_path, self.store_path, (init_datetime, step)))
+
+        return pending
+
+    def _poll(self):
+        """Return files that are complete and not yet ingested (or changed since they were)."""
+        ready = []
+        sizes = {}
+        for file_path in sorted(glob.glob(os.path.join(self.data_dir, "*.grib2"))):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue  # Removed between the glob and the stat
+            sizes[file_path] = (stat.st_size, stat.st_mtime_ns)
+            self._arrived.setdefault(file_path, time.monotonic())
+
+            # Still growing, or unchanged since it was handled
+            if self._sizes.get(file_path) != sizes[file_path] or self._handled.get(file_path) == sizes[file_path]:
+                continue
+            if not stat.st_size or not is_complete(file_path):
+                continue
+
+            self._handled[file_path] = sizes[file_path]
+            if data_extraction.parse_grib_filename(file_path) is None:
+                logging.warning(f"Skipping file due to unexpected format: {file_path}")
+            elif self._pending_entries(file_path):
+                ready.append(file_path)
+
+        self._sizes = sizes
+        return ready
+
+    async def watch(self, files):
+        """Poll the folder and queue complete files until shutdown."""
+        while not self.stopping.is_set():
+            for file_path in self._poll():
+                await files.put(file_path)  # Blocks while the decoders are behind
+                if self.stopping.is_set():
+                    break
+
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _new_pool(self):
+        # Spawned, the workers don't inherit the writer's open stores and locks
+        context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context, **pool_initializer())
+
+    def _restart_pool(self, broken):
+        """Replace a pool whose worker died, unless another decode task already did."""
+        if self._executor is broken:
+            logging.warning("A decode worker died, restarting the process pool.")
+            self._executor = self._new_pool()
+            broken.shutdown(wait=False)
+
+    async def decode(self, files, decoded):
+        """Decode queued files in the process pool and pass them on to the writer.
+
+        Never raises, so a failing file or a dead worker can't stop the
+        decoding, or leave the watcher and the shutdown waiting on a full queue.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            file_path = await files.get()
+            if file_path is None:
+                return
+
+            ds = None
+            for _ in range(DECODE_ATTEMPTS):
+                executor = self._executor
+                try:
+                    ds = await loop.run_in_executor(executor, data_extraction.load_grib_file, file_path,
+                                                    self.index_cache_dir, self.variables, self.bbox)
+                    break
+                except BrokenProcessPool as e:
+                    logging.error(f"Decode worker died while decoding {file_path}: {e}")
+                    self._restart_pool(executor)
+                except Exception as e:
+                    logging.error(f"Error decoding {file_path}: {e}")
+                    break
+
+            if ds is None:
+                continue  # Retried once the file changes
+            await decoded.put((file_path, ds))  # Blocks while the writer is behind
+
+    def _write(self, file_path, ds):
+        """Write one decoded file to every store it belongs to and record it in their manifests.
+
+        Runs in a thread, so the manifest sets are replaced rather than
+        mutated while the watcher may be reading them.
+        """
+        for store_path, manifest, entry in self._pending_entries(file_path):
+            if manifest == self.store_path and entry[0] != self._current_cycle() and self.ingested:
+                logging.info(f"New cycle {entry[0]:%Y-%m-%d %Hz} arrived, replacing the previous one in {store_path}.")
+                data_extraction.reset_store(store_path)
+                self.ingested = set()
+
+            with profile_stage("zarr_write", level=logging.DEBUG, file=os.path.basename(file_path)):
+                data_extraction.write_step(ds, store_path, self.chunks, self.variables, self.bbox)
+
+            if manifest == self.archive:
+                self.archived = self.archived | {entry}
+                data_extraction.save_ingest_manifest(manifest, self.archived)
+            else:
+                self.ingested = self.ingested | {entry}
+                data_extraction.save_ingest_manifest(manifest, self.ingested)
+
+        if self.archive:
+            removed = set(forecast_archive.prune_archive(self.archive, self.keep_days))
+            if removed:
+                self.archived = {entry for entry in self.archived if entry[0] not in removed}
+                data_extraction.save_ingest_manifest(self.archive, self.archived)
+
+    async def write(self, decoded):
+        """Single writer, so appends to a store never race."""
+        while True:
+            item = await decoded.get()
+            if item is None:
+                return
+
+            file_path, ds = item
+            try:
+                # Off the event loop, so polling and decoding go on during the write
+                await asyncio.to_thread(self._write, file_path, ds)
+            except Exception as e:
+                logging.error(f"Error writing {file_path}: {e}")
+                continue
+
+            latency = time.monotonic() - self._arrived.pop(file_path, time.monotonic())
+            logging.info(f"Published {os.path.basename(file_path)} {latency:.1f}s after it arrived")
+
+    def stop(self):
+        if not self.stopping.is_set():
+            logging.info("Shutting down, finishing the files already queued...")
+            self.stopping.set()
+
+    async def run(self):
+        """Ingest until SIGINT or SIGTERM, then drain the queues and exit."""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        files = asyncio.Queue(maxsize=self.queue_size)
+        decoded = asyncio.Queue(maxsize=self.max_workers)
+
+        logging.info(f"Watching {self.data_dir} every {self.poll_interval}s with {self.max_workers} decode workers")
+
+        self._executor = self._new_pool()
+        try:
+            decoders = [asyncio.create_task(self.decode(files, decoded)) for _ in range(self.max_workers)]
+            writer = asyncio.create_task(self.write(decoded))
+
+            await self.watch(files)
+
+            for _ in decoders:
+                await files.put(None)
+            await asyncio.gather(*decoders)
+            await decoded.put(None)
+            await writer
+        finally:
+            self._executor.shutdown()
+
+        shared_cache(self.index_cache_dir).evict()
+        logging.info("Ingest daemon stopped.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest GRIB2 files into the Zarr store as they arrive.")
+    parser.add_argument("--data-dir", default="./Data", help="Folder the GRIB2 files are downloaded into.")
+    parser.add_argument("--workers", type=int, default=0, help="Number of decode processes (0 = one per CPU).")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="Seconds between folder scans.")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="Completed files waiting for a decode worker.")
+    parser.add_argument("--index-cache", default=None, help="Directory for cached cfgrib index files.")
+    parser.add_argument("--archive", action="store_true",
+                        help=f"Also keep every cycle and ensemble member in {forecast_archive.DEFAULT_ARCHIVE}.")
+    parser.add_argument("--archive-days", type=int, default=forecast_archive.ARCHIVE_DAYS,
+                        help="Days of cycles kept in the forecast archive, counted back from the newest cycle.")
+    parser.add_argument("--variables", type=lambda value: value.split(","), default=None,
+                        help=f"Comma-separated variables to extract ({', '.join(data_extraction.VARIABLES)}, default: all).")
+    parser.add_argument("--bbox", type=lambda value: [float(part) for part in value.split(",")], default=None,
+                        metavar="LAT_MIN,LAT_MAX,LON_MIN,LON_MAX", help="Only extract grid points inside this box.")
+    parser.add_argument("--regions", type=lambda value: value.split(","), default=None,
+                        help=f"Comma-separated named regions to extract ({', '.join(data_extraction.REGIONS)}).")
+    args = parser.parse_args()
+
+    if args.bbox is not None and len(args.bbox) != 4:
+        parser.error("--bbox needs four values: LAT_MIN,LAT_MAX,LON_MIN,LON_MAX")
+    unknown_regions = set(args.regions or []) - set(data_extraction.REGIONS)
+    if unknown_regions:
+        parser.error(f"Unknown regions {sorted(unknown_regions)}, choose from {list(data_extraction.REGIONS)}")
+    unknown_variables = set(args.variables or []) - set(data_extraction.VARIABLES)
+    if unknown_variables:
+        parser.error(f"Unknown variables {sorted(unknown_variables)}, choose from {data_extraction.VARIABLES}")
+
+    try:
+        daemon = IngestDaemon(
+            data_dir=args.data_dir, archive=forecast_archive.DEFAULT_ARCHIVE if args.archive else None,
+            keep_days=args.archive_days, max_workers=args.workers or None, queue_size=args.queue_size,
+            poll_interval=args.poll_interval, index_cache_dir=args.index_cache, variables=args.variables,
+            bbox=data_extraction.resolve_bbox(args.bbox, args.regions),
+        )
+    except ValueError as e:
+        logging.error(f"Ingest daemon not started: {e}")
+        sys.exit(1)
+    asyncio.run(daemon.run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+import zipfile
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from logging_config import logging, pool_initializer  # Import logging setup
+
+# Cells per tile side, every tile holds at most TILE_SIZE x TILE_SIZE Placemarks
+TILE_SIZE = 32
+
+# A tile is drawn once its region covers MIN_LOD_PIXELS on screen, parents
+# hide again past MAX_LOD_PIXELS when their children have taken over
+MIN_LOD_PIXELS = 128
+MAX_LOD_PIXELS = 1024
+
+# Filled by _init_worker in every pool process (and once in-process without a pool)
+_grid = {}
+
+def _cell_edges(centers, limit=None):
+    """Cell boundaries halfway between the centers, extended by half a cell at both ends.
+
+    The centers must be evenly spaced (ValueError otherwise), the cells
+    next to a gap would stretch across it.
+    """
+    half = np.diff(centers) / 2
+    if not np.allclose(half, half[0]):
+        raise ValueError("The grid is not evenly spaced, export each region separately")
+    edges = np.concatenate([[centers[0] - half[0]], centers[:-1] + half, [centers[-1] + half[-1]]])
+    return np.clip(edges, -limit, limit) if limit else edges
+
+def _init_worker(values, lat_edges, lon_edges, colors, vmin, vmax, tile_size):
+    _grid.update(
+        values=values, lat_edges=lat_edges, lon_edges=lon_edges,
+        colors=colors, vmin=vmin, vmax=vmax, tile_size=tile_size,
+    )
+
+def _tile_name(tile):
+    level, row0, _, col0, _ = tile
+    return f"{level}_{row0}_{col0}.kml"
+
+def _children(tile):
+    """The up to four quadtree children of a tile (none once it is at native resolution)."""
+    level, row0, row1, col0, col1 = tile
+    tile_size = _grid["tile_size"]
+    if row1 - row0 <= tile_size and col1 - col0 <= tile_size:
+        return []
+
+    row_mid, col_mid = (row0 + row1) // 2, (col0 + col1) // 2
+    return [
+        (level + 1, r0, r1, c0, c1)
+        for r0, r1 in ((row0, row_mid), (row_mid, row1))
+        for c0, c1 in ((col0, col_mid), (col_mid, col1))
+        if r1 > r0 and c1 > c0
+    ]
+
+def _block_edges(start, stop, parts):
+    """Start indices splitting [start, stop) into ``parts`` nearly equal blocks."""
+    return np.linspace(start, stop, min(parts, stop - start) + 1).astype(int)
+
+def _aggregate(row0, row1, col0, col1):
+    """NaN-aware block mean of a tile down to at most tile_size x tile_size cells."""
+    tile_size = _grid["tile_size"]
+    block = _grid["values"][row0:row1, col0:col1]
+    rows = _block_edges(0, row1 - row0, tile_size)
+    cols = _block_edges(0, col1 - col0, tile_size)
+
+    valid = np.isfinite(block)
+    sums = np.add.reduceat(np.add.reduceat(np.where(valid, block, 0.0), rows[:-1], axis=0), cols[:-1], axis=1)
+    counts = np.add.reduceat(np.add.reduceat(valid.astype(np.int32), rows[:-1], axis=0), cols[:-1], axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+
+    return means, rows + row0, cols + col0
+
+def _region(row0, row1, col0, col1, min_lod, max_lod):
+    lat_edges, lon_edges = _grid["lat_edges"], _grid["lon_edges"]
+    return (
+        f"<Region><LatLonAltBox><north>{lat_edges[row1]:.4f}</north><south>{lat_edges[row0]:.4f}</south>"
+        f"<east>{lon_edges[col1]:.4f}</east><west>{lon_edges[col0]:.4f}</west></LatLonAltBox>"
+        f"<Lod><minLodPixels>{min_lod}</minLodPixels><maxLodPixels>{max_lod}</maxLodPixels></Lod></Region>\n"
+    )
+
+def _styles():
+    return "".join(
+        f'<Style id="t{index}"><LineStyle><width>0</width></LineStyle>'
+        f"<PolyStyle><color>{color}</color></PolyStyle></Style>\n"
+        for index, color in enumerate(_grid["colors"])
+    )
+
+def _render_tile(tile):
+    """Render one tile: its Region, the aggregated cells and NetworkLinks to its children."""
+    level, row0, row1, col0, col1 = tile
+    children = _children(tile)
+    lat_edges, lon_edges = _grid["lat_edges"], _grid["lon_edges"]
+
+    means, rows, cols = _aggregate(row0, row1, col0, col1)
+    vmin, vmax, n_colors = _grid["vmin"], _grid["vmax"], len(_grid["colors"])
+    color_indices = (np.clip((means - vmin) / (vmax - vmin), 0, 1) * (n_colors - 1)).astype(np.int8)
+
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n',
+        _region(row0, row1, col0, col1, 0 if level == 0 else MIN_LOD_PIXELS, MAX_LOD_PIXELS if children else -1),
+        _styles(),
+    ]
+
+    # Plain Python floats format several times faster than NumPy scalars
+    row_edges, col_edges = lat_edges[rows].tolist(), lon_edges[cols].tolist()
+    valid = np.isfinite(means)
+
+    for i, (south, north) in enumerate(zip(row_edges[:-1], row_edges[1:])):
+        row_means, row_colors, row_valid = means[i].tolist(), color_indices[i].tolist(), valid[i].tolist()
+        for j, (west, east) in enumerate(zip(col_edges[:-1], col_edges[1:])):
+            if not row_valid[j]:
+                continue
+            parts.append(
+                f"<Placemark><name>{row_means[j]:.1f}°C</name><styleUrl>#t{row_colors[j]}</styleUrl>"
+                f"<Polygon><outerBoundaryIs><LinearRing><coordinates>{west:.4f},{south:.4f},0 {east:.4f},{south:.4f},0 "
+                f"{east:.4f},{north:.4f},0 {west:.4f},{north:.4f},0 {west:.4f},{south:.4f},0</coordinates>"
+                f"</LinearRing></outerBoundaryIs></Polygon></Placemark>\n"
+            )
+
+    for child in children:
+        parts.append(
+            f"<NetworkLink>{_region(*child[1:], MIN_LOD_PIXELS, -1)}"
+            f"<Link><href>{_tile_name(child)}</href><viewRefreshMode>onRegion</viewRefreshMode></Link></NetworkLink>\n"
+        )
+
+    parts.append("</Document></kml>")
+    return tile, "".join(parts)
+
+def _iter_tiles(root):
+    """Every tile of the pyramid, breadth first."""
+    queue = deque([root])
+    while queue:
+        tile = queue.popleft()
+        yield tile
+        queue.extend(_children(tile))
+
+def _write_tiles(kmz, rendered):
+    """Stream rendered tiles into the archive, returning how many were written."""
+    tiles = 0
+    for tile, kml in rendered:
+        kmz.writestr(f"tiles/{_tile_name(tile)}", kml)
+        tiles += 1
+    return tiles
+
+def write_kmz_pyramid(values, latitudes, longitudes, kmz_path, colors, vmin, vmax,
+                      tile_size=TILE_SIZE, max_workers=None):
+    """Write a quadtree pyramid of aggregated tiles with Region/Lod NetworkLinks into a KMZ.
+
+    ``values`` is a (latitude, longitude) array on ascending longitudes in
+    [-180, 180], ``colors`` are KML aabbggrr colours spread over
+    [vmin, vmax]. Tiles are rendered in a process pool (``max_workers=1``
+    renders in-process) and streamed into the archive as they complete.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    # Tiles are laid out south to north
+    if latitudes[0] > latitudes[-1]:
+        latitudes, values = latitudes[::-1], values[::-1]
+
+    initargs = (values, _cell_edges(latitudes, 90), _cell_edges(longitudes, 180), colors, vmin, vmax, tile_size)
+    _init_worker(*initargs)
+    root = (0, 0, values.shape[0], 0, values.shape[1])
+
+    os.makedirs(os.path.dirname(kmz_path) or ".", exist_ok=True)
+    with zipfile.ZipFile(kmz_path, "w", zipfile.ZIP_DEFLATED) as kmz:
+        kmz.writestr("doc.kml", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+            f"<NetworkLink>{_region(*root[1:], 0, -1)}"
+            f"<Link><href>tiles/{_tile_name(root)}</href><viewRefreshMode>onRegion</viewRefreshMode></Link></NetworkLink>\n"
+            "</Document></kml>"
+        ))
+
+        if max_workers == 1:
+            tiles = _write_tiles(kmz, map(_render_tile, _iter_tiles(root)))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, **pool_initializer(_init_worker, initargs)) as executor:
+                tiles = _write_tiles(kmz, executor.map(_render_tile, _iter_tiles(root), chunksize=32))
+
+    logging.info(f"KMZ pyramid with {tiles} tiles saved at {kmz_path}")
+    return tiles
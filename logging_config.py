@@ -1,4 +1,9 @@
+import os
+import json
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
 import colorama
 
 # Define log styles
@@ -7,28 +12,114 @@ class style:
     COMPLEMENT = lambda x: colorama.Fore.RED + str(x)
     RESET = lambda x: colorama.Style.RESET_ALL + str(x)
 
+# Level prefixes, built once rather than for every record
+LEVEL_STYLES = {
+    logging.DEBUG: style.HEADER("[DEBUG]"),
+    logging.INFO: style.HEADER("[INFO]"),
+    logging.WARNING: style.COMPLEMENT("[WARNING]"),
+    logging.ERROR: style.COMPLEMENT("[ERROR]"),
+    logging.CRITICAL: style.COMPLEMENT("[CRITICAL]"),
+}
+DEFAULT_STYLE = style.RESET("[LOG]")
+RESET_STYLE = style.RESET("")
+
 class ColorFormatter(logging.Formatter):
     """Custom formatter to apply colors based on log level"""
     def format(self, record):
-        level_colors = {
-            logging.DEBUG: style.HEADER("[DEBUG]"),
-            logging.INFO: style.HEADER("[INFO]"),
-            logging.WARNING: style.COMPLEMENT("[WARNING]"),
-            logging.ERROR: style.COMPLEMENT("[ERROR]"),
-            logging.CRITICAL: style.COMPLEMENT("[CRITICAL]"),
-        }
-        log_color = level_colors.get(record.levelno, style.RESET("[LOG]"))
+        log_color = LEVEL_STYLES.get(record.levelno, DEFAULT_STYLE)
         log_msg = super().format(record)
-        return f"{log_color} {log_msg} {style.RESET('')}"
+        return f"{log_color} {log_msg} {RESET_STYLE}"
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the structured ``metrics`` passed as ``extra``"""
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "metrics", {}))
+        return json.dumps(entry, default=str)
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_FILE = "grib2_processing.log"
+
+# Stage timings from profiling.py, as JSON lines
+METRICS_LOGGER = "grib2.metrics"
+METRICS_LOG = os.environ.get("GRIB2_METRICS_LOG", "grib2_metrics.jsonl")
+
+# Optional JSON copy of the log, rotated every GRIB2_JSON_LOG_MB (keeping GRIB2_JSON_LOG_BACKUPS files)
+JSON_LOG = os.environ.get("GRIB2_JSON_LOG")
+JSON_LOG_MAX_BYTES = int(os.environ.get("GRIB2_JSON_LOG_MB", "50")) * 1024 * 1024
+JSON_LOG_BACKUPS = int(os.environ.get("GRIB2_JSON_LOG_BACKUPS", "5"))
+
+def _output_handlers():
+    """File, console, metrics and (optional) JSON handlers, only ever attached to the listener."""
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(ColorFormatter(LOG_FORMAT))
+
+    # Keep the human-readable handlers at INFO, the metrics log also takes per-file DEBUG records
+    handlers = [file_handler, console_handler]
+    for handler in handlers:
+        handler.setLevel(logging.INFO)
+
+    metrics_handler = logging.FileHandler(METRICS_LOG)
+    metrics_handler.setFormatter(JsonFormatter())
+    metrics_handler.addFilter(logging.Filter(METRICS_LOGGER))
+    handlers.append(metrics_handler)
+
+    if JSON_LOG:
+        json_handler = logging.handlers.RotatingFileHandler(JSON_LOG, maxBytes=JSON_LOG_MAX_BYTES, backupCount=JSON_LOG_BACKUPS)
+        json_handler.setFormatter(JsonFormatter())
+        json_handler.setLevel(logging.INFO)
+        handlers.append(json_handler)
+
+    return handlers
+
+def _log_through(log_queue):
+    """Send every record of this process to ``log_queue`` instead of formatting and writing it here."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    logging.getLogger(METRICS_LOGGER).setLevel(logging.DEBUG)
+
+# Setup logging: records of this process and of every pool worker go through one
+# queue, and a single listener thread formats and writes them, so logging calls
+# never wait on the disk or the console and lines from different processes never interleave
+LOG_QUEUE = None
+_listener = None
+
+if multiprocessing.parent_process() is None:
+    LOG_QUEUE = multiprocessing.get_context("spawn").Queue()
+    _log_through(LOG_QUEUE)
+
+    _listener = logging.handlers.QueueListener(LOG_QUEUE, *_output_handlers(), respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)  # Flushes the records still queued
+
+def init_worker_logging(log_queue):
+    """Log to the parent's queue from a pool worker (spawned workers don't inherit its handlers)."""
+    global LOG_QUEUE
+    LOG_QUEUE = log_queue
+    _log_through(log_queue)
 
-# Setup logging
-logging.basicConfig(
-    filename="grib2_processing.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+def _init_worker(log_queue, initializer, initargs):
+    init_worker_logging(log_queue)
+    if initializer is not None:
+        initializer(*initargs)
 
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(ColorFormatter("%(asctime)s - %(levelname)s - %(message)s"))
+def pool_initializer(initializer=None, initargs=()):
+    """``initializer``/``initargs`` of a ProcessPoolExecutor whose workers log through this process's queue.
 
-logging.getLogger().addHandler(console_handler)
+    ``initializer(*initargs)`` of the pool itself, if any, runs after the logging setup.
+    """
+    if LOG_QUEUE is None:
+        return {"initializer": initializer, "initargs": initargs}
+    return {"initializer": _init_worker, "initargs": (LOG_QUEUE, initializer, initargs)}
@@ -1,40 +1,220 @@
 import sys
 import os
+import argparse
+import functools
 
 project_dir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(project_dir)
 sys.path.append(project_dir)
 
+# Render off-screen unless a backend was chosen explicitly (or --show asks for a window),
+# so batch runs never need a display
+if "--show" not in sys.argv:
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
 from logging_config import logging
 import data_extraction
 import data_cleaning
 import generate_gif
 import generate_3d_map
 import export_to_kml
+import export_formats
+import export_parquet
+import export_cog
+import dataset_cache
+import encoding_profiles
+import forecast_archive
+import grib_index_cache
+import kml_tiles
+import point_query
+import zonal_stats
+import regridding
+import rollups
+import profiling
+import logging_config
+from pipeline import Pipeline, Stage
+
+CLEANED_PATH = "Outputs/final_cleaned_dataset.nc"
+
+# Imported by every stage (timings and log setup), so part of every stage key, and
+# this module, which defines the stage functions and the paths they read
+COMMON_CODE = [sys.modules[__name__], profiling, logging_config]
+
+def extract_stage(workers, index_cache, incremental, variables=None, bbox=None, regions=None,
+                  archive=False, archive_days=forecast_archive.ARCHIVE_DAYS):
+    """Extract GRIB2 data into the Zarr store (and every cycle into the forecast archive)."""
+    options = {"variables": variables, "bbox": bbox, "regions": regions,
+               "archive": forecast_archive.DEFAULT_ARCHIVE if archive else None, "keep_days": archive_days}
+    if incremental:
+        extracted_ds = data_extraction.append_new_grib_files(max_workers=workers, index_cache_dir=index_cache, **options)
+    else:
+        extracted_ds = data_extraction.process_grib_files(max_workers=workers, index_cache_dir=index_cache, **options)
+
+    return None if extracted_ds is None else data_extraction.DEFAULT_STORE
+
+def clean_stage(profile=encoding_profiles.DEFAULT_PROFILE):
+    """Clean the extracted store into the final NetCDF."""
+    return data_cleaning.clean_and_transform(data_extraction.open_store(), CLEANED_PATH, profile)
+
+def _open_cleaned():
+    # Opened once per worker process, derived arrays are shared by the stages it runs
+    return dataset_cache.open_dataset(CLEANED_PATH)
+
+def gif_stage(formats=generate_gif.OUTPUT_FORMATS):
+    return generate_gif.create_temperature_gif(_open_cleaned(), formats=formats)
+
+def map_stage(show=False):
+    return generate_3d_map.create_3d_temperature_map(_open_cleaned(), show=show)
+
+def kml_stage(stride=export_to_kml.STRIDE):
+    return export_to_kml.export_kml(_open_cleaned(), stride=stride)
+
+def geotiff_stage():
+    return export_formats.export_geotiff(_open_cleaned())
+
+def csv_stage():
+    return export_formats.export_csv(_open_cleaned())
+
+def zarr_stage(profile=encoding_profiles.DEFAULT_PROFILE):
+    return export_formats.export_zarr(_open_cleaned(), profile=profile)
+
+def cog_stage(compression=export_cog.COMPRESSION):
+    return export_cog.export_cog(_open_cleaned(), compression=compression)
+
+def parquet_stage(drop_fill=False):
+    return export_parquet.export_parquet(_open_cleaned(), drop_fill=drop_fill)
+
+def zonal_stage(zones, id_field=None, weights_dir=zonal_stats.WEIGHTS_DIR):
+    return zonal_stats.export_zonal_stats(_open_cleaned(), zones, id_field=id_field, weights_dir=weights_dir)
+
+def regrid_stage(targets, method="bilinear", profile=encoding_profiles.DEFAULT_PROFILE, weights_dir=regridding.WEIGHTS_DIR):
+    output_paths = [regridding.export_regridded(_open_cleaned(), target, method, profile=profile, weights_dir=weights_dir)
+                    for target in targets]
+    return None if None in output_paths else output_paths
+
+def rollups_stage(reset_hours=rollups.ACCUMULATION_RESET_HOURS):
+    return rollups.update_rollups(_open_cleaned(), reset_hours=reset_hours)
+
+def build_pipeline(args):
+    """Declare every stage with its inputs, outputs and code."""
+    # Worker counts and the GRIB index cache location don't change the artifacts,
+    # so they are bound here instead of being hashed as parameters
+    extract = functools.partial(extract_stage, args.workers or None, args.index_cache, args.incremental)
+    extract_outputs = [data_extraction.DEFAULT_STORE] + ([forecast_archive.DEFAULT_ARCHIVE] if args.archive else [])
+
+    # Settings read from the environment are passed as params with their resolved
+    # values, so changing one reruns the stages it affects
+    animation_formats = [output_format.strip().lower() for output_format in generate_gif.OUTPUT_FORMATS]
+    animation_outputs = [f"Outputs/temperature_forecast{generate_gif.EXTENSIONS[output_format]}"
+                         for output_format in animation_formats]
+
+    stages = [
+        Stage("extract", extract, extract_outputs, inputs=["./Data/*.grib2"],
+              params={"variables": args.variables, "bbox": args.bbox, "regions": args.regions,
+                      "archive": args.archive, "archive_days": args.archive_days},
+              code=[data_extraction, grib_index_cache, forecast_archive] + COMMON_CODE),
+        Stage("clean", clean_stage, [CLEANED_PATH], depends_on=["extract"], params={"profile": args.encoding_profile},
+              code=[data_cleaning, encoding_profiles] + COMMON_CODE),
+
+        # Independent sinks, run concurrently once cleaning is done
+        Stage("gif", gif_stage, animation_outputs, depends_on=["clean"], params={"formats": animation_formats},
+              code=[generate_gif, dataset_cache, data_cleaning] + COMMON_CODE, parallel=True),
+        Stage("3d_map", map_stage, ["Outputs/3d_map.png"], depends_on=["clean"], params={"show": args.show},
+              code=[generate_3d_map, dataset_cache, data_cleaning] + COMMON_CODE, parallel=not args.show),
+        Stage("kml", kml_stage, ["Outputs/temperature_data.kml", "Outputs/temperature_tiles.kmz"],
+              depends_on=["clean"], params={"stride": export_to_kml.STRIDE},
+              code=[export_to_kml, kml_tiles, dataset_cache, data_cleaning] + COMMON_CODE, parallel=True),
+        Stage("geotiff", geotiff_stage, ["Outputs/temperature_2m.tif"], depends_on=["clean"],
+              code=[export_formats, dataset_cache, data_cleaning] + COMMON_CODE, parallel=True),
+        Stage("csv", csv_stage, ["Outputs/final_dataset.csv"], depends_on=["clean"],
+              code=[export_formats, dataset_cache] + COMMON_CODE, parallel=True),
+        Stage("zarr", zarr_stage, ["Outputs/final_cleaned_dataset.zarr"], depends_on=["clean"],
+              params={"profile": args.encoding_profile}, code=[export_formats, encoding_profiles, dataset_cache] + COMMON_CODE,
+              parallel=True),
+        Stage("cog", cog_stage, [export_cog.DEFAULT_OUTPUT_DIR], depends_on=["clean"],
+              params={"compression": export_cog.COMPRESSION},
+              code=[export_cog, dataset_cache, data_cleaning] + COMMON_CODE, parallel=True),
+        Stage("parquet", parquet_stage, [export_parquet.DEFAULT_OUTPUT_DIR], depends_on=["clean"],
+              params={"drop_fill": args.parquet_drop_fill}, code=[export_parquet, dataset_cache, data_cleaning] + COMMON_CODE,
+              parallel=True),
+        # Only rolls up the steps added since its last run
+        Stage("rollups", rollups_stage, [rollups.DEFAULT_OUTPUT_DIR], depends_on=["clean"],
+              params={"reset_hours": rollups.ACCUMULATION_RESET_HOURS},
+              code=[rollups, dataset_cache, data_extraction] + COMMON_CODE, parallel=True),
+    ]
+
+    if args.zones:
+        stages.append(Stage("zonal", zonal_stage, [zonal_stats.DEFAULT_OUTPUT], inputs=[args.zones], depends_on=["clean"],
+                            params={"zones": args.zones, "id_field": args.zones_id_field,
+                                    "weights_dir": zonal_stats.WEIGHTS_DIR},
+                            code=[zonal_stats, dataset_cache] + COMMON_CODE, parallel=True))
 
-logging.info("Executing complete GRIB2 processing pipeline...")
+    if args.regrid:
+        outputs = [f"Outputs/final_cleaned_dataset_{regridding.grid_name(target)}_{args.regrid_method}.nc" for target in args.regrid]
+        stages.append(Stage("regrid", regrid_stage, outputs, inputs=[target for target in args.regrid if os.path.exists(target)],
+                            depends_on=["clean"], params={"targets": args.regrid, "method": args.regrid_method,
+                                                          "profile": args.encoding_profile,
+                                                          "weights_dir": regridding.WEIGHTS_DIR},
+                            code=[regridding, point_query, dataset_cache, encoding_profiles] + COMMON_CODE, parallel=True))
 
-# Extract GRIB2 Data
-extracted_ds = data_extraction.process_grib_files()
+    return Pipeline(stages, max_workers=args.sink_workers or None)
 
-if extracted_ds is None:
-    logging.error("Data extraction failed. Exiting...")
-    sys.exit(1)
+def main():
+    parser = argparse.ArgumentParser(description="Run the complete GRIB2 processing pipeline.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of parallel GRIB2 extraction workers (0 = one per CPU).")
+    parser.add_argument("--sink-workers", type=int, default=0,
+                        help="Number of processes running the export stages concurrently (0 = one per CPU).")
+    parser.add_argument("--index-cache", default=None,
+                        help="Directory for cached cfgrib index files (default: $GRIB2_INDEX_CACHE_DIR or ~/.cache/grib2_index).")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"Only decode new forecast steps and append them to {data_extraction.DEFAULT_STORE}.")
+    parser.add_argument("--variables", type=lambda value: value.split(","), default=None,
+                        help=f"Comma-separated variables to extract ({', '.join(data_extraction.VARIABLES)}, default: all).")
+    parser.add_argument("--bbox", type=lambda value: [float(part) for part in value.split(",")], default=None,
+                        metavar="LAT_MIN,LAT_MAX,LON_MIN,LON_MAX", help="Only extract grid points inside this box.")
+    parser.add_argument("--regions", type=lambda value: value.split(","), default=None,
+                        help=f"Comma-separated named regions to extract ({', '.join(data_extraction.REGIONS)}).")
+    parser.add_argument("--archive", action="store_true",
+                        help=f"Keep every cycle and ensemble member in {forecast_archive.DEFAULT_ARCHIVE} (the newest one is exported).")
+    parser.add_argument("--archive-days", type=int, default=forecast_archive.ARCHIVE_DAYS,
+                        help="Days of cycles kept in the forecast archive, counted back from the newest cycle.")
+    parser.add_argument("--parquet-drop-fill", action="store_true",
+                        help="Leave grid points where every variable is missing out of the Parquet export.")
+    parser.add_argument("--zones", default=None,
+                        help=f"GeoJSON regions to compute area-weighted statistics over (written to {zonal_stats.DEFAULT_OUTPUT}).")
+    parser.add_argument("--zones-id-field", default=None, help="Feature property naming each region in --zones.")
+    parser.add_argument("--regrid", type=lambda value: value.split(","), default=None,
+                        help="Comma-separated target resolutions in degrees or grid files, e.g. 0.5,1.0 or customer_grid.nc.")
+    parser.add_argument("--regrid-method", choices=regridding.METHODS, default="bilinear",
+                        help="Regridding method for --regrid.")
+    parser.add_argument("--encoding-profile", choices=encoding_profiles.PROFILES, default=encoding_profiles.DEFAULT_PROFILE,
+                        help="Packing, chunking and compression of the NetCDF and Zarr outputs (see encoding_profiles.py).")
+    parser.add_argument("--force", action="store_true",
+                        help="Run every stage, even those whose inputs are unchanged.")
+    parser.add_argument("--show", action="store_true",
+                        help="Open the interactive 3D map window (blocks until it is closed).")
+    args = parser.parse_args()
 
-# Clean Data
-cleaned_ds = data_cleaning.clean_and_transform(extracted_ds)
+    if args.bbox is not None and len(args.bbox) != 4:
+        parser.error("--bbox needs four values: LAT_MIN,LAT_MAX,LON_MIN,LON_MAX")
+    unknown_regions = set(args.regions or []) - set(data_extraction.REGIONS)
+    if unknown_regions:
+        parser.error(f"Unknown regions {sorted(unknown_regions)}, choose from {list(data_extraction.REGIONS)}")
+    unknown_variables = set(args.variables or []) - set(data_extraction.VARIABLES)
+    if unknown_variables:
+        parser.error(f"Unknown variables {sorted(unknown_variables)}, choose from {data_extraction.VARIABLES}")
 
-if cleaned_ds is None:
-    logging.error("Data cleaning failed. Exiting...")
-    sys.exit(1)
+    logging.info("Executing complete GRIB2 processing pipeline...")
+    os.makedirs("Outputs", exist_ok=True)
 
-# Generate GIF
-generate_gif.create_temperature_gif()
+    executed = build_pipeline(args).run(force=args.force)
 
-# Generate 3D Map
-generate_3d_map.create_3d_temperature_map()
+    if executed is None:
+        logging.error("GRIB2 processing pipeline failed. Exiting...")
+        sys.exit(1)
 
-# Export to KML
-export_to_kml.export_kml()
+    logging.info(f"All processing steps completed successfully! Stages run: {executed or 'none'}")
 
-logging.info("All processing steps completed successfully!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import glob
+import hashlib
+import inspect
+import json
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from logging_config import logging, pool_initializer  # Import custom logging setup
+
+DEFAULT_CACHE_PATH = "Outputs/.pipeline_cache.json"
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+class Stage:
+    """One pipeline step: a callable with its declared inputs, outputs and parameters.
+
+    ``func(**params)`` must write ``outputs`` and return something other than
+    None on success. ``inputs`` are file paths or glob patterns read by the
+    stage, ``depends_on`` names the upstream stages whose artifacts it reads
+    and ``code`` the modules whose source defines its behaviour (the module
+    of ``func`` by default). Stages marked ``parallel`` run in the worker
+    pool, the others in the main process.
+    """
+
+    def __init__(self, name, func, outputs, inputs=(), depends_on=(), params=None, code=(), parallel=False):
+        self.name = name
+        self.func = func
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.depends_on = list(depends_on)
+        self.params = params or {}
+        self.code = list(code) or [inspect.getmodule(func)]
+        self.parallel = parallel
+
+class Pipeline:
+    """Run stages in dependency order, skipping those whose inputs are unchanged.
+
+    Every stage's artifact is recorded under a key hashing its input files'
+    contents, its parameters, the source of its code modules and the keys of
+    its upstream stages. A stage whose key matches the last successful run,
+    and whose outputs still exist, is skipped.
+    """
+
+    def __init__(self, stages, cache_path=DEFAULT_CACHE_PATH, max_workers=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+
+        for stage in stages:
+            for upstream in stage.depends_on:
+                if upstream not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{upstream}'")
+
+        self._cache = self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"stages": {}, "files": {}}
+
+    def _save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        with open(f"{self.cache_path}.tmp", "w") as f:
+            json.dump(self._cache, f, indent=1, sort_keys=True)
+        os.replace(f"{self.cache_path}.tmp", self.cache_path)
+
+    def _file_hash(self, path):
+        """Content hash of a file, only recomputed when its size or mtime changes."""
+        stat = os.stat(path)
+        cached = self._cache["files"].get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+
+        self._cache["files"][path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def stage_key(self, stage, upstream_keys):
+        """Hash of everything that determines a stage's artifact."""
+        input_files = sorted({path for pattern in stage.inputs for path in glob.glob(pattern)})
+        code_files = sorted({inspect.getsourcefile(module) for module in stage.code})
+
+        manifest = {
+            "inputs": [(path, self._file_hash(path)) for path in input_files],
+            "code": [(os.path.basename(path), self._file_hash(path)) for path in code_files],
+            "params": stage.params,
+            "upstream": [upstream_keys[name] for name in stage.depends_on],
+        }
+        return hashlib.blake2b(json.dumps(manifest, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+    def _is_cached(self, stage, key):
+        cached = self._cache["stages"].get(stage.name, {})
+        return cached.get("key") == key and all(os.path.exists(path) for path in stage.outputs)
+
+    def _record(self, stage, key, result):
+        """Store a finished stage's key, returning whether it succeeded."""
+        if result is None:
+            logging.error(f"Stage '{stage.name}' failed.")
+            return False
+
+        self._cache["stages"][stage.name] = {"key": key, "outputs": stage.outputs}
+        self._save_cache()
+        logging.info(f"Stage '{stage.name}' finished.")
+        return True
+
+    def run(self, force=False):
+        """Run every stage whose key changed (all of them with ``force``).
+
+        Returns the names of the stages that executed successfully, or None
+        if any stage failed (its dependents are not run).
+        """
+        keys, done, failed, executed = {}, set(), set(), []
+        pending = list(self.stages.values())
+        running = {}
+
+        def finish(stage, key, call):
+            try:
+                result = call()
+            except Exception as e:
+                logging.error(f"Stage '{stage.name}' raised: {e}")
+                result = None
+
+            if self._record(stage, key, result):
+                done.add(stage.name)
+                executed.append(stage.name)
+            else:
+                failed.add(stage.name)
+
+        # Spawned, not forked: by the time sinks start the parent holds dask
+        # and HDF5 threads whose locks a forked child could inherit mid-acquire
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context, **pool_initializer()) as executor:
+            while pending or running:
+                progressed = False
+
+                for stage in list(pending):
+                    if any(name in failed for name in stage.depends_on):
+                        logging.warning(f"Skipping stage '{stage.name}', an upstream stage failed.")
+                        failed.add(stage.name)
+                    elif not all(name in done for name in stage.depends_on):
+                        continue
+                    else:
+                        keys[stage.name] = key = self.stage_key(stage, keys)
+
+                        if not force and self._is_cached(stage, key):
+                            logging.info(f"Stage '{stage.name}' is up to date, skipping.")
+                            done.add(stage.name)
+                        elif stage.parallel:
+                            logging.info(f"Running stage '{stage.name}' in the worker pool...")
+                            running[executor.submit(stage.func, **stage.params)] = (stage, key)
+                        else:
+                            logging.info(f"Running stage '{stage.name}'...")
+                            finish(stage, key, lambda: stage.func(**stage.params))
+
+                    pending.remove(stage)
+                    progressed = True
+
+                if running:
+                    # Wait for a pooled stage, its dependents may become ready
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage, key = running.pop(future)
+                        finish(stage, key, future.result)
+                elif pending and not progressed:
+                    raise ValueError(f"Dependency cycle between stages {[stage.name for stage in pending]}")
+
+        return None if failed else executed
@@ -0,0 +1,212 @@
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from logging_config import logging  # Import custom logging setup
+import dataset_cache
+
+DEFAULT_SOURCE = "Outputs/final_cleaned_dataset.nc"
+
+class GridAxis:
+    """Fractional index of coordinate values along one 1D grid axis.
+
+    Regular axes use plain arithmetic, irregular ones interpolate over the
+    sorted coordinate. ``period`` (360 for a global longitude axis) lets
+    positions past the last cell wrap around to the first one.
+    """
+
+    def __init__(self, coords, period=None):
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.size = len(self.coords)
+        steps = np.diff(self.coords)
+        self.step = steps.mean() if self.size > 1 else 1.0
+        self.regular = self.size > 1 and np.allclose(steps, self.step, rtol=1e-6, atol=0)
+        self.period = period if period and self.regular and np.isclose(abs(self.step) * self.size, period) else None
+        self.order = np.argsort(self.coords)
+
+    def position(self, values):
+        """Fractional index of every value (NaN outside the axis)."""
+        values = np.asarray(values, dtype=np.float64)
+
+        if self.period:
+            # Into [first, first + period) in the axis' own convention, e.g. [0, 360) or [-180, 180)
+            start = min(self.coords[0], self.coords[-1])
+            values = (values - start) % self.period + start
+            position = (values - self.coords[0]) / self.step
+            return np.where(position < 0, position + self.size, position)
+
+        if self.regular:
+            position = (values - self.coords[0]) / self.step
+        else:
+            position = np.interp(values, self.coords[self.order], self.order.astype(np.float64),
+                                 left=np.nan, right=np.nan)
+
+        # Half a cell of tolerance at both ends, like the grid cells' own extent
+        return np.where((position >= -0.5) & (position <= self.size - 0.5), position, np.nan)
+
+    def nearest(self, position):
+        index = np.rint(position)
+        return np.where(index >= self.size, index - self.size if self.period else self.size - 1, index)
+
+    def neighbours(self, position):
+        """Lower and upper cell indices around every position and the weight of the upper one."""
+        lower = np.floor(position)
+        weight = position - lower
+        upper = lower + 1
+
+        if self.period:
+            upper = np.where(upper >= self.size, upper - self.size, upper)
+        else:
+            # Edge half-cells snap to the edge value
+            lower, upper = np.clip(lower, 0, self.size - 1), np.clip(upper, 0, self.size - 1)
+
+        return lower, upper, weight
+
+class PointQuery:
+    """Batched point and time-series lookups on a lat/lon gridded dataset.
+
+    The grid index is computed once per dataset: arithmetic on regular
+    axes, interpolation over the coordinates of irregular 1D axes, or a
+    KD-tree for 2D (curvilinear) latitude/longitude coordinates. Queries
+    gather every step of every point in one vectorized operation.
+    """
+
+    def __init__(self, ds_or_path=DEFAULT_SOURCE):
+        self.ds = dataset_cache.open_dataset(ds_or_path) if isinstance(ds_or_path, str) else ds_or_path
+        latitudes, longitudes = self.ds["latitude"], self.ds["longitude"]
+
+        self.tree = None
+        if latitudes.ndim == 2:
+            from scipy.spatial import cKDTree  # Only needed for curvilinear grids
+
+            self.grid_shape = latitudes.shape
+            self.tree = cKDTree(self._unit_vectors(latitudes.values.ravel(), longitudes.values.ravel()))
+        else:
+            self.lat_axis = GridAxis(latitudes.values)
+            self.lon_axis = GridAxis(longitudes.values, period=360)
+            self.grid_shape = (self.lat_axis.size, self.lon_axis.size)
+
+    @staticmethod
+    def _unit_vectors(latitudes, longitudes):
+        lat, lon = np.radians(latitudes), np.radians(longitudes)
+        return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+    def cell_weights(self, latitudes, longitudes, method="nearest"):
+        """Flat grid indices (points, k) and weights (points, k) of every query point.
+
+        ``k`` is 1 for ``nearest`` and 4 for ``bilinear``, points outside the
+        grid get index 0 and NaN weights.
+        """
+        if self.tree is not None:
+            if method != "nearest":
+                raise ValueError("Curvilinear grids only support nearest-neighbour queries")
+            _, index = self.tree.query(self._unit_vectors(latitudes, longitudes))
+            return index[:, None], np.ones((len(index), 1))
+
+        rows = self.lat_axis.position(latitudes)
+        cols = self.lon_axis.position(longitudes)
+        outside = np.isnan(rows) | np.isnan(cols)
+        rows, cols = np.nan_to_num(rows), np.nan_to_num(cols)
+        n_cols = self.grid_shape[1]
+
+        if method == "nearest":
+            index = (self.lat_axis.nearest(rows) * n_cols + self.lon_axis.nearest(cols))[:, None]
+            weights = np.ones(index.shape)
+        elif method == "bilinear":
+            row0, row1, row_weight = self.lat_axis.neighbours(rows)
+            col0, col1, col_weight = self.lon_axis.neighbours(cols)
+            index = np.stack([row0 * n_cols + col0, row0 * n_cols + col1,
+                              row1 * n_cols + col0, row1 * n_cols + col1], axis=1)
+            weights = np.stack([(1 - row_weight) * (1 - col_weight), (1 - row_weight) * col_weight,
+                                row_weight * (1 - col_weight), row_weight * col_weight], axis=1)
+        else:
+            raise ValueError(f"Unknown interpolation method '{method}'")
+
+        weights[outside] = np.nan
+        return index.astype(np.int64), weights
+
+    def query(self, latitudes, longitudes, variables=None, method="nearest"):
+        """Values of every variable at every point and step.
+
+        Returns a dict of variable name to a (step, point) float32 array, or
+        (point,) for variables without a step. Only the grid window covering
+        the points is read.
+        """
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+        variables = variables or [name for name, var in self.ds.data_vars.items()
+                                  if {"latitude", "longitude"} <= set(var.dims)]
+
+        index, weights = self.cell_weights(latitudes, longitudes, method)
+        inside = ~np.isnan(weights[:, 0])
+        if not inside.any():
+            logging.warning("None of the query points fall inside the grid.")
+            inside[:] = True  # Gather anything, the NaN weights blank the results
+
+        # Read the bounding window of the touched cells instead of the whole grid
+        rows, cols = np.divmod(index, self.grid_shape[1])
+        row_slice = slice(int(rows[inside].min()), int(rows[inside].max()) + 1)
+        col_slice = slice(int(cols[inside].min()), int(cols[inside].max()) + 1)
+        window_index = (rows - row_slice.start) * (col_slice.stop - col_slice.start) + (cols - col_slice.start)
+        window_index[~inside] = 0
+
+        lat_dim, lon_dim = self.ds["latitude"].dims[0], self.ds["longitude"].dims[-1]
+        results = {}
+        for name in variables:
+            da = self.ds[name]
+            leading = [dim for dim in da.dims if dim not in (lat_dim, lon_dim)]
+            window = da.isel({lat_dim: row_slice, lon_dim: col_slice}).transpose(*leading, lat_dim, lon_dim).values
+            window = window.reshape(window.shape[:-2] + (-1,))
+
+            # (..., points, k) gather, weighted sum over the k neighbours
+            values = (window[..., window_index] * weights).sum(axis=-1)
+            results[name] = values.astype(np.float32)
+
+        return results
+
+    def query_dataframe(self, latitudes, longitudes, variables=None, method="nearest"):
+        """``query`` as a long DataFrame with one row per point and step."""
+        results = self.query(latitudes, longitudes, variables, method)
+        n_points = len(np.atleast_1d(latitudes))
+        n_steps = self.ds.sizes.get("step", 1)
+
+        frame = {
+            "point": np.tile(np.arange(n_points), n_steps),
+            "latitude": np.tile(np.atleast_1d(latitudes), n_steps),
+            "longitude": np.tile(np.atleast_1d(longitudes), n_steps),
+        }
+        if "step" in self.ds.dims:
+            frame["step"] = np.repeat(self.ds["step"].values, n_points)
+            if "valid_time" in self.ds.coords:
+                frame["valid_time"] = np.repeat(np.atleast_1d(self.ds["valid_time"].values), n_points)
+
+        for name, values in results.items():
+            frame[name] = np.broadcast_to(values, (n_steps, n_points)).ravel()
+
+        return pd.DataFrame(frame)
+
+def main():
+    parser = argparse.ArgumentParser(description="Sample the forecast at a list of coordinates.")
+    parser.add_argument("points", help="CSV file with latitude and longitude columns.")
+    parser.add_argument("--source", default=DEFAULT_SOURCE, help="Cleaned NetCDF file or Zarr store to query.")
+    parser.add_argument("--variables", type=lambda value: value.split(","), default=None,
+                        help="Comma-separated variables to sample (default: all).")
+    parser.add_argument("--method", choices=["nearest", "bilinear"], default="nearest")
+    parser.add_argument("--output", default="Outputs/point_forecast.csv", help="CSV or .parquet output file.")
+    args = parser.parse_args()
+
+    points = pd.read_csv(args.points)
+    result = PointQuery(args.source).query_dataframe(
+        points["latitude"].values, points["longitude"].values, args.variables, args.method
+    )
+
+    if args.output.endswith(".parquet"):
+        result.to_parquet(args.output, index=False)
+    else:
+        result.to_csv(args.output, index=False)
+    logging.info(f"Sampled {len(points)} points into {args.output} ({len(result)} rows)")
+
+if __name__ == "__main__":
+    main()
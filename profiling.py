@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import functools
+import resource
+import logging
+import threading
+from contextlib import contextmanager
+
+from logging_config import logging, METRICS_LOGGER  # Import custom logging setup
+
+# Opt-in hot-spot dump of every top-level stage: GRIB2_PROFILE=cprofile or pyinstrument
+PROFILER = os.environ.get("GRIB2_PROFILE", "").lower()
+PROFILE_DIR = os.environ.get("GRIB2_PROFILE_DIR", "Outputs/profiles")
+
+# Seconds between RSS samples while a stage is open
+RSS_SAMPLE_INTERVAL = float(os.environ.get("GRIB2_RSS_SAMPLE_MS", "10")) / 1000
+
+metrics_logger = logging.getLogger(METRICS_LOGGER)
+
+# Names of the stages currently open in this process, outermost first
+_active = []
+
+def _io_counters():
+    """(bytes read, bytes written) from and to storage by this process so far, None where /proc is unavailable.
+
+    Storage I/O only: pipes, sockets (e.g. the process pool's IPC) and reads
+    served from the page cache don't count.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None, None
+    return int(counters["read_bytes"]), int(counters["write_bytes"])
+
+def process_peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size over the whole life of this process (or of its largest reaped child) in MB.
+
+    ru_maxrss is in bytes on macOS, KB elsewhere.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def current_rss():
+    """Resident set size of this process right now in bytes, None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+class _RssSampler:
+    """Thread sampling this process's RSS while stages are open, keeping the peak of each open stage."""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._peaks = {}  # stage token -> peak RSS in bytes since the stage started
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss()
+        with self._lock:
+            for token, peak in self._peaks.items():
+                self._peaks[token] = max(peak, rss)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._peaks:
+                    self._thread = None  # Restarted by the next stage
+                    return
+            self._sample()
+
+    def start(self):
+        """Start tracking a stage's peak, returning its token (None where RSS can't be read)."""
+        rss = current_rss()
+        if rss is None:
+            return None
+
+        token = object()
+        with self._lock:
+            self._peaks[token] = rss
+            # A forked child inherits the thread object but not the thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+        return token
+
+    def stop(self, token):
+        """Stop tracking a stage, returning its peak RSS in MB."""
+        if token is None:
+            return None
+        self._sample()
+        with self._lock:
+            return round(self._peaks.pop(token) / (1024 * 1024), 1)
+
+_rss_sampler = _RssSampler()
+
+def _start_profiler():
+    if PROFILER == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    if PROFILER == "pyinstrument":
+        import pyinstrument  # Optional, only needed for GRIB2_PROFILE=pyinstrument
+
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        return profiler
+
+    return None
+
+def _dump_profiler(profiler, name):
+    """Write a profiler's results to PROFILE_DIR, returning the file path."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = os.path.join(PROFILE_DIR, f"{name}-{os.getpid()}")
+
+    if PROFILER == "cprofile":
+        profiler.disable()
+        profiler.dump_stats(f"{stem}.prof")  # Open with snakeviz or pstats
+        return f"{stem}.prof"
+
+    profiler.stop()
+    with open(f"{stem}.html", "w") as f:
+        f.write(profiler.output_html())
+    return f"{stem}.html"
+
+def _size(value):
+    return "n/a" if value is None else f"{value / (1024 * 1024):.1f} MB"
+
+class profile_stage:
+    """Measure a block (or, used as a decorator, a function call) and log its metrics.
+
+    Records wall time, CPU time, the peak RSS of this process during the
+    block (sampled every RSS_SAMPLE_INTERVAL, so shorter spikes can be
+    missed) and over its whole life so far, and bytes read from and written
+    to storage by this process. A block that raises, or a decorated
+    function that returns None (how the stages report a failure they
+    caught), is logged with status "error". The yielded dict can be filled
+    with extra counters (e.g. ``stats["messages"]``) and is logged with
+    ``fields`` as one record of the ``grib2.metrics`` logger at ``level``
+    (DEBUG keeps per-file records out of the console, they still go to the
+    JSON metrics log). With GRIB2_PROFILE set, only the outermost stage of a
+    process is profiled.
+    """
+
+    def __init__(self, name, level=logging.INFO, **fields):
+        self.name, self.level, self.fields = name, level, fields
+        self._blocks = []  # Open blocks, a stage can be entered again while open (e.g. recursion)
+
+    def __enter__(self):
+        block = _measure(self.name, self.level, self.fields)
+        self._blocks.append(block)
+        return block.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._blocks.pop().__exit__(*exc_info)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # A block per call, so concurrent calls of the same stage never share one
+            with _measure(self.name, self.level, self.fields) as stats:
+                result = func(*args, **kwargs)
+                if result is None:
+                    stats["status"] = "error"
+                return result
+        return wrapper
+
+@contextmanager
+def _measure(name, level, fields):
+    stats = dict(fields)
+    parent = _active[-1] if _active else None
+    profiler = _start_profiler() if parent is None else None
+
+    read_start, written_start = _io_counters()
+    rss_token = _rss_sampler.start()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    _active.append(name)
+
+    status = "ok"
+    try:
+        yield stats
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _active.pop()
+        read_end, written_end = _io_counters()
+        status = stats.pop("status", status)
+
+        metrics = {
+            "stage": name,
+            "parent": parent,
+            "status": status,
+            "pid": os.getpid(),
+            "wall_s": round(time.perf_counter() - wall_start, 4),
+            "cpu_s": round(time.process_time() - cpu_start, 4),
+            "stage_peak_rss_mb": _rss_sampler.stop(rss_token),
+            "process_peak_rss_mb": process_peak_rss_mb(),
+            "bytes_read": None if read_start is None else read_end - read_start,
+            "bytes_written": None if written_start is None else written_end - written_start,
+            **stats,
+        }
+        if profiler is not None:
+            metrics["profile"] = _dump_profiler(profiler, name)
+
+        details = "".join(f", {key}={value}" for key, value in stats.items())
+        peak = "n/a" if metrics["stage_peak_rss_mb"] is None else f"{metrics['stage_peak_rss_mb']} MB"
+        metrics_logger.log(
+            level,
+            f"Stage '{name}' {status} in {metrics['wall_s']:.2f}s (cpu {metrics['cpu_s']:.2f}s, "
+            f"peak RSS {peak}, read {_size(metrics['bytes_read'])}, "
+            f"written {_size(metrics['bytes_written'])}{details})",
+            extra={"metrics": metrics},
+        )
@@ -0,0 +1,261 @@
+import os
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+from logging_config import logging  # Import custom logging setup
+from profiling import profile_stage
+from point_query import GridAxis
+import dataset_cache
+import encoding_profiles
+
+DEFAULT_SOURCE = "Outputs/final_cleaned_dataset.nc"
+
+# Weight matrices are cached here, keyed by the source grid, target grid and method
+WEIGHTS_DIR = os.environ.get("GRIB2_REGRID_WEIGHTS_DIR", "Outputs/regrid_weights")
+
+METHODS = ("bilinear", "nearest", "conservative")
+
+# Bump when the weights change, so cached matrices are rebuilt
+WEIGHTS_VERSION = 1
+
+def grid_name(target):
+    """Short name of a target grid for output files, e.g. 0p50 for 0.5 degrees, or the grid file's name."""
+    try:
+        return f"{float(target):.2f}".replace(".", "p")
+    except ValueError:
+        return os.path.splitext(os.path.basename(target.rstrip("/")))[0]
+
+def target_grid(target, latitudes, longitudes):
+    """Target (latitudes, longitudes) from a resolution in degrees or a NetCDF/Zarr file with the grid.
+
+    A resolution gives a regular grid over the source's extent, aligned on
+    multiples of the resolution, in the source's latitude order and
+    longitude convention.
+    """
+    try:
+        resolution = float(target)
+    except ValueError:
+        grid = dataset_cache.open_dataset(target)
+        if grid["latitude"].ndim != 1 or grid["longitude"].ndim != 1:
+            raise ValueError(f"{target} is not a rectilinear latitude/longitude grid")
+        return grid["latitude"].values.astype(np.float64), grid["longitude"].values.astype(np.float64)
+
+    def axis(values, descending=False):
+        start = np.ceil(values.min() / resolution - 1e-9) * resolution
+        stop = np.floor(values.max() / resolution + 1e-9) * resolution
+        centres = np.round(np.arange(start, stop + resolution / 2, resolution), 6)
+        return centres[::-1] if descending else centres
+
+    return axis(latitudes, latitudes[0] > latitudes[-1]), axis(longitudes)
+
+def _interpolation_weights(source, target, method, period=None):
+    """1D bilinear or nearest weights (target, source), targets outside the source axis get an empty row."""
+    axis = GridAxis(source, period=period)
+    position = axis.position(target)
+    inside = np.flatnonzero(~np.isnan(position))
+    position = position[inside]
+
+    if method == "nearest":
+        rows, cols, values = inside, axis.nearest(position), np.ones(len(inside))
+    else:
+        lower, upper, weight = axis.neighbours(position)
+        rows = np.concatenate([inside, inside])
+        cols = np.concatenate([lower, upper])
+        values = np.concatenate([1 - weight, weight])
+
+    return sparse.csr_matrix((values, (rows, cols.astype(np.int64))), shape=(len(target), len(source)))
+
+def _cell_bounds(centres):
+    """Lower and upper edge of every cell, half way between neighbouring centres."""
+    if len(centres) == 1:
+        return centres - 0.5, centres + 0.5
+    middles = (centres[1:] + centres[:-1]) / 2
+    edges = np.concatenate([[2 * centres[0] - middles[0]], middles, [2 * centres[-1] - middles[-1]]])
+    return np.minimum(edges[:-1], edges[1:]), np.maximum(edges[:-1], edges[1:])
+
+def _conservative_weights(source, target, latitude=False, period=None):
+    """1D overlap weights (target, source), rows normalised over the covered part of each target cell.
+
+    Latitude overlaps are measured in sin(latitude), so the weights are
+    proportional to the area on the sphere.
+    """
+    source_lower, source_upper = _cell_bounds(source)
+    target_lower, target_upper = _cell_bounds(target)
+
+    measure = (lambda edges: np.sin(np.radians(np.clip(edges, -90, 90)))) if latitude else (lambda edges: edges)
+    overlap = np.zeros((len(target), len(source)))
+    for shift in ((-period, 0, period) if period else (0,)):
+        lower = np.maximum(target_lower[:, None], source_lower[None, :] + shift)
+        upper = np.minimum(target_upper[:, None], source_upper[None, :] + shift)
+        overlap += np.where(upper > lower, measure(upper) - measure(lower), 0)
+
+    totals = overlap.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        overlap = np.where(totals > 0, overlap / totals, 0)
+    return sparse.csr_matrix(overlap)
+
+class RegridWeights:
+    """Separable sparse weights from one rectilinear lat/lon grid to another.
+
+    The full (target cells, source cells) matrix is the Kronecker product
+    of a latitude and a longitude matrix, so only those two are built,
+    stored and applied: ``lat_weights @ field @ lon_weights.T``.
+    """
+
+    def __init__(self, lat_weights, lon_weights, latitudes, longitudes, method):
+        self.lat_weights = lat_weights.tocsr()
+        self.lon_weights = lon_weights.tocsr()
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.method = method
+
+    @classmethod
+    def build(cls, source_latitudes, source_longitudes, latitudes, longitudes, method="bilinear"):
+        if method not in METHODS:
+            raise ValueError(f"Unknown regridding method '{method}', choose from {METHODS}")
+
+        source_latitudes = np.asarray(source_latitudes, dtype=np.float64)
+        source_longitudes = np.asarray(source_longitudes, dtype=np.float64)
+
+        # Target longitudes in the source's convention, and a period if the source wraps around the globe
+        lon_start = source_longitudes.min()
+        mapped_longitudes = (np.asarray(longitudes, dtype=np.float64) - lon_start) % 360 + lon_start
+        lon_step = np.abs(np.diff(source_longitudes)).mean() if len(source_longitudes) > 1 else 360.0
+        period = 360 if np.isclose(lon_step * len(source_longitudes), 360) else None
+
+        if method == "conservative":
+            lat_weights = _conservative_weights(source_latitudes, latitudes, latitude=True)
+            lon_weights = _conservative_weights(source_longitudes, mapped_longitudes, period=period)
+        else:
+            lat_weights = _interpolation_weights(source_latitudes, latitudes, method)
+            lon_weights = _interpolation_weights(source_longitudes, mapped_longitudes, method, period=period)
+
+        return cls(lat_weights, lon_weights, np.asarray(latitudes), np.asarray(longitudes), method)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {"latitudes": self.latitudes, "longitudes": self.longitudes, "method": self.method}
+        for name, matrix in (("lat", self.lat_weights), ("lon", self.lon_weights)):
+            arrays.update({f"{name}_data": matrix.data, f"{name}_indices": matrix.indices,
+                           f"{name}_indptr": matrix.indptr, f"{name}_shape": matrix.shape})
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            lat_weights, lon_weights = (
+                sparse.csr_matrix((f[f"{name}_data"], f[f"{name}_indices"], f[f"{name}_indptr"]), shape=tuple(f[f"{name}_shape"]))
+                for name in ("lat", "lon")
+            )
+            return cls(lat_weights, lon_weights, f["latitudes"], f["longitudes"], str(f["method"]))
+
+    def _separable(self, values):
+        """(k, source lat, source lon) -> (k, target lat, target lon)."""
+        k, n_lat, n_lon = values.shape
+        out = self.lat_weights @ values.transpose(1, 0, 2).reshape(n_lat, -1)  # (target lat, k * source lon)
+        out = out.reshape(-1, k, n_lon).transpose(2, 1, 0).reshape(n_lon, -1)  # (source lon, k * target lat)
+        out = self.lon_weights @ out  # (target lon, k * target lat)
+        return out.reshape(-1, k, self.lat_weights.shape[0]).transpose(1, 2, 0)
+
+    def apply(self, values):
+        """Regrid an array whose last two axes are (latitude, longitude).
+
+        Missing source cells are left out and the remaining weights
+        renormalised, target cells without any source cell are NaN.
+        """
+        lead = values.shape[:-2]
+        values = np.asarray(values, dtype=np.float32).reshape(-1, *values.shape[-2:])
+        valid = np.isfinite(values)
+
+        total = self._separable(np.where(valid, values, 0))
+        if valid.all():
+            coverage = np.outer(self.lat_weights.sum(axis=1), self.lon_weights.sum(axis=1))[None]
+        else:
+            coverage = self._separable(valid.astype(np.float32))
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            regridded = np.where(coverage > 1e-9, total / coverage, np.nan)
+        return regridded.astype(np.float32).reshape(*lead, *regridded.shape[-2:])
+
+def _weights_key(source_latitudes, source_longitudes, latitudes, longitudes, method):
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (source_latitudes, source_longitudes, latitudes, longitudes):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    digest.update(f"{method}:{WEIGHTS_VERSION}".encode())
+    return digest.hexdigest()
+
+def regrid_weights(ds, target, method="bilinear", weights_dir=WEIGHTS_DIR):
+    """Cached RegridWeights from the grid of ``ds`` to ``target`` (a resolution or a grid file)."""
+    source_latitudes, source_longitudes = ds["latitude"].values, ds["longitude"].values
+    latitudes, longitudes = target_grid(target, source_latitudes, source_longitudes)
+    key = _weights_key(source_latitudes, source_longitudes, latitudes, longitudes, method)
+    cache_path = os.path.join(weights_dir, f"{key}.npz")
+
+    if os.path.exists(cache_path):
+        return RegridWeights.load(cache_path)
+
+    weights = RegridWeights.build(source_latitudes, source_longitudes, latitudes, longitudes, method)
+    weights.save(cache_path)
+    logging.info(f"Built {method} weights to a {len(latitudes)}x{len(longitudes)} grid, cached in {cache_path}")
+    return weights
+
+def regrid(ds, weights):
+    """Lazily regrid every (latitude, longitude) variable of ``ds``, one dask chunk of steps at a time."""
+    def regrid_variable(da):
+        if not {"latitude", "longitude"} <= set(da.dims):
+            return da
+        if da.chunks:
+            da = da.chunk({"latitude": -1, "longitude": -1})  # Each chunk holds whole fields
+        return xr.apply_ufunc(
+            weights.apply, da,
+            input_core_dims=[["latitude", "longitude"]], output_core_dims=[["latitude", "longitude"]],
+            exclude_dims={"latitude", "longitude"}, dask="parallelized", output_dtypes=[np.float32],
+            dask_gufunc_kwargs={"output_sizes": {"latitude": len(weights.latitudes), "longitude": len(weights.longitudes)}},
+            keep_attrs=True,
+        )
+
+    regridded = ds.map(regrid_variable, keep_attrs=True)
+    regridded = regridded.assign_coords(latitude=("latitude", weights.latitudes, ds["latitude"].attrs),
+                                        longitude=("longitude", weights.longitudes, ds["longitude"].attrs))
+    regridded.attrs["regrid_method"] = weights.method
+    return regridded
+
+@profile_stage("regrid")
+def export_regridded(ds, target, method="bilinear", output_path=None, profile=encoding_profiles.DEFAULT_PROFILE,
+                     weights_dir=WEIGHTS_DIR):
+    """Regrid the dataset onto ``target`` and write it as NetCDF (returns the path, None on failure).
+
+    ``target`` is a resolution in degrees or a NetCDF/Zarr file holding the
+    target grid, the default output is ``Outputs/final_cleaned_dataset_<grid>_<method>.nc``,
+    written with the encoding ``profile`` (see encoding_profiles).
+    """
+    output_path = output_path or f"Outputs/final_cleaned_dataset_{grid_name(target)}_{method}.nc"
+    try:
+        weights = regrid_weights(ds, target, method, weights_dir)
+        encoding_profiles.to_netcdf(regrid(ds, weights), output_path, profile)
+    except Exception as e:
+        logging.error(f"Error regridding onto {target}: {e}")
+        return None
+
+    logging.info(f"Regridded dataset ({method}, {len(weights.latitudes)}x{len(weights.longitudes)}) saved as {output_path}")
+    return output_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Regrid the cleaned dataset with cached sparse weights.")
+    parser.add_argument("target", help="Target resolution in degrees (e.g. 0.5) or a NetCDF/Zarr file with the target grid.")
+    parser.add_argument("--method", choices=METHODS, default="bilinear")
+    parser.add_argument("--source", default=DEFAULT_SOURCE, help="Cleaned NetCDF file or Zarr store.")
+    parser.add_argument("--output", default=None, help="NetCDF output file.")
+    parser.add_argument("--encoding-profile", choices=encoding_profiles.PROFILES, default=encoding_profiles.DEFAULT_PROFILE,
+                        help="Packing, chunking and compression of the output.")
+    args = parser.parse_args()
+
+    export_regridded(dataset_cache.open_dataset(args.source), args.target, args.method, args.output, args.encoding_profile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import os
+import json
+import shutil
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from logging_config import logging  # Import custom logging setup
+from profiling import profile_stage
+import dataset_cache
+from data_extraction import TIME_ENCODING
+
+DEFAULT_SOURCE = "Outputs/final_cleaned_dataset.nc"
+DEFAULT_OUTPUT_DIR = "Outputs/rollups"
+
+# Rollup store name -> period length (pandas frequency)
+PERIODS = {"daily": "1D", "6hourly": "6h"}
+
+# Summarised with min, max and mean over each period
+INSTANT_VARIABLES = ("t2m",)
+
+# Accumulated fields, de-accumulated into per-step increments and summed over each period
+ACCUMULATED_VARIABLES = ("tp", "smlt")
+
+# Forecast hours between accumulation restarts: 0 = accumulated since initialisation (ECMWF),
+# 6 for NCEP-style buckets (0-6h, then 6-7h, 6-8h...)
+ACCUMULATION_RESET_HOURS = int(os.environ.get("GRIB2_ACCUMULATION_RESET_HOURS", "0"))
+
+# Without a reset schedule, a cell whose accumulated value falls by more than this
+# fraction of the previous value restarted, smaller drops are packing or rounding noise
+RESET_DROP_FRACTION = 0.5
+
+class _PeriodAccumulator:
+    """Running min/max/sum of instantaneous fields and totals of increments over one period."""
+
+    def __init__(self, start):
+        self.start = start
+        self.samples = 0
+        self.minimum, self.maximum, self.total, self.count = {}, {}, {}, {}  # instantaneous variable -> field
+        self.increments = {}  # accumulated variable -> summed increments
+
+    def add_instant(self, fields):
+        for name, values in fields.items():
+            valid = np.isfinite(values)
+            if name in self.total:
+                np.fmin(self.minimum[name], values, out=self.minimum[name])
+                np.fmax(self.maximum[name], values, out=self.maximum[name])
+            else:
+                self.minimum[name], self.maximum[name] = values.copy(), values.copy()
+                self.total[name] = np.zeros(values.shape, dtype=np.float64)
+                self.count[name] = np.zeros(values.shape, dtype=np.int32)
+            # Missing values are left out of the mean, like fmin/fmax leave them out of the extremes
+            self.total[name] += np.where(valid, values, 0)
+            self.count[name] += valid
+        self.samples += 1
+
+    def add_increments(self, fields):
+        for name, values in fields.items():
+            if name in self.increments:
+                self.increments[name] += values
+            else:
+                self.increments[name] = values.astype(np.float64)
+
+    def to_dataset(self, coords, instant_variables, accumulated_variables, units):
+        """One period of the rollup store, with a length-1 ``time`` dimension.
+
+        Every variable is present in every period, those without any value
+        in it (e.g. a period only reached by an increment) are NaN.
+        """
+        dims = ("time", "latitude", "longitude")
+        missing = np.full((1, len(coords["latitude"]), len(coords["longitude"])), np.nan, dtype=np.float32)
+        data_vars = {"samples": ("time", [self.samples])}
+        for name in instant_variables:
+            attrs = {"units": units[name]}
+            if name in self.total:
+                data_vars[f"{name}_min"] = (dims, self.minimum[name][None], attrs)
+                data_vars[f"{name}_max"] = (dims, self.maximum[name][None], attrs)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    mean = self.total[name] / self.count[name]
+                data_vars[f"{name}_mean"] = (dims, mean.astype(np.float32)[None], attrs)
+                data_vars[f"{name}_count"] = (dims, self.count[name][None])
+            else:
+                for statistic in ("min", "max", "mean"):
+                    data_vars[f"{name}_{statistic}"] = (dims, missing, attrs)
+                data_vars[f"{name}_count"] = (dims, np.zeros(missing.shape, dtype=np.int32))
+        for name in accumulated_variables:
+            values = self.increments[name].astype(np.float32)[None] if name in self.increments else missing
+            data_vars[f"{name}_total"] = (dims, values, {"units": units[name]})
+        return xr.Dataset(data_vars, coords={"time": [np.datetime64(self.start, "ns")], **coords})
+
+    @classmethod
+    def from_dataset(cls, ds):
+        """Resume the accumulator of a period already written to a rollup store."""
+        accumulator = cls(pd.Timestamp(ds["time"].values))
+        accumulator.samples = int(ds["samples"])
+        for name in ds.data_vars:
+            if name.endswith("_count") and ds[name].values.any():
+                variable = name[:-len("_count")]
+                accumulator.count[variable] = ds[name].values.astype(np.int32)
+                accumulator.total[variable] = np.nan_to_num(ds[f"{variable}_mean"].values.astype(np.float64)) * ds[name].values
+                accumulator.minimum[variable] = ds[f"{variable}_min"].values
+                accumulator.maximum[variable] = ds[f"{variable}_max"].values
+            elif name.endswith("_total") and not np.isnan(ds[name].values).all():
+                accumulator.increments[name[:-len("_total")]] = ds[name].values.astype(np.float64)
+        return accumulator
+
+class _RollupStore:
+    """Zarr store of one period length, periods are appended or rewritten in place."""
+
+    def __init__(self, path, coords, instant_variables, accumulated_variables, units):
+        self.path = path
+        self.coords = coords
+        self.variables = (instant_variables, accumulated_variables, units)
+        self.times = list(xr.open_zarr(path)["time"].values) if os.path.exists(path) else []
+
+    def last_period(self):
+        """Accumulator of the newest stored period, which may still be incomplete."""
+        if not self.times:
+            return None
+        return _PeriodAccumulator.from_dataset(xr.open_zarr(self.path).isel(time=-1).load())
+
+    def write(self, accumulator):
+        ds = accumulator.to_dataset(self.coords, *self.variables)
+        time = ds["time"].values[0]
+        if time in self.times:
+            index = self.times.index(time)
+            ds.drop_vars(["latitude", "longitude"]).to_zarr(self.path, region={"time": slice(index, index + 1)})
+        elif self.times:
+            ds.to_zarr(self.path, append_dim="time")
+            self.times.append(time)
+        else:
+            encoding = {name: {"chunks": (1,) + var.shape[1:]} for name, var in ds.data_vars.items()}
+            encoding["time"] = dict(TIME_ENCODING["time"])
+            ds.to_zarr(self.path, mode="w", encoding=encoding)
+            self.times.append(time)
+
+def _load_state(output_dir):
+    try:
+        with open(os.path.join(output_dir, "state.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _save_state(output_dir, state):
+    state_path = os.path.join(output_dir, "state.json")
+    with open(f"{state_path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{state_path}.tmp", state_path)
+
+def _init_time(ds):
+    if "time" in ds.coords:
+        return str(pd.Timestamp(ds["time"].values))
+    return str(pd.Timestamp(ds["valid_time"].values[0] - ds["step"].values[0]))
+
+def _increment(current, previous, previous_step_hours, reset_hours):
+    """Amount accumulated between two steps, never negative.
+
+    With ``reset_hours`` the accumulation restarts only when the previous
+    step falls on a reset boundary. Without it, a cell restarted where the
+    value dropped by more than RESET_DROP_FRACTION of the previous one.
+    """
+    if previous is None or (reset_hours and previous_step_hours % reset_hours == 0):
+        return current
+    difference = current - previous
+    if not reset_hours:
+        difference = np.where(difference < -RESET_DROP_FRACTION * previous, current, difference)
+    return np.maximum(difference, 0)
+
+def _step_hours(step):
+    return float(step / np.timedelta64(1, "h"))
+
+@profile_stage("rollups")
+def update_rollups(ds, output_dir=DEFAULT_OUTPUT_DIR, instant_variables=INSTANT_VARIABLES,
+                   accumulated_variables=ACCUMULATED_VARIABLES, reset_hours=ACCUMULATION_RESET_HOURS):
+    """Bring the daily and 6-hourly rollups of ``ds`` up to date in one pass over its new steps.
+
+    Each step is read once and folded into running min/max/mean
+    accumulators of ``instant_variables`` and, after de-accumulation
+    (see ``_increment``), into per-period totals of
+    ``accumulated_variables``. The increments themselves go to
+    ``<output_dir>/increments.zarr`` and the summaries to
+    ``<output_dir>/<period>.zarr`` (``time`` = period start, ``samples`` =
+    steps seen so far). Periods are written as soon as they are complete.
+    ``state.json`` records the last step rolled up, so a later call only
+    reads the steps added since, resuming the last (partial) period from
+    its store. A new cycle or a change in the processed steps rebuilds
+    everything. Returns the output directory, or None on failure.
+    """
+    instant_variables = [name for name in instant_variables if name in ds.data_vars]
+    accumulated_variables = [name for name in accumulated_variables if name in ds.data_vars]
+    if "step" not in ds.dims:
+        ds = ds.expand_dims("step")
+
+    steps = [_step_hours(step) for step in ds["step"].values]
+    init_time = _init_time(ds)
+    signature = {"init_time": init_time, "instant": instant_variables, "accumulated": accumulated_variables,
+                 "reset_hours": reset_hours}
+
+    state = _load_state(output_dir)
+    if state and ({key: state.get(key) for key in signature} != signature or state["steps"] != steps[:len(state["steps"])]):
+        logging.info(f"Rollups in {output_dir} belong to another cycle or selection, rebuilding them.")
+        state = None
+    if state is None:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        state = {**signature, "steps": []}
+    os.makedirs(output_dir, exist_ok=True)
+
+    new_steps = range(len(state["steps"]), len(steps))
+    if not len(new_steps):
+        logging.info(f"Rollups in {output_dir} are up to date.")
+        return output_dir
+
+    try:
+        coords = {"latitude": ds["latitude"].values, "longitude": ds["longitude"].values}
+        units = {name: ds[name].attrs.get("units", "") for name in instant_variables + accumulated_variables}
+        stores = {name: _RollupStore(os.path.join(output_dir, f"{name}.zarr"), coords, instant_variables, accumulated_variables, units)
+                  for name in PERIODS}
+        increments_path = os.path.join(output_dir, "increments.zarr")
+
+        # Running accumulators of the periods still open, resumed from the stores
+        open_periods = {name: {} for name in PERIODS}
+        for name, store in stores.items():
+            last = store.last_period()
+            if last is not None:
+                open_periods[name][last.start] = last
+
+        previous = {}
+        if state["steps"] and accumulated_variables:
+            # De-accumulation continues from the last step already rolled up
+            last_index = len(state["steps"]) - 1
+            previous = {name: ds[name].isel(step=last_index).values for name in accumulated_variables}
+
+        for index in new_steps:
+            step_ds = ds.isel(step=index)
+            valid_time = pd.Timestamp(step_ds["valid_time"].values)
+            instant = {name: step_ds[name].values.astype(np.float32) for name in instant_variables}
+
+            increments = {}
+            for name in accumulated_variables:
+                current = step_ds[name].values.astype(np.float32)
+                previous_step = steps[index - 1] if index else None
+                increments[name] = _increment(current, previous.get(name), previous_step, reset_hours)
+                previous[name] = current
+
+            if increments:
+                slab = xr.Dataset({name: (("latitude", "longitude"), values, {"units": units[name]})
+                                   for name, values in increments.items()},
+                                  coords=coords).expand_dims(step=[step_ds["step"].values])
+                slab = slab.assign_coords(valid_time=("step", [step_ds["valid_time"].values]))
+                if os.path.exists(increments_path):
+                    slab.to_zarr(increments_path, append_dim="step")
+                else:
+                    encoding = {name: dict(TIME_ENCODING[name]) for name in ("step", "valid_time")}
+                    slab.to_zarr(increments_path, mode="w", encoding=encoding)
+
+            for name, frequency in PERIODS.items():
+                # An instant belongs to the period containing it, an increment to the one its interval ends in
+                instant_start = valid_time.floor(frequency)
+                increment_start = (valid_time - pd.Timedelta(1, "ns")).floor(frequency)
+
+                # The accumulation at step 0 covers no time
+                for start, add, fields in ((instant_start, "add_instant", instant), (increment_start, "add_increments", increments)):
+                    if fields and not (add == "add_increments" and steps[index] == 0):
+                        accumulator = open_periods[name].setdefault(start, _PeriodAccumulator(start))
+                        getattr(accumulator, add)(fields)
+
+                # Periods no later step can contribute to are complete
+                for start in sorted(open_periods[name]):
+                    if start < min(instant_start, increment_start):
+                        stores[name].write(open_periods[name].pop(start))
+
+        # The newest periods are written even if incomplete, later steps extend them
+        for name in PERIODS:
+            for start in sorted(open_periods[name]):
+                stores[name].write(open_periods[name][start])
+
+        _save_state(output_dir, {**state, "steps": steps})
+    except Exception as e:
+        logging.error(f"Error computing rollups: {e}")
+        # The stores may be partly updated, the next run rebuilds them
+        if os.path.exists(os.path.join(output_dir, "state.json")):
+            os.remove(os.path.join(output_dir, "state.json"))
+        return None
+
+    logging.info(f"Rolled up {len(new_steps)} new steps into {output_dir}")
+    return output_dir
+
+def main():
+    parser = argparse.ArgumentParser(description="Daily and 6-hourly rollups of the cleaned dataset.")
+    parser.add_argument("--source", default=DEFAULT_SOURCE, help="Cleaned NetCDF file or Zarr store.")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--reset-hours", type=int, default=ACCUMULATION_RESET_HOURS,
+                        help="Forecast hours between accumulation restarts (0 = accumulated since initialisation).")
+    args = parser.parse_args()
+
+    update_rollups(dataset_cache.open_dataset(args.source), args.output_dir, reset_hours=args.reset_hours)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the top of the project, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# logging_config opens its log files relative to the working directory on import,
+# keep the test runs out of the project's logs
+os.chdir(tempfile.mkdtemp(prefix="grib2_tests_"))
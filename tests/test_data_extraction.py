@@ -0,0 +1,22 @@
+import os
+
+import data_extraction
+
+def _decode(file_path):
+    if file_path == "crash.grib2":
+        os._exit(1)  # Like a worker killed for memory
+    if file_path == "corrupt.grib2":
+        raise ValueError("not a GRIB2 file")
+    return file_path.upper()
+
+def test_dead_worker_only_loses_its_file():
+    file_list = ["a.grib2", "b.grib2", "crash.grib2", "c.grib2", "corrupt.grib2", "d.grib2", "e.grib2"]
+    results = list(data_extraction._map_files(_decode, file_list, 2))
+
+    assert results == [
+        ("a.grib2", "A.GRIB2"), ("b.grib2", "B.GRIB2"), ("crash.grib2", None), ("c.grib2", "C.GRIB2"),
+        ("corrupt.grib2", None), ("d.grib2", "D.GRIB2"), ("e.grib2", "E.GRIB2"),
+    ]
+
+def test_in_process_keeps_file_order():
+    assert list(data_extraction._map_files(str.upper, ["b", "a"], 1)) == [("b", "B"), ("a", "A")]
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+import export_cog
+
+def test_grid_transform_of_regular_grid():
+    latitudes = np.arange(50, 40, -0.25)
+    longitudes = np.arange(-10, 0, 0.25)
+    transform = export_cog.grid_transform(latitudes, longitudes)
+
+    assert transform.a == pytest.approx(0.25)
+    assert transform.e == pytest.approx(-0.25)
+    assert transform.c == pytest.approx(-10.125)
+    assert transform.f == pytest.approx(50.125)
+
+def test_grid_transform_refuses_gapped_longitudes():
+    # Two regions cropped from one grid, with a gap between them
+    latitudes = np.arange(50, 40, -0.25)
+    longitudes = np.concatenate([np.arange(-10, 0, 0.25), np.arange(20, 30, 0.25)])
+
+    with pytest.raises(ValueError):
+        export_cog.grid_transform(latitudes, longitudes)
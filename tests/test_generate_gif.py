@@ -0,0 +1,20 @@
+from PIL import Image
+
+import generate_gif
+
+def _frames(count):
+    return (Image.new("RGB", (8, 8), (index * 40, 0, 0)) for index in range(count))
+
+def test_apng_keeps_every_frame(tmp_path):
+    output_path = str(tmp_path / "animation.png")
+    generate_gif.save_animation(_frames(3), output_path)
+
+    with Image.open(output_path) as image:
+        assert image.n_frames == 3
+
+def test_gif_keeps_every_frame(tmp_path):
+    output_path = str(tmp_path / "animation.gif")
+    generate_gif.save_animation(_frames(3), output_path)
+
+    with Image.open(output_path) as image:
+        assert image.n_frames == 3
@@ -0,0 +1,24 @@
+import re
+import zipfile
+
+import numpy as np
+
+import kml_tiles
+
+def test_region_bounds_stay_on_the_globe(tmp_path):
+    latitudes = np.arange(-90, 90.1, 10.0)
+    longitudes = np.arange(-180, 180, 10.0)
+    values = np.zeros((len(latitudes), len(longitudes)))
+    kmz_path = str(tmp_path / "tiles.kmz")
+
+    kml_tiles.write_kmz_pyramid(values, latitudes, longitudes, kmz_path, ["ff0000ff"], -1, 1, tile_size=8, max_workers=1)
+
+    with zipfile.ZipFile(kmz_path) as kmz:
+        documents = [kmz.read(name).decode() for name in kmz.namelist()]
+
+    bounds = {side: [float(value) for document in documents for value in re.findall(f"<{side}>([-0-9.]+)</{side}>", document)]
+              for side in ("north", "south", "east", "west")}
+    assert bounds["north"] and bounds["west"]
+    # The outermost cells are clamped to the globe instead of reaching half a cell past it
+    assert max(bounds["north"]) == 90 and min(bounds["south"]) == -90
+    assert max(bounds["east"]) == 175 and min(bounds["west"]) == -180
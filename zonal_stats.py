@@ -0,0 +1,248 @@
+import os
+import json
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+import shapely
+import xarray as xr
+from scipy import sparse
+
+from logging_config import logging  # Import custom logging setup
+from profiling import profile_stage
+import dataset_cache
+
+DEFAULT_SOURCE = "Outputs/final_cleaned_dataset.nc"
+DEFAULT_OUTPUT = "Outputs/zonal_stats.csv"
+
+# Weight matrices are cached here, keyed by the grid and the polygons
+WEIGHTS_DIR = os.environ.get("GRIB2_ZONAL_WEIGHTS_DIR", "Outputs/zonal_weights")
+
+# Values of one step block read at once (step x window cells, float32)
+BLOCK_BYTES = 256 * 1024 * 1024
+
+STATISTICS = ("mean", "min", "max")
+
+# Bump when the rasterisation changes, so cached matrices are rebuilt
+WEIGHTS_VERSION = 1
+
+def load_regions(geojson_path, id_field=None):
+    """Return (region names, shapely geometries) of a GeoJSON FeatureCollection.
+
+    Names come from the ``id_field`` property, or the feature ``id``, or
+    its position in the file.
+    """
+    with open(geojson_path) as f:
+        features = json.load(f)["features"]
+
+    names, geometries = [], []
+    for index, feature in enumerate(features):
+        if not feature.get("geometry"):
+            continue
+        properties = feature.get("properties") or {}
+        names.append(str(properties[id_field] if id_field else feature.get("id", index)))
+        geometries.append(shapely.geometry.shape(feature["geometry"]))
+
+    return names, geometries
+
+class ZonalWeights:
+    """Sparse cell-to-region weights of a set of polygons on one lat/lon grid.
+
+    Row ``r`` holds the cos(latitude) area weight of every grid cell whose
+    centre falls inside region ``r`` (the cells it touches, for regions
+    smaller than a cell). Columns index the cells of the smallest grid
+    window covering every region, so only that window is ever read.
+    """
+
+    def __init__(self, matrix, names, window):
+        self.matrix = matrix.tocsr()
+        self.names = list(names)
+        self.window = window  # (row start, row stop, column start, column stop)
+
+    @classmethod
+    def build(cls, latitudes, longitudes, names, geometries):
+        """Rasterise every geometry onto the grid, each one only over its own bounding window."""
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        wrapped = (np.asarray(longitudes, dtype=np.float64) + 180) % 360 - 180  # GeoJSON longitudes
+        area = np.cos(np.radians(latitudes))
+
+        regions, rows, cols = [], [], []
+        for region, geometry in enumerate(geometries):
+            min_lon, min_lat, max_lon, max_lat = geometry.bounds
+            row_index = np.flatnonzero((latitudes >= min_lat) & (latitudes <= max_lat))
+            col_index = np.flatnonzero((wrapped >= min_lon) & (wrapped <= max_lon))
+
+            shapely.prepare(geometry)
+            grid_rows, grid_cols = np.meshgrid(row_index, col_index, indexing="ij")
+            inside = shapely.contains_xy(geometry, wrapped[grid_cols], latitudes[grid_rows])
+            grid_rows, grid_cols = grid_rows[inside], grid_cols[inside]
+
+            if not len(grid_rows):
+                # Smaller than a cell, or between cell centres: use the cells it touches
+                grid_rows, grid_cols = cls._touched_cells(latitudes, wrapped, geometry)
+                if not len(grid_rows):
+                    logging.warning(f"Region {names[region]} is outside the grid")
+
+            regions.append(np.full(len(grid_rows), region))
+            rows.append(grid_rows)
+            cols.append(grid_cols)
+
+        regions, rows, cols = np.concatenate(regions), np.concatenate(rows), np.concatenate(cols)
+        if not len(rows):
+            raise ValueError("None of the regions overlap the grid")
+
+        window = (int(rows.min()), int(rows.max()) + 1, int(cols.min()), int(cols.max()) + 1)
+        window_cols = window[3] - window[2]
+        cells = (rows - window[0]) * window_cols + (cols - window[2])
+        shape = (len(geometries), (window[1] - window[0]) * window_cols)
+
+        matrix = sparse.csr_matrix((area[rows], (regions, cells)), shape=shape)
+        return cls(matrix, names, window)
+
+    @staticmethod
+    def _touched_cells(latitudes, wrapped, geometry):
+        """Cells whose extent intersects a geometry."""
+        lat_step = abs(latitudes[1] - latitudes[0]) if len(latitudes) > 1 else 180.0
+        lon_step = abs(wrapped[1] - wrapped[0]) if len(wrapped) > 1 else 360.0
+        min_lon, min_lat, max_lon, max_lat = geometry.bounds
+
+        row_index = np.flatnonzero(np.abs(latitudes - (min_lat + max_lat) / 2) <= (max_lat - min_lat + lat_step) / 2)
+        col_index = np.flatnonzero(np.abs(wrapped - (min_lon + max_lon) / 2) <= (max_lon - min_lon + lon_step) / 2)
+        grid_rows, grid_cols = np.meshgrid(row_index, col_index, indexing="ij")
+        cells = shapely.box(wrapped[grid_cols] - lon_step / 2, latitudes[grid_rows] - lat_step / 2,
+                            wrapped[grid_cols] + lon_step / 2, latitudes[grid_rows] + lat_step / 2)
+        touched = shapely.intersects(cells, geometry)
+        return grid_rows[touched], grid_cols[touched]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(path, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                            shape=self.matrix.shape, window=self.window, names=np.array(self.names))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            matrix = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+            return cls(matrix, f["names"].tolist(), tuple(int(value) for value in f["window"]))
+
+def _weights_key(latitudes, longitudes, geojson_path, id_field):
+    """Cache key of the grid coordinates, the polygon file's content and the id field."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (latitudes, longitudes):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    with open(geojson_path, "rb") as f:
+        digest.update(f.read())
+    digest.update(f"{id_field}:{WEIGHTS_VERSION}".encode())
+    return digest.hexdigest()
+
+def region_weights(ds, geojson_path, id_field=None, weights_dir=WEIGHTS_DIR):
+    """Cached ZonalWeights of the regions in ``geojson_path`` on the grid of ``ds``."""
+    latitudes, longitudes = ds["latitude"].values, ds["longitude"].values
+    cache_path = os.path.join(weights_dir, f"{_weights_key(latitudes, longitudes, geojson_path, id_field)}.npz")
+
+    if os.path.exists(cache_path):
+        return ZonalWeights.load(cache_path)
+
+    with profile_stage("zonal_rasterise", level=logging.DEBUG, file=geojson_path):
+        weights = ZonalWeights.build(latitudes, longitudes, *load_regions(geojson_path, id_field))
+    weights.save(cache_path)
+    logging.info(f"Rasterised {len(weights.names)} regions onto {weights.matrix.nnz} cells, cached in {cache_path}")
+    return weights
+
+def _block_statistics(weights, values, statistics):
+    """Statistics of a (steps, cells) block for every region, as {name: (steps, regions)}."""
+    valid = np.isfinite(values)
+    results = {}
+
+    if "mean" in statistics:
+        # One sparse x dense product for every region and step, missing cells get no weight
+        totals = weights.matrix @ np.where(valid, values, 0).T
+        coverage = weights.matrix @ valid.T.astype(np.float32)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            results["mean"] = (totals / coverage).T
+
+    # Gather every region's cells once and reduce each CSR row segment
+    indptr = weights.matrix.indptr
+    empty = indptr[:-1] == indptr[1:]
+    starts = np.minimum(indptr[:-1], max(len(weights.matrix.indices) - 1, 0))
+    gathered = values[:, weights.matrix.indices]
+    for name, reduce in (("min", np.fmin), ("max", np.fmax)):
+        if name in statistics:
+            reduced = reduce.reduceat(gathered, starts, axis=1) if gathered.shape[1] else np.full((len(values), len(empty)), np.nan)
+            reduced[:, empty] = np.nan
+            results[name] = reduced
+
+    return results
+
+@profile_stage("zonal")
+def zonal_statistics(ds, weights, variables=None, statistics=STATISTICS):
+    """Area-weighted per-region statistics of every variable and step.
+
+    Returns a Dataset with ``region`` and ``step`` dimensions and one
+    ``<variable>_<statistic>`` variable per combination. The grid window
+    covering the regions is read ``BLOCK_BYTES`` worth of steps at a time.
+    """
+    variables = variables or [name for name, var in ds.data_vars.items() if {"latitude", "longitude"} <= set(var.dims)]
+    row_start, row_stop, col_start, col_stop = weights.window
+    window = ds.isel(latitude=slice(row_start, row_stop), longitude=slice(col_start, col_stop))
+    n_cells = weights.matrix.shape[1]
+
+    output = {}
+    for variable in variables:
+        da = window[variable]
+        if "step" not in da.dims:
+            da = da.expand_dims("step")
+        da = da.transpose("step", "latitude", "longitude")
+
+        step_block = max(1, BLOCK_BYTES // (4 * n_cells))
+        blocks = []
+        for start in range(0, da.sizes["step"], step_block):
+            values = np.asarray(da.isel(step=slice(start, start + step_block)).values, dtype=np.float32)
+            blocks.append(_block_statistics(weights, values.reshape(len(values), n_cells), statistics))
+
+        for statistic in statistics:
+            output[f"{variable}_{statistic}"] = (("step", "region"), np.concatenate([block[statistic] for block in blocks]))
+
+    coords = {"region": weights.names}
+    if "step" in ds.dims:
+        coords["step"] = ds["step"].values
+        if "valid_time" in ds.coords and ds["valid_time"].dims == ("step",):
+            coords["valid_time"] = ("step", ds["valid_time"].values)
+
+    result = xr.Dataset(output, coords=coords).transpose("region", "step")
+    logging.info(f"Zonal statistics of {len(variables)} variables over {len(weights.names)} regions")
+    return result
+
+def export_zonal_stats(ds, geojson_path, output_path=DEFAULT_OUTPUT, id_field=None, variables=None,
+                       weights_dir=WEIGHTS_DIR):
+    """Write per-region statistics as one CSV or Parquet row per region and step (None on failure)."""
+    try:
+        weights = region_weights(ds, geojson_path, id_field, weights_dir)
+        result = zonal_statistics(ds, weights, variables)
+        frame = result.to_dataframe(dim_order=[dim for dim in ("region", "step") if dim in result.dims]).reset_index()
+        if output_path.endswith(".parquet"):
+            frame.to_parquet(output_path, index=False)
+        else:
+            frame.to_csv(output_path, index=False)
+    except Exception as e:
+        logging.error(f"Error computing zonal statistics: {e}")
+        return None
+
+    logging.info(f"Zonal statistics saved as {output_path}")
+    return output_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Area-weighted statistics of the forecast over polygon regions.")
+    parser.add_argument("regions", help="GeoJSON FeatureCollection of the regions.")
+    parser.add_argument("--id-field", default=None, help="Feature property naming each region (default: feature id).")
+    parser.add_argument("--source", default=DEFAULT_SOURCE, help="Cleaned NetCDF file or Zarr store.")
+    parser.add_argument("--variables", type=lambda value: value.split(","), default=None,
+                        help="Comma-separated variables, e.g. t2m,sw-5,sw-15,sw-50 (default: all).")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="CSV or .parquet output file.")
+    args = parser.parse_args()
+
+    export_zonal_stats(dataset_cache.open_dataset(args.source), args.regions, args.output, args.id_field, args.variables)
+
+if __name__ == "__main__":
+    main()